@@ -0,0 +1,137 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Event storage encodings: stored size, insert and load rates.
+Needs a running mongod. Encodings whose libraries aren't installed
+are skipped.
+
+Usage:
+  python -m bench.bench_codec [<events>] [<batch_size>]
+"""
+
+import datetime
+import sys
+import time
+import uuid
+
+import bson
+
+from oahu import codec
+from oahu import config
+from oahu import criteria
+from oahu import mongodb_driver
+from oahu import trigger_definition
+
+
+SPECS = [None, "json", "json+zlib", "json+lz4", "msgpack+zlib",
+         "msgpack+lz4"]
+
+
+class BenchConfig(config.Config):
+    def __init__(self, spec):
+        self.spec = spec
+
+    def get_driver(self):
+        return None
+
+    def get_distiller_config(self):
+        return None
+
+    def get_mongo_database(self):
+        return "oahu_bench"
+
+    def get_mongo_event_codec(self):
+        return self.spec
+
+
+def make_events(num):
+    """Roughly the shape and size of a nova notification."""
+    now = datetime.datetime.utcnow()
+    events = []
+    for x in range(num):
+        instance_id = str(uuid.uuid4())
+        events.append({
+            '_unique_id': str(uuid.uuid4()),
+            '_context_request_id': "req-%d" % (x / 10),
+            '_context_project_id': "project-%d" % (x % 50),
+            '_context_user_id': "user-%d" % (x % 200),
+            '_context_roles': ["admin", "member"],
+            '_context_auth_token': "%032x" % x,
+            'event_type': 'compute.instance.update',
+            'priority': 'INFO',
+            'publisher_id': 'compute.host-%d' % (x % 20),
+            'timestamp': now + datetime.timedelta(seconds=x),
+            'payload': {
+                'instance_id': instance_id,
+                'display_name': "server-%d" % x,
+                'state': 'active',
+                'old_state': 'building',
+                'state_description': '',
+                'memory_mb': 2048,
+                'disk_gb': 20,
+                'vcpus': 2,
+                'instance_type': 'm1.small',
+                'image_meta': dict(('property_%d' % y, "value %d" % y)
+                                   for y in range(20)),
+                'metadata': [{'key': 'tag-%d' % y, 'value': 'x' * 20}
+                             for y in range(5)],
+                'fixed_ips': [{'address': '10.0.%d.%d' % (x % 250, y),
+                               'type': 'fixed', 'version': 4,
+                               'label': 'private'} for y in range(2)],
+                'audit_period_beginning': str(now.date()),
+                'audit_period_ending': str(now.date()),
+                'bandwidth': {'public': {'bw_in': x, 'bw_out': x * 2}}}})
+    return events
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    trigger = trigger_definition.TriggerDefinition(
+                    "bench", ["_context_request_id"], criteria.Inactive(60), [])
+    events = [(e['_unique_id'], e) for e in make_events(num)]
+
+    print "%-14s %10s %14s %14s" % ("encoding", "bytes/event", "inserts/sec",
+                                    "loads/sec")
+    for spec in SPECS:
+        try:
+            driver = mongodb_driver.MongoDBDriver([trigger], BenchConfig(spec))
+        except ValueError as e:
+            print "%-14s skipped, %s" % (spec, e)
+            continue
+        driver.flush_all()
+
+        start = time.time()
+        for x in range(0, num, batch_size):
+            driver.save_events(events[x:x + batch_size])
+        insert_secs = time.time() - start
+
+        size = 0
+        start = time.time()
+        for doc in driver.events.find():
+            size += len(bson.BSON.encode(doc))
+            event = driver._from_event_doc(doc)
+            event['payload']['instance_id']  # What a callback would do.
+        load_secs = time.time() - start
+
+        print "%-14s %10d %14.0f %14.0f" % (spec or "bson", size / num,
+                                           num / insert_secs,
+                                           num / load_secs)
+        driver.flush_all()
+
+
+if __name__ == '__main__':
+    main()
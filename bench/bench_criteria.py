@@ -0,0 +1,74 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Criteria benchmark - nested criteria trees vs. compiled ones.
+
+Usage:
+  python -m bench.bench_criteria [<depth>] [<iterations>]
+"""
+
+import datetime
+import sys
+import timeit
+
+from oahu import criteria
+from oahu import debugging
+
+
+class FakeStream(object):
+    def __init__(self, last_update):
+        self.last_update = last_update
+
+
+def deep_tree(depth):
+    """A right-leaning And tree with the cheap event type check at
+       the very bottom, the worst case for an uncompiled tree.
+    """
+    node = criteria.EventType("compute.instance.exists")
+    for x in range(depth):
+        node = criteria.And([criteria.Inactive(60 + x), node])
+    return node
+
+
+def bench(label, tree, stream, event, now, debugger, iterations):
+    def run():
+        tree.should_fire(stream, event, debugger, now)
+
+    secs = timeit.timeit(run, number=iterations)
+    print "%-28s %8.2f usec/check" % (label, secs * 1e6 / iterations)
+
+
+def main():
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    now = datetime.datetime.utcnow()
+    stream = FakeStream(now - datetime.timedelta(hours=1))
+    event = {'event_type': 'compute.instance.update'}  # Won't match.
+
+    raw = deep_tree(depth)
+    compiled = criteria.compile_criteria(raw)
+
+    print "depth=%d, iterations=%d" % (depth, iterations)
+    for name, debugger in [("no-op", debugging.NoOpTriggerDebugger()),
+                           ("debug", debugging.TriggerDebugger("bench"))]:
+        bench("nested (%s)" % name, raw, stream, event, now, debugger,
+              iterations)
+        bench("compiled (%s)" % name, compiled, stream, event, now, debugger,
+              iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Periodic trigger check on the in-memory driver - the slot array
+   scan vs. calling should_fire() on every stream.
+
+Usage:
+  python -m bench.bench_trigger_check [<streams>] [<shards>]
+"""
+
+import datetime
+import sys
+import time
+
+from oahu import criteria
+from oahu import debugging
+from oahu import inmemory
+from oahu import stream as pstream
+from oahu import trigger_definition
+
+
+def populate(driver, trigger, num_streams, start):
+    # Straight into the shards, we're not timing ingest here.
+    for x in xrange(num_streams):
+        traits = {'request_id': "req-%d" % x}
+        shard = driver._get_shard(trigger.name,
+                                  pstream.trait_key(traits))
+        stream = inmemory.InMemoryStream(trigger.name, traits, shard)
+        stream.last_update = start + datetime.timedelta(seconds=x % 3600)
+        shard.add(stream)
+
+
+def main():
+    num_streams = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_shards = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    trigger = trigger_definition.TriggerDefinition(
+                    "by_request", ["request_id"],
+                    criteria.And([criteria.Inactive(7200),
+                                  criteria.Inactive(3600)]), [])
+    driver = inmemory.InMemoryDriver([trigger], num_shards=num_shards)
+    start = datetime.datetime(2014, 5, 1)
+    populate(driver, trigger, num_streams, start)
+    now = start + datetime.timedelta(seconds=3600)  # Nothing expires.
+
+    print "streams=%d, shards=%d, numpy=%s" % (num_streams, num_shards,
+                                               inmemory.numpy is not None)
+
+    debugger = debugging.NoOpTriggerDebugger()
+    started = time.time()
+    for shard in driver.shards:
+        for stream in shard.active_streams[trigger.name].values():
+            trigger.should_fire(stream, None, debugger, now=now)
+    print "%-12s %8.3f secs" % ("per-stream", time.time() - started)
+
+    started = time.time()
+    driver.do_trigger_check(None, -1, now)
+    print "%-12s %8.3f secs" % ("slots", time.time() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ingest cost of each MongoDB write concern. Needs a running mongod.
+
+Usage:
+  python -m bench.bench_write_concern [<events>] [<batch_size>]
+"""
+
+import datetime
+import sys
+import time
+import uuid
+
+from oahu import config
+from oahu import criteria
+from oahu import mongodb_driver
+from oahu import trigger_definition
+
+
+SETTINGS = [
+    ("acknowledged (default)", {}),
+    ("w=1, j=False", {'w': 1, 'j': False}),
+    ("w=1, j=True", {'w': 1, 'j': True}),
+    ("w=0 (unacknowledged, dedup off)", {'w': 0}),
+]
+
+
+class BenchConfig(config.Config):
+    def __init__(self, ingest):
+        self.ingest = ingest
+
+    def get_driver(self):
+        return None
+
+    def get_distiller_config(self):
+        return None
+
+    def get_mongo_database(self):
+        return "oahu_bench"
+
+    def get_mongo_write_concerns(self):
+        return {'ingest': self.ingest}
+
+
+def make_events(num):
+    now = datetime.datetime.utcnow()
+    events = []
+    for x in range(num):
+        events.append({'_unique_id': str(uuid.uuid4()),
+                       '_context_request_id': "req-%d" % (x / 10),
+                       'event_type': 'compute.instance.update',
+                       'timestamp': now + datetime.timedelta(seconds=x),
+                       'payload': {'instance_id': str(uuid.uuid4()),
+                                   'state': 'active'}})
+    return events
+
+
+def main():
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    trigger = trigger_definition.TriggerDefinition(
+                    "bench", ["_context_request_id"], criteria.Inactive(60), [])
+    events = make_events(num)
+
+    for label, ingest in SETTINGS:
+        driver = mongodb_driver.MongoDBDriver([trigger], BenchConfig(ingest))
+        driver.flush_all()
+
+        start = time.time()
+        for x in range(0, num, batch_size):
+            driver.add_events(events[x:x + batch_size])
+        secs = time.time() - start
+        print "%-24s %8.0f events/sec" % (label, num / secs)
+
+        driver.flush_all()
+
+
+if __name__ == '__main__':
+    main()
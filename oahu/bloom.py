@@ -0,0 +1,140 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bloom filters for cheap "have we seen this message_id?" checks.
+
+A miss is definite, a hit only probable, so hits still need to be
+confirmed against storage. See DBDriver.set_dedup().
+"""
+
+import hashlib
+import math
+import struct
+import threading
+import time
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        bits = int(math.ceil(-capacity * math.log(error_rate) /
+                             math.log(2) ** 2))
+        self.num_bits = max(bits, 8)
+        self.num_hashes = max(int(round(self.num_bits * math.log(2) /
+                                        capacity)), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """Returns True if key was (probably) already present."""
+        present = True
+        for pos in self._positions(key):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                present = False
+                self.bits[pos >> 3] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+
+class ScalableBloomFilter(object):
+    """Adds bigger filters as it fills up, each with a tighter error
+       rate, so the overall false positive rate stays under
+       error_rate however many keys are added.
+    """
+    GROWTH = 2
+    TIGHTENING = 0.5
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = []
+
+    def _current(self):
+        if not self.filters or \
+                self.filters[-1].count >= self.filters[-1].capacity:
+            n = len(self.filters)
+            self.filters.append(BloomFilter(
+                    self.capacity * self.GROWTH ** n,
+                    self.error_rate * (1 - self.TIGHTENING) *
+                    self.TIGHTENING ** n))
+        return self.filters[-1]
+
+    def add(self, key):
+        if any(key in f for f in self.filters[:-1]):
+            return True
+        return self._current().add(key)
+
+    def __contains__(self, key):
+        return any(key in f for f in self.filters)
+
+
+class WindowedBloomFilter(object):
+    """Remembers keys for at least window seconds (and at most twice
+       that) so memory doesn't grow forever. Thread-safe.
+    """
+    def __init__(self, window, error_rate=0.001, capacity=100000):
+        self.window = window
+        self.capacity = capacity
+        # Two generations are checked, so split the error budget.
+        self.error_rate = error_rate / 2
+        self.lock = threading.Lock()
+        self.previous = None
+        self.current = ScalableBloomFilter(capacity, self.error_rate)
+        self.started = time.time()
+
+    def _rotate(self):
+        now = time.time()
+        if now - self.started >= self.window:
+            self.previous = self.current
+            self.current = ScalableBloomFilter(self.capacity,
+                                               self.error_rate)
+            self.started = now
+
+    def add(self, key):
+        """Returns True if key was (probably) seen within the window."""
+        with self.lock:
+            self._rotate()
+            if self.previous is not None and key in self.previous:
+                self.current.add(key)
+                return True
+            return self.current.add(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            self._rotate()
+            return key in self.current or (self.previous is not None and
+                                           key in self.previous)
+
+
+def configure(driver, conf):
+    """Turn on the configured deduplication, if any, for driver."""
+    window = conf.get_dedup_window()
+    if window:
+        driver.set_dedup(WindowedBloomFilter(window,
+                                             conf.get_dedup_error_rate()))
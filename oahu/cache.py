@@ -0,0 +1,80 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """A bounded {key: value} mapping that evicts the least
+       recently used entries first. Thread-safe.
+
+       By default max_size counts entries. Pass sizeof(value) to
+       bound something else, like bytes.
+    """
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value  # Now the most recent.
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                key, value = self.entries.popitem(last=False)
+                self.size -= self.sizeof(value)
+
+    def discard(self, key, value=None):
+        """Drop key, but only if it still maps to value (if given)."""
+        with self.lock:
+            if key in self.entries and (value is None or
+                                        self.entries[key] == value):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def _remove(self, key):
+        if key in self.entries:
+            self.size -= self.sizeof(self.entries.pop(key))
+
+    def __len__(self):
+        return len(self.entries)
@@ -16,7 +16,9 @@
 """Pipeline - periodic pipeline processing for StackTach.v3
 
 Usage:
-  pipeline (trigger|ready|completed) <config_simport> [--daemon] [--polling_rate=<rate>]
+  pipeline (trigger|ready|completed) <config_simport> [--daemon] [--polling_rate=<rate>] [--partitioned] [--heartbeat_timeout=<secs>]
+  pipeline init-db <config_simport>
+  pipeline replay <config_simport> <files>... [--batch_size=<n>] [--processes=<n>] [--check_interval=<secs>]
   pipeline (-h | --help)
   pipeline --version
 
@@ -26,39 +28,83 @@ Options:
   --debug                Debug mode
   --daemon               Run as daemon
   --polling_rate=<rate>  Rate in seconds [default: 300]
+  --partitioned          Split the streams with the other workers doing
+                         the same job (consistent hashing on stream_id)
+  --heartbeat_timeout=<secs>  Seconds before a silent worker's share is
+                         given away. Defaults to 3 x the polling rate.
+  --batch_size=<n>       Events per write when replaying [default: 1000]
+  --processes=<n>        Decoding processes. Defaults to one per CPU.
+  --check_interval=<secs>  Event time between trigger checks when
+                         replaying [default: 60]
   <config_simport>       Config class location in Simport format
+  <files>                JSON lines notification archives, maybe gzipped
 
 """
 import datetime
+import os
+import socket
 import time
+import uuid
 
 import daemon
 from docopt import docopt
 
+from oahu import bloom
 from oahu import config
-from oahu import mongodb_driver as driver
+from oahu import distill
+from oahu import partition
 from oahu import pipeline
+from oahu import replay
 from oahu import stream
 
 
-def run(poll, trigger, ready, completed, conf):
+def get_partitioner(db_driver, group, heartbeat_timeout):
+    worker_id = "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                              str(uuid.uuid4())[:8])
+    print "Partitioned worker:", worker_id
+    membership = db_driver.get_membership(group, worker_id, heartbeat_timeout)
+    return partition.Partitioner(membership)
+
+
+def run(poll, trigger, ready, completed, conf, partitioned=False,
+        heartbeat_timeout=None):
     print "Polling rate:", poll
 
     db_driver = conf.get_driver()
     p = pipeline.Pipeline(db_driver)
 
-    while True:
-        now = datetime.datetime.utcnow()
-        if trigger:
-            p.do_trigger_check(conf.get_trigger_chunk_size(), now)
-            db_driver.dump_debuggers(trait_match=False, errors=False)
-        if ready:
-            p.process_ready_streams(conf.get_ready_chunk_size(), now)
-            db_driver.dump_debuggers(criteria_match=False, trait_match=False)
-        if completed:
-            p.purge_streams(conf.get_completed_chunk_size())
-
-        time.sleep(poll)
+    partitioner = None
+    if partitioned:
+        group = "trigger" if trigger else "ready" if ready else "completed"
+        partitioner = get_partitioner(db_driver, group,
+                                      heartbeat_timeout or poll * 3)
+        db_driver.set_partitioner(partitioner)
+
+    try:
+        while True:
+            now = datetime.datetime.utcnow()
+            if trigger:
+                p.do_trigger_check(conf.get_trigger_chunk_size(), now)
+                db_driver.dump_debuggers(trait_match=False, errors=False)
+            if ready:
+                p.process_ready_streams(conf.get_ready_chunk_size(), now)
+                db_driver.dump_debuggers(criteria_match=False,
+                                         trait_match=False)
+            if completed:
+                p.purge_streams(conf.get_completed_chunk_size())
+                db_driver.dump_debuggers(trait_match=False,
+                                         criteria_match=False,
+                                         errors=False, purged=True)
+
+            if ready:
+                # Wake up as soon as something is READY. The polling
+                # rate is only a fallback sweep now.
+                db_driver.wait_for_ready(poll)
+            else:
+                time.sleep(poll)
+    finally:
+        if partitioner:
+            partitioner.leave()  # Hand our share over right away.
 
 
 def main():
@@ -67,16 +113,38 @@ def main():
     driver_location = arguments['<config_simport>']
     conf = config.get_config(driver_location)
 
+    if arguments['init-db']:
+        conf.get_driver().init_db()
+        return
+
+    if arguments['replay']:
+        db_driver = conf.get_driver()
+        distill.configure(db_driver, conf)
+        bloom.configure(db_driver, conf)
+        processes = arguments['--processes']
+        replay.replay(pipeline.Pipeline(db_driver), arguments['<files>'],
+                      batch_size=int(arguments['--batch_size']),
+                      processes=int(processes) if processes else None,
+                      check_interval=float(arguments['--check_interval']),
+                      chunk=conf.get_trigger_chunk_size())
+        return
+
     trigger = arguments["trigger"]
     ready = arguments["ready"]
     completed = arguments["completed"]
     poll = float(arguments['--polling_rate'])
+    partitioned = arguments['--partitioned']
+    heartbeat_timeout = None
+    if arguments['--heartbeat_timeout']:
+        heartbeat_timeout = float(arguments['--heartbeat_timeout'])
 
     if arguments['--daemon']:
         with daemon.DaemonContext():
-            run(poll, trigger, ready, completed, conf)
+            run(poll, trigger, ready, completed, conf, partitioned,
+                heartbeat_timeout)
     else:
-        run(poll, trigger, ready, completed, conf)
+        run(poll, trigger, ready, completed, conf, partitioned,
+            heartbeat_timeout)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact storage encoding for event bodies.
+
+A codec spec is "<serializer>+<compression>", ie: "msgpack+zlib",
+"json+lz4" or "json". msgpack and lz4 are optional, json and zlib
+are always available.
+
+Every blob starts with a two byte header naming its serializer and
+compression, so decode() reads anything ever written no matter
+what the current spec is.
+"""
+
+import datetime
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+
+# Stored at the top level of the event document (and so indexable)
+# with everything else in the compressed body.
+INDEXED = ['_unique_id', 'event_type', 'timestamp', '_context_request_id',
+           'audit_bucket']
+
+_DATETIME = '__datetime__'
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {_DATETIME: [obj.year, obj.month, obj.day, obj.hour,
+                            obj.minute, obj.second, obj.microsecond]}
+    raise TypeError("Can't encode %r" % obj)
+
+
+def _object_hook(obj):
+    if _DATETIME in obj:
+        return datetime.datetime(*obj[_DATETIME])
+    return obj
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, default=_default, separators=(',', ':'))
+
+
+def _json_loads(data):
+    return json.loads(data, object_hook=_object_hook)
+
+
+def _msgpack_dumps(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, object_hook=_object_hook, raw=False)
+
+
+# {name: (header byte, dumps, loads)}
+SERIALIZERS = {'json': ('j', _json_dumps, _json_loads),
+               'msgpack': ('m', _msgpack_dumps, _msgpack_loads)}
+
+# {name: (header byte, compress(data, level), decompress)}
+COMPRESSORS = {'none': ('n', lambda data, level: data, lambda data: data),
+               'zlib': ('z', zlib.compress, zlib.decompress),
+               'lz4': ('l', lambda data, level: lz4.compress(data),
+                       lambda data: lz4.decompress(data))}
+
+_AVAILABLE = {'msgpack': msgpack, 'lz4': lz4}
+
+
+class Codec(object):
+    def __init__(self, spec, level=6):
+        self.spec = spec
+        serializer, _, compression = spec.partition('+')
+        compression = compression or 'none'
+        for name, table in [(serializer, SERIALIZERS),
+                            (compression, COMPRESSORS)]:
+            if name not in table:
+                raise ValueError("Unknown codec: %s" % name)
+            if _AVAILABLE.get(name, True) is None:
+                raise ValueError("%s isn't installed" % name)
+        s_tag, self.dumps, _ = SERIALIZERS[serializer]
+        c_tag, self.compress, _ = COMPRESSORS[compression]
+        self.header = s_tag + c_tag
+        self.level = level
+
+    def encode(self, obj):
+        return self.header + self.compress(self.dumps(obj), self.level)
+
+    def split(self, event):
+        """Returns ({indexed fields}, blob of the rest)."""
+        fields = {}
+        body = {}
+        for key, value in event.iteritems():
+            if key in INDEXED:
+                fields[key] = value
+            else:
+                body[key] = value
+        return fields, self.encode(body)
+
+
+_LOADS = dict((tag, loads) for tag, dumps, loads in SERIALIZERS.values())
+_DECOMPRESS = dict((tag, decompress)
+                   for tag, compress, decompress in COMPRESSORS.values())
+
+
+def decode(blob):
+    blob = str(blob)
+    return _LOADS[blob[0]](_DECOMPRESS[blob[1]](blob[2:]))
+
+
+class LazyEvent(dict):
+    """An event whose compressed body is only decoded once
+       something outside the indexed fields is looked at.
+
+       dict(event) takes a C shortcut that skips all this and
+       only sees what's already decoded. Use event.copy().
+    """
+    def __init__(self, fields, blob):
+        super(LazyEvent, self).__init__(fields)
+        self._blob = blob
+
+    def _load(self):
+        if self._blob is not None:
+            blob, self._blob = self._blob, None
+            dict.update(self, decode(blob))
+
+    def __missing__(self, key):
+        if self._blob is None:
+            raise KeyError(key)
+        self._load()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self._load()
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self._load()
+        return dict.__contains__(self, key)
+
+    has_key = __contains__
+
+
+def _loaded(name):
+    method = getattr(dict, name)
+
+    def wrapper(self, *args, **kwargs):
+        self._load()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+
+# Anything that looks at the whole event needs the body first.
+for _name in ['__iter__', '__len__', '__repr__', '__eq__', '__ne__',
+              'keys', 'values', 'items', 'iterkeys', 'itervalues',
+              'iteritems', 'copy', 'pop', 'popitem', 'update',
+              'setdefault']:
+    setattr(LazyEvent, _name, _loaded(_name))
@@ -27,8 +27,32 @@ class Config(object):
 
     @abc.abstractmethod
     def get_distiller_config(self):
+        """{trait: path} to store distilled events, or None to
+           store them whole. See distill.py
+        """
         pass
 
+    def get_dedup_window(self):
+        """Seconds that event message_ids are remembered to drop
+           redeliveries. None turns deduplication off.
+        """
+        return 3600
+
+    def get_dedup_error_rate(self):
+        """Bloom filter false positive rate. Each false positive
+           costs a storage lookup.
+        """
+        return 0.001
+
+    def get_keep_raw_events(self):
+        """With a distiller configured, still keep the full
+           notifications in cold storage? (MongoDBDriver only)
+        """
+        return False
+
+    def get_trigger_chunk_size(self):
+        return -1
+
     def get_ready_chunk_size(self):
         return -1
 
@@ -38,6 +62,96 @@ class Config(object):
     def get_completed_chunk_size(self):
         return -1
 
+    def get_purge_batch_size(self):
+        """Processed streams deleted per round trip."""
+        return 500
+
+    def get_purge_rate(self):
+        """Max processed streams purged per second, None is
+           unlimited. Keeps a big purge from starving ingest.
+        """
+        return None
+
+    # MongoDBDriver connection settings. The MongoClient (and its
+    # connection pool) is shared by every driver in the process
+    # that uses the same settings.
+    def get_mongo_uri(self):
+        return "mongodb://localhost:27017"
+
+    def get_mongo_database(self):
+        return "stacktach"
+
+    def get_mongo_pool_size(self):
+        return 100
+
+    def get_mongo_write_concern(self):
+        """Default write concern, ie: {'w': 'majority', 'j': True}"""
+        return {}
+
+    def get_mongo_write_concerns(self):
+        """Write concern per class of operation, overriding the
+           default above:
+             'ingest' - event, stream row and last_update writes.
+                        With dedup on (see get_dedup_window) event
+                        inserts are acknowledged even with w=0, that
+                        is how redelivered events are detected.
+                        With dedup off w=0 is honored, and
+                        redeliveries are appended to streams again.
+             'state'  - stream creation and state changes. These
+                        are compare-and-swaps, so never w=0.
+             'purge'  - deleting processed streams.
+        """
+        return {}
+
+    def get_mongo_read_preference(self):
+        """Read preference mode name, ie: 'secondaryPreferred'.
+           None uses the driver default (primary).
+        """
+        return None
+
+    def get_mongo_timeouts(self):
+        """Per-collection query timeouts in milliseconds, ie:
+           {'events': 5000, 'trigger_defs': 30000}
+        """
+        return {}
+
+    def get_mongo_stream_cache_size(self):
+        """Number of open (COLLECTING) stream ids each process
+           remembers by trigger and identifying traits, so bursts
+           of events for one stream skip the lookup. 0 disables.
+        """
+        return 10000
+
+    def get_mongo_event_cache_size(self):
+        """Bytes of event documents each process keeps around for
+           loading streams. An event usually belongs to a stream of
+           every trigger, so this saves refetching it. 0 disables.
+        """
+        return 64 * 1024 * 1024
+
+    def get_mongo_event_codec(self):
+        """Store event bodies compressed, ie: "msgpack+zlib" or
+           "json+lz4" (see codec.py). Only the fields in
+           codec.INDEXED stay queryable. None stores plain BSON.
+        """
+        return None
+
+    def get_mongo_event_layout(self):
+        """'single' - one events collection.
+           'daily'  - one events_YYYYMMDD collection per day, taken
+                      from the event's audit_bucket or timestamp,
+                      so retention is a cheap collection drop.
+        """
+        return "single"
+
+    def get_mongo_event_retention(self):
+        """Days of events to keep, None keeps everything.
+           With the 'single' layout this is a TTL index on
+           'timestamp' (which must be a datetime). With 'daily'
+           the purger drops the expired collections.
+        """
+        return None
+
 
 def get_config(driver_location):
     config_class = simport.load(driver_location)
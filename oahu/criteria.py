@@ -18,31 +18,85 @@ import datetime
 
 import dateutil.parser
 
+import debugging
+
+
+# Relative evaluation costs. compile_criteria() orders siblings
+# so the cheap checks run (and fail) first.
+COST_EVENT = 0   # Looks at the last event only.
+COST_TIME = 1    # Date arithmetic on the stream.
+COST_LOAD = 2    # May have to load the stream's events.
+
+
+class Pushdown(object):
+    """A periodic check that can be done by the storage layer
+       without loading the stream into Python. Streams match if
+       last_update < last_update_before (when set). If never is
+       True, no stream can match.
+    """
+    def __init__(self, last_update_before=None, never=False):
+        self.last_update_before = last_update_before
+        self.never = never
+
+    def merge(self, other):
+        """AND this pushdown with another one."""
+        cutoffs = [p.last_update_before for p in [self, other]
+                   if p.last_update_before is not None]
+        return Pushdown(last_update_before=min(cutoffs) if cutoffs else None,
+                        never=self.never or other.never)
+
+    def union(self, other):
+        """OR this pushdown with another one."""
+        if self.never:
+            return other
+        if other.never:
+            return self
+        if None in [self.last_update_before, other.last_update_before]:
+            return Pushdown()
+        return Pushdown(last_update_before=max(self.last_update_before,
+                                               other.last_update_before))
+
 
 class Criteria(object):
     __metaclass__ = abc.ABCMeta
 
+    cost = COST_LOAD
+
     @abc.abstractmethod
     def should_fire(self, stream, last_event, now=None):
         return False
 
+    def get_pushdown(self, now):
+        """Return a Pushdown equivalent to should_fire() during a
+           periodic check (where there is no last_event), or None
+           if this criteria has to be evaluated in Python.
+        """
+        return None
+
 
 class Inactive(Criteria):
+    cost = COST_TIME
+
     def __init__(self, expiry_in_seconds):
         super(Inactive, self).__init__()
         self.expiry_in_seconds = expiry_in_seconds
 
     def should_fire(self, stream, last_event, debugger, now=None):
-        secs = (now - stream.last_update).seconds
-        #print "Stream %s = %d seconds (%d)" % (stream.uuid, secs, self.expiry_in_seconds)
         if now is None:
             now = datetime.datetime.utcnow()
         return debugger.check(
-            (now - stream.last_update).seconds > self.expiry_in_seconds,
+            (now - stream.last_update).total_seconds() >
+                self.expiry_in_seconds,
             "no timeout")
 
+    def get_pushdown(self, now):
+        expiry = datetime.timedelta(seconds=self.expiry_in_seconds)
+        return Pushdown(last_update_before=now - expiry)
+
 
 class EventType(Criteria):
+    cost = COST_EVENT
+
     def __init__(self, event_type):
         super(EventType, self).__init__()
         self.event_type = event_type
@@ -53,19 +107,86 @@ class EventType(Criteria):
         return debugger.check(last_event['event_type'] == self.event_type,
                               "wrong event type")
 
+    def get_pushdown(self, now):
+        # Periodic checks have no last event, so this never fires.
+        return Pushdown(never=True)
+
 
 class And(Criteria):
     def __init__(self, criteria_list):
         super(And, self).__init__()
         self.criteria_list = criteria_list
 
+    @property
+    def cost(self):
+        return max([c.cost for c in self.criteria_list] or [COST_EVENT])
+
     def should_fire(self, stream, last_event, debugger, now=None):
-        should = [c.should_fire(stream, last_event, debugger, now)
-                                        for c in self.criteria_list]
-        return debugger.check(all(should), "AND failed")
+        # Stop at the first failure and blame it for the mismatch.
+        collector = debugging.ReasonCollector()
+        for c in self.criteria_list:
+            if not c.should_fire(stream, last_event, collector, now):
+                return debugger.criteria_mismatch(collector.last_reason())
+        return debugger.criteria_match()
+
+    def get_pushdown(self, now):
+        result = Pushdown()
+        for c in self.criteria_list:
+            pushdown = c.get_pushdown(now)
+            if pushdown is None:
+                return None
+            result = result.merge(pushdown)
+        return result
+
+
+class Or(Criteria):
+    def __init__(self, criteria_list):
+        super(Or, self).__init__()
+        self.criteria_list = criteria_list
+
+    @property
+    def cost(self):
+        return max([c.cost for c in self.criteria_list] or [COST_EVENT])
+
+    def should_fire(self, stream, last_event, debugger, now=None):
+        # Stop at the first match. If nothing matched, every
+        # child contributed to the mismatch.
+        collector = debugging.ReasonCollector()
+        for c in self.criteria_list:
+            if c.should_fire(stream, last_event, collector, now):
+                return debugger.criteria_match()
+        return debugger.criteria_mismatch(
+                        "OR failed (%s)" % ", ".join(collector.reasons))
+
+    def get_pushdown(self, now):
+        result = Pushdown(never=True)
+        for c in self.criteria_list:
+            pushdown = c.get_pushdown(now)
+            if pushdown is None:
+                return None
+            result = result.union(pushdown)
+        return result
+
+
+class Not(Criteria):
+    def __init__(self, criteria):
+        super(Not, self).__init__()
+        self.criteria = criteria
+
+    @property
+    def cost(self):
+        return self.criteria.cost
+
+    def should_fire(self, stream, last_event, debugger, now=None):
+        collector = debugging.ReasonCollector()
+        return debugger.check(
+            not self.criteria.should_fire(stream, last_event, collector, now),
+            "NOT failed")
 
 
 class EndOfDayExists(Criteria):
+    cost = COST_LOAD
+
     def __init__(self, exists_name):
         super(EndOfDayExists, self).__init__()
         self.exists_name = exists_name
@@ -95,3 +216,33 @@ class EndOfDayExists(Criteria):
         return debugger.check(self._is_zero_hour(audit_start) and
                               self._is_zero_hour(audit_end),
                               "time != 00:00:00.0 ")
+
+
+def compile_criteria(criteria):
+    """Returns an equivalent criteria tree that is cheaper to
+       evaluate: nested And/Or nodes are flattened into their
+       parent, double negation is removed and siblings are
+       ordered cheapest first so short-circuiting skips the
+       expensive checks whenever possible.
+    """
+    if isinstance(criteria, Not):
+        inner = compile_criteria(criteria.criteria)
+        if isinstance(inner, Not):
+            return inner.criteria
+        return Not(inner)
+
+    for kind in [And, Or]:
+        if isinstance(criteria, kind):
+            children = []
+            for child in criteria.criteria_list:
+                child = compile_criteria(child)
+                if isinstance(child, kind):
+                    children.extend(child.criteria_list)
+                else:
+                    children.append(child)
+            if len(children) == 1:
+                return children[0]
+            # sorted() is stable, so equal cost keeps the user's order.
+            return kind(sorted(children, key=lambda c: c.cost))
+
+    return criteria
@@ -15,6 +15,7 @@
 
 import abc
 import datetime
+import threading
 
 import debugging
 import stream as pstream
@@ -29,6 +30,92 @@ class CursorState(object):
         self.offset = 0
 
 
+class TransitionBuffer(object):
+    """Stream state changes waiting to be flushed. Changes are
+       grouped by a driver-defined key so that each group can be
+       applied in a single round trip.
+    """
+    def __init__(self):
+        self.groups = {}  # {key: [(trigger_name, stream), ...]}
+
+    def add(self, key, trigger_name, stream):
+        self.groups.setdefault(key, []).append((trigger_name, stream))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.groups.values())
+
+
+# Stored stream fields that find_streams() can project.
+STREAM_FIELDS = ['stream_id', 'trigger_name', 'state', 'last_update',
+                 'identifying_traits']
+
+
+class StreamQuery(object):
+    """The arguments to find_streams()/count_streams():
+         stream_id, state, trigger_name - exact matches.
+         traits - {trait: value}, streams whose identifying
+                  traits include all of these. Indexed per trait,
+                  so this works across triggers.
+         older_than, younger_than - last_update bounds (exclusive).
+         fields - return just these STREAM_FIELDS instead of
+                  the to_dict() summary. Much cheaper.
+         details - include the events (to_dict() only).
+         limit - max number of results.
+         after - (last_update, stream_id) of the last result of
+                 the previous page.
+       Results are ordered by (last_update, stream_id) whenever
+       limit or after is given, so pages never overlap.
+    """
+    def __init__(self, stream_id=None, state=None, trigger_name=None,
+                 traits=None, older_than=None, younger_than=None,
+                 fields=None, details=False, limit=None, after=None):
+        self.stream_id = stream_id
+        self.traits = traits
+        self.state = state
+        self.trigger_name = trigger_name
+        self.older_than = older_than
+        self.younger_than = younger_than
+        self.details = details
+        self.limit = limit
+        self.after = after
+
+        self.fields = fields
+        if fields:
+            unknown = set(fields) - set(STREAM_FIELDS)
+            if unknown:
+                raise ValueError("Unknown stream fields: %s" %
+                                 ", ".join(sorted(unknown)))
+
+    @property
+    def ordered(self):
+        return bool(self.limit or self.after)
+
+    def matches(self, stream_id, trigger_name, state, last_update,
+                identifying_traits):
+        if self.stream_id and stream_id != self.stream_id:
+            return False
+        if self.traits:
+            for trait, value in self.traits.iteritems():
+                if trait not in identifying_traits or \
+                                    identifying_traits[trait] != value:
+                    return False
+        if self.state and state != self.state:
+            return False
+        if self.trigger_name and trigger_name != self.trigger_name:
+            return False
+        if self.older_than and not last_update < self.older_than:
+            return False
+        if self.younger_than and not last_update > self.younger_than:
+            return False
+        if self.after and not (last_update, stream_id) > tuple(self.after):
+            return False
+        return True
+
+    def project(self, values):
+        """values is {field: value} for all the STREAM_FIELDS."""
+        return dict((field, values[field]) for field in self.fields)
+
+
 class DBDriver(object):
     __metaclass__ = abc.ABCMeta
 
@@ -41,6 +128,29 @@ class DBDriver(object):
         for trigger in trigger_defs:
             self.trigger_defs_dict[trigger.name] = trigger
 
+        # Not None while state changes are being buffered.
+        self.transitions = None
+
+        # Set when several workers split the streams between them.
+        self.partitioner = None
+
+        # Set to store distilled events only, see distill.py.
+        self.distiller = None
+        self.keep_raw = False
+
+        # Set to drop redelivered events, see set_dedup().
+        self.dedup = None
+        self.duplicates = 0
+        self.dedup_false_positives = 0
+        self.bad_events = 0  # Dropped by add_events(), no _unique_id.
+        self.stats_lock = threading.Lock()
+
+        # Stamps last_update on ingest. See set_clock().
+        self.clock = datetime.datetime.utcnow
+
+        # Set whenever a stream in this process becomes READY.
+        self.ready_event = threading.Event()
+
     def _get_debugger(self, trigger_name):
         debugger = self.trigger_debuggers.get(trigger_name)
         if not debugger:
@@ -54,18 +164,138 @@ class DBDriver(object):
         return debugger
 
     def dump_debuggers(self, trait_match=True, criteria_match=True,
-                       errors=True):
+                       errors=True, purged=False):
         for debugger in self.trigger_debuggers.values():
             debugging.dump_debugger(debugger,
                                     trait_match=trait_match,
                                     criteria_match=criteria_match,
-                                    errors=errors)
+                                    errors=errors, purged=purged)
 
     def add_event(self, event):
-        message_id = self._get_message_id(event)
-        self.save_event(message_id, event)
+        self._get_message_id(event)  # Raises BadEvent.
+        self.add_events([event])
+
+    def add_events(self, events):
+        """Add a batch of events. The events are stored with one
+           save_events() call before any of them is added to a stream.
+           Only once the whole batch is in its streams are the events
+           marked as appended, so a redelivered event that was stored
+           but never (or only partly) appended gets appended again,
+           skipping the streams that already have it.
+
+           Events without a _unique_id are dropped and counted in
+           bad_events, rather than failing the rest of the batch.
+        """
+        batch = []
+        for event in events:
+            try:
+                batch.append((self._get_message_id(event), event))
+            except BadEvent:
+                self._count(bad=1)
+        batch, retries = self._drop_duplicates(batch)
+        batch = self._distill(batch)
+        duplicates = self.save_events(batch)
+        if duplicates:
+            # Got past the dedup filter, but storage caught them.
+            appended = self._appended([(message_id, event)
+                                       for message_id, event in batch
+                                       if message_id in duplicates])
+            self._count(duplicates=len(appended))
+            retries.update(duplicates - appended)
+            batch = [(message_id, event) for message_id, event in batch
+                     if message_id not in appended]
+        for message_id, event in batch:
+            self._append_to_streams(message_id, event,
+                                    retry=message_id in retries)
+        self._mark_appended(batch)
+
+    def _count(self, duplicates=0, false_positives=0, bad=0):
+        with self.stats_lock:
+            self.duplicates += duplicates
+            self.dedup_false_positives += false_positives
+            self.bad_events += bad
+
+    def _drop_duplicates(self, batch):
+        """Returns the batch without the events already appended,
+           and the set of message_ids that were stored but may not
+           be in all their streams yet.
+        """
+        if not self.dedup:
+            return batch, set()
+        unique = []
+        maybe = []
+        seen = set()
+        for message_id, event in batch:
+            if message_id in seen:
+                self._count(duplicates=1)
+                continue
+            seen.add(message_id)
+            unique.append((message_id, event))
+            if self.dedup.add(message_id):
+                maybe.append((message_id, event))
+        if not maybe:
+            return unique, set()
+
+        stored = self._stored(maybe)
+        appended = self._appended([(message_id, event)
+                                   for message_id, event in maybe
+                                   if message_id in stored])
+        self._count(duplicates=len(appended),
+                    false_positives=len(maybe) - len(stored))
+        return ([(message_id, event) for message_id, event in unique
+                 if message_id not in appended],
+                stored - appended)
+
+    def _stored(self, events):
+        """The message_ids of the (message_id, event) tuples that
+           are already stored.
+        """
+        raise NotImplementedError()
+
+    def _appended(self, events):
+        """The message_ids of the stored (message_id, event) tuples
+           that made it into all their streams. See _mark_appended().
+        """
+        raise NotImplementedError()
 
+    def _mark_appended(self, events):
+        """Record that these (message_id, event) tuples are in all
+           their streams.
+        """
+        raise NotImplementedError()
+
+    def _in_streams(self, trigger, trait_dict, message_id):
+        """True if message_id is already in a stream of this trigger
+           with these identifying traits.
+        """
+        raise NotImplementedError()
+
+    def _distill(self, batch):
+        if not self.distiller:
+            return batch
+        if self.keep_raw:
+            self.save_raw_events(batch)
+        return [(message_id, self.distiller.distill(event))
+                for message_id, event in batch]
+
+    def save_raw_events(self, events):
+        """Keep the undistilled (message_id, event) tuples somewhere
+           cold. Only needed for set_distiller(keep_raw=True).
+        """
+        raise NotImplementedError()
+
+    def save_events(self, events):
+        """events is a list of (message_id, event) tuples. Override
+           if the driver can store many events in one operation.
+           May return the set of message_ids that turned out to be
+           stored already.
+        """
+        for message_id, event in events:
+            self.save_event(message_id, event)
+
+    def _append_to_streams(self, message_id, event, retry=False):
         # An event may apply to many streams ...
+        # With retry, the event may be in some of them already.
         for trigger in self.trigger_defs:
             debugger = self._get_debugger(trigger.name)
             if not trigger.applies(event):
@@ -74,9 +304,94 @@ class DBDriver(object):
             debugger.trait_match()
 
             trait_dict = trigger.get_identifying_trait_dict(event)
+            if retry and self._in_streams(trigger, trait_dict, message_id):
+                continue
             if self.append_event(message_id, trigger, event, trait_dict):
                 debugger.new_stream()
 
+    def init_db(self):
+        """One-time creation of whatever the backing store needs
+           (collections, indexes, ...). Run by 'pipeline init-db'
+           rather than on every worker start.
+        """
+        pass
+
+    def set_partitioner(self, partitioner):
+        """Only look at the streams this worker owns. See partition.py
+        """
+        self.partitioner = partitioner
+
+    def set_dedup(self, dedup):
+        """Drop events whose message_id is already stored, ie: after
+           a redelivery. dedup is a bloom.WindowedBloomFilter or
+           anything with add(message_id) returning True if it may
+           have been seen. Only those are checked against storage.
+        """
+        self.dedup = dedup
+
+    def set_distiller(self, distiller, keep_raw=False):
+        """Only store and process the distilled events. The full
+           events go to save_raw_events() if keep_raw.
+        """
+        self.distiller = distiller
+        self.keep_raw = keep_raw
+
+    def set_clock(self, clock):
+        """clock() returns the time new events are stamped with.
+           A replay sets it to event time so the inactivity
+           criteria see the original gaps between events.
+        """
+        self.clock = clock
+
+    def get_membership(self, group, worker_id, timeout):
+        """Returns a partition.Membership backed by this driver's store.
+        """
+        raise NotImplementedError("%s does not support partitioning" %
+                                  self.__class__.__name__)
+
+    def begin_transitions(self):
+        """Buffer stream state changes until flush_transitions()
+           is called. Drivers that talk to a remote store use this
+           to turn one update per stream into one update per state.
+        """
+        if self.transitions is None:
+            self.transitions = TransitionBuffer()
+
+    def flush_transitions(self):
+        """Apply all the buffered state changes.
+
+           Returns a list of (trigger_name, stream) tuples for the
+           changes that were not applied because another worker
+           changed the stream first.
+        """
+        transitions, self.transitions = self.transitions, None
+        if not transitions:
+            return []
+        failed = self._flush_transitions(transitions)
+        for trigger_name, stream in failed:
+            self._get_debugger(trigger_name).state_conflict()
+        return failed
+
+    def _flush_transitions(self, transitions):
+        """Derived classes that buffer state changes must override
+           this and return the failed (trigger_name, stream) tuples.
+        """
+        return []
+
+    def wait_for_ready(self, timeout):
+        """Block until a stream may have become READY, or for at most
+           timeout seconds. Returns True if we were woken up early.
+
+           The default only hears about streams made READY in this
+           process. Drivers with a shared store can do better.
+        """
+        woken = self.ready_event.wait(timeout)
+        self.ready_event.clear()
+        return woken
+
+    def _notify_ready(self):
+        self.ready_event.set()
+
     def get_cursor_state(self):
         """Returns an opaque state object that can store limit and offset
            information for purse/process and ready checks.
@@ -137,12 +452,28 @@ class DBDriver(object):
     def get_num_active_streams(self, trigger_name):
         pass
 
-    @abc.abstractmethod
     def find_streams(self, **kwargs):
+        """Iterates over the matching streams. See StreamQuery
+           for the arguments.
+        """
+        return self._find_streams(StreamQuery(**kwargs))
+
+    def count_streams(self, **kwargs):
+        """Number of streams find_streams() would return, without
+           fetching them.
+        """
+        return self._count_streams(StreamQuery(**kwargs))
+
+    def get_stream(self, stream_id, details=False, fields=None):
+        return list(self.find_streams(stream_id=stream_id,
+                                      details=details, fields=fields))
+
+    @abc.abstractmethod
+    def _find_streams(self, query):
         pass
 
     @abc.abstractmethod
-    def get_stream(self, stream_id):
+    def _count_streams(self, query):
         pass
 
     @abc.abstractmethod
@@ -171,6 +502,11 @@ class DBDriver(object):
             return True
         return False
 
+    def _cap_reached(self, trigger, stream, cap):
+        # A stream hit one of the trigger's caps, fire it now.
+        self._get_debugger(trigger.name).cap_hit(cap)
+        self.ready(trigger.name, stream)
+
     def _do_pipeline_callbacks(self, stream, trigger):
         debugger = self._get_debugger(trigger.name)
         scratchpad = {}
@@ -21,6 +21,11 @@ class SimpleDumper(object):
             debugger._trait_match,
             debugger._trait_match+debugger._trait_mismatch,
             debugger._new_streams)
+        if debugger._cap_hits:
+            print "%s: streams capped - %s" % (
+                debugger._name,
+                ", ".join("%s = %d" % hit
+                          for hit in sorted(debugger._cap_hits.items())))
 
     def dump_criteria_match(self, debugger):
         print "%s: %d of %d criteria match" % (
@@ -29,10 +34,15 @@ class SimpleDumper(object):
             debugger._criteria_match+debugger._criteria_mismatch)
 
     def dump_errors(self, debugger):
-        print "%s: %d on_trigger() errors, %d commit() errors" % (
+        print "%s: %d on_trigger() errors, %d commit() errors, " \
+              "%d state conflicts" % (
             debugger._name,
             debugger._trigger_errors,
-            debugger._commit_errors)
+            debugger._commit_errors,
+            debugger._state_conflicts)
+
+    def dump_purged(self, debugger):
+        print "%s: %d streams purged" % (debugger._name, debugger._purged)
 
 
 class DetailedDumper(SimpleDumper):
@@ -45,13 +55,16 @@ class DetailedDumper(SimpleDumper):
         # TODO(sandy): Should add provisions for exception counts.
 
 
-def dump_debugger(debugger, trait_match, criteria_match, errors):
+def dump_debugger(debugger, trait_match, criteria_match, errors,
+                  purged=False):
     if trait_match:
         debugger.dump_trait_match()
     if criteria_match:
         debugger.dump_criteria_match()
     if errors:
         debugger.dump_errors()
+    if purged:
+        debugger.dump_purged()
     debugger.reset()
 
 
@@ -68,6 +81,9 @@ class NoOpTriggerDebugger(object):
     def dump_errors(self):
         pass
 
+    def dump_purged(self):
+        pass
+
     def reset(self):
         pass
 
@@ -80,7 +96,7 @@ class NoOpTriggerDebugger(object):
     def new_stream(self):
         pass
 
-    def criteria_match(self):
+    def criteria_match(self, count=1):
         return True
 
     def criteria_mismatch(self, reason):
@@ -95,6 +111,38 @@ class NoOpTriggerDebugger(object):
     def commit_error(self):
         return False
 
+    def state_conflict(self):
+        return False
+
+    def purged(self, count=1):
+        pass
+
+    def cap_hit(self, cap):
+        pass
+
+
+class ReasonCollector(NoOpTriggerDebugger):
+    """Remembers mismatch reasons without counting them. Composite
+       criteria evaluate their children against one of these and
+       then decide what to report to the real debugger.
+    """
+    def __init__(self):
+        self.reasons = []
+
+    def criteria_mismatch(self, reason):
+        self.reasons.append(reason)
+        return False
+
+    def check(self, value, reason):
+        if value:
+            return True
+        return self.criteria_mismatch(reason)
+
+    def last_reason(self):
+        if self.reasons:
+            return self.reasons[-1]
+        return "unknown"
+
 
 class TriggerDebugger(object):
     def __init__(self, name, dumper=None):
@@ -114,6 +162,9 @@ class TriggerDebugger(object):
     def dump_errors(self):
         self.dumper.dump_errors(self)
 
+    def dump_purged(self):
+        self.dumper.dump_purged(self)
+
     def reset(self):
         # If it's not a match or a mismatch it was a fatal error.
         self._trait_mismatch = 0
@@ -126,6 +177,9 @@ class TriggerDebugger(object):
 
         self._trigger_errors = 0
         self._commit_errors = 0
+        self._state_conflicts = 0
+        self._purged = 0
+        self._cap_hits = {}  # { cap name: streams forced READY }
 
     def trait_match(self):
         self._trait_match += 1
@@ -138,8 +192,8 @@ class TriggerDebugger(object):
     def new_stream(self):
         self._new_streams += 1
 
-    def criteria_match(self):
-        self._criteria_match += 1
+    def criteria_match(self, count=1):
+        self._criteria_match += count
         return True
 
     def criteria_mismatch(self, reason):
@@ -159,3 +213,13 @@ class TriggerDebugger(object):
     def commit_error(self):
         self._commit_errors += 1
         return False
+
+    def state_conflict(self):
+        self._state_conflicts += 1
+        return False
+
+    def purged(self, count=1):
+        self._purged += count
+
+    def cap_hit(self, cap):
+        self._cap_hits[cap] = self._cap_hits.get(cap, 0) + 1
@@ -0,0 +1,76 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cut notifications down to the traits the pipeline needs before
+they're stored. The config maps each trait to where it's found:
+
+    {'instance_id': 'payload/instance_id',
+     'tenant_id': ['payload/tenant_id', '_context_project_id'],
+     'payload/audit_period_beginning': 'payload/audit_period_beginning'}
+
+Paths are / separated, as for identifying traits. With a list the
+first path present wins. Trait names can be paths too, so mapping a
+path to itself keeps it where trigger definitions and criteria
+expect it. Traits missing from the event are left out.
+"""
+
+
+# Always kept, the pipeline itself relies on these.
+REQUIRED = ['_unique_id', 'event_type', 'timestamp', 'audit_bucket']
+
+
+class Distiller(object):
+    def __init__(self, traits):
+        wanted = dict((name, name) for name in REQUIRED)
+        wanted.update(traits)
+        # [(trait path parts, [source path parts, ...]), ...]
+        self.traits = []
+        for name, paths in sorted(wanted.items()):
+            if isinstance(paths, basestring):
+                paths = [paths]
+            self.traits.append((name.split('/'),
+                                [path.split('/') for path in paths]))
+
+    def distill(self, event):
+        result = {}
+        for trait, sources in self.traits:
+            for source in sources:
+                try:
+                    value = _fetch(source, event)
+                except (KeyError, TypeError):
+                    continue
+                _place(trait, result, value)
+                break
+        return result
+
+
+def _fetch(parts, event):
+    for name in parts:
+        event = event[name]
+    return event
+
+
+def _place(parts, result, value):
+    for name in parts[:-1]:
+        result = result.setdefault(name, {})
+    result[parts[-1]] = value
+
+
+def configure(driver, conf):
+    """Hook the configured Distiller, if any, into the driver."""
+    traits = conf.get_distiller_config()
+    if traits:
+        driver.set_distiller(Distiller(traits),
+                             keep_raw=conf.get_keep_raw_events())
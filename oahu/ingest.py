@@ -0,0 +1,159 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import Queue
+import threading
+
+
+class IngestQueue(object):
+    """Decouples consuming events from persisting them.
+
+       put() hands a batch to a bounded queue and blocks while
+       the queue is full, which is the backpressure on the consumer.
+       A pool of writer threads drains the queue, merging up to
+       batch_size events per add_events() call. Each batch carries
+       an opaque token (the messages to ack, say). Once the write
+       has returned the tokens come back through completed() with
+       a success flag, so the caller only acks what is durable.
+       A failed merged write is retried batch by batch, so only
+       the batches that fail on their own are reported as failed.
+    """
+    def __init__(self, pipeline, writers=1, max_depth=100,
+                 batch_size=500):
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.pending = Queue.Queue(max_depth)
+        self.done = Queue.Queue()
+        self.running = True
+
+        # Metrics, updated by the writers under stats_lock.
+        self.stats_lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.lag = datetime.timedelta(0)  # Oldest batch in the last write.
+        self.max_lag = datetime.timedelta(0)
+
+        self.threads = []
+        for num in range(writers):
+            thread = threading.Thread(target=self._write_forever,
+                                      name="oahu-writer-%d" % num)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, events, token=None, timeout=None):
+        """Queue a batch. With a timeout, returns False if the queue
+           stayed full that long, so the caller can deal with
+           completed() batches before trying again.
+        """
+        try:
+            self.pending.put((events, token, datetime.datetime.utcnow()),
+                             timeout=timeout)
+        except Queue.Full:
+            return False
+        return True
+
+    def depth(self):
+        return self.pending.qsize()
+
+    def completed(self, timeout=None):
+        """Return [(token, ok), ...] for the batches finished so far.
+           With a timeout, waits up to that long for the first one.
+        """
+        results = []
+        if timeout:
+            try:
+                results.append(self.done.get(timeout=timeout))
+            except Queue.Empty:
+                return results
+        while True:
+            try:
+                results.append(self.done.get_nowait())
+            except Queue.Empty:
+                return results
+
+    def stop(self, timeout=None):
+        """Write whatever is queued, then stop the writers."""
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def reset_max_lag(self):
+        with self.stats_lock:
+            max_lag, self.max_lag = self.max_lag, datetime.timedelta(0)
+        return max_lag
+
+    def _take(self):
+        try:
+            first = self.pending.get(timeout=0.5)
+        except Queue.Empty:
+            return []
+        batches = [first]
+        size = len(first[0])
+        while size < self.batch_size:
+            try:
+                batch = self.pending.get_nowait()
+            except Queue.Empty:
+                break
+            batches.append(batch)
+            size += len(batch[0])
+        return batches
+
+    def _write_forever(self):
+        while self.running or not self.pending.empty():
+            batches = self._take()
+            if not batches:
+                continue
+
+            results = self._write(batches)
+
+            now = datetime.datetime.utcnow()
+            with self.stats_lock:
+                self.lag = now - min(queued for _, _, queued in batches)
+                self.max_lag = max(self.max_lag, self.lag)
+                for (batch_events, _, _), ok in zip(batches, results):
+                    if ok:
+                        self.written += len(batch_events)
+                    else:
+                        self.failed += len(batch_events)
+            for (_, token, _), ok in zip(batches, results):
+                self.done.put((token, ok))
+
+    def _write(self, batches):
+        """Write the merged batches, returns an ok flag per batch.
+           If the merged write fails the batches are retried one
+           at a time, so one bad delivery doesn't fail the rest.
+        """
+        events = []
+        for batch_events, token, queued in batches:
+            events.extend(batch_events)
+        try:
+            self.pipeline.add_events(events)
+            return [True] * len(batches)
+        except Exception as ex:
+            print "Write of %d events failed: %s" % (len(events), ex)
+        if len(batches) == 1:
+            return [False]
+
+        results = []
+        for batch_events, token, queued in batches:
+            try:
+                self.pipeline.add_events(batch_events)
+                results.append(True)
+            except Exception as ex:
+                print "Write of %d events failed: %s" % (len(batch_events),
+                                                         ex)
+                results.append(False)
+        return results
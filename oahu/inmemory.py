@@ -13,27 +13,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import calendar
 import datetime
+import itertools
+import threading
 import uuid
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import db_driver
+import reducers
 import stream as pstream
 
 
 class LocalStream(pstream.Stream):
     def __init__(self, uuid, trigger_name, state, last_update,
-                 identifying_traits, inmemory_stream):
+                 identifying_traits, inmemory_stream, driver):
         super(LocalStream, self).__init__(uuid, trigger_name,
                                           state, last_update,
                                           identifying_traits)
         self.inmemory_stream = inmemory_stream
+        self.driver = driver
+        self.aggregates = dict(inmemory_stream.aggregates)
+
+    @property
+    def sid(self):
+        return self.uuid
 
     def load_events(self):
-        self.events = self.inmemory_stream.messages
+        if self.events is None:
+            with self.inmemory_stream.shard.lock:
+                messages = list(self.inmemory_stream.messages)
+            self.events = self.driver._get_events(messages)
 
 
 class InMemoryStream(object):
-    def __init__(self, trigger_name, identifying_traits, event):
+    def __init__(self, trigger_name, identifying_traits, shard):
         self.trigger_name = trigger_name
         self.sid = str(uuid.uuid4())
         self.messages = []
@@ -42,135 +61,538 @@ class InMemoryStream(object):
         self.last_error = None
         self.commit_errors = 0
         self.events = None
+        self.identifying_traits = identifying_traits  # { trait: value }
+        self.trait_key = pstream.trait_key(identifying_traits)
+        self.shard = shard
+        self.aggregates = {}
+        self.created = self.last_update
+        self.num_bytes = 0  # Only counted for triggers with max_bytes.
+
 
-        # Don't do this if we're creating from an existing stream ...
-        self._extract_identifying_traits(identifying_traits, event)
+def _epoch(when):
+    return calendar.timegm(when.utctimetuple()) + when.microsecond / 1e6
 
-    def _extract_identifying_traits(self, it, event):
-        self.identifying_traits = {}  # { trait: value }
-        for name in it:
-            self.identifying_traits[name] = event[name]
 
-    def do_identifying_traits_match(self, event):
-        for name, value in self.identifying_traits.iteritems():
-            if event.get(name) != self.identifying_traits[name]:
-                return False
-        return True
+FREE = 0  # State of an unused slot.
+
+
+class Slots(object):
+    """The last_update (as epoch seconds) and state of one trigger's
+       streams in flat arrays, so the periodic check can scan them
+       in bulk instead of doing datetime math per stream. Uses numpy
+       over the same buffers when it's installed. Slots of removed
+       streams are reused.
+    """
+    def __init__(self):
+        self.epochs = array.array('d')
+        self.states = array.array('b')
+        self.streams = []
+        self.free = []
+
+    def add(self, stream):
+        if self.free:
+            slot = self.free.pop()
+            self.streams[slot] = stream
+        else:
+            slot = len(self.streams)
+            self.streams.append(stream)
+            self.epochs.append(0.0)
+            self.states.append(FREE)
+        stream.slot = slot
+        self.update(stream)
+
+    def remove(self, stream):
+        self.states[stream.slot] = FREE
+        self.streams[stream.slot] = None
+        self.free.append(stream.slot)
+
+    def update(self, stream):
+        self.epochs[stream.slot] = _epoch(stream.last_update)
+        self.states[stream.slot] = stream.state
+
+    def collecting_before(self, when):
+        """The COLLECTING streams with last_update < when."""
+        cutoff = _epoch(when)
+        if numpy:
+            epochs = numpy.frombuffer(self.epochs, dtype=numpy.float64)
+            states = numpy.frombuffer(self.states, dtype=numpy.int8)
+            hits = numpy.flatnonzero((epochs < cutoff) &
+                                     (states == pstream.COLLECTING))
+        else:
+            hits = [slot for slot, (epoch, state) in
+                    enumerate(itertools.izip(self.epochs, self.states))
+                    if epoch < cutoff and state == pstream.COLLECTING]
+        return [self.streams[slot] for slot in hits]
+
+    def collecting(self):
+        return [self.streams[slot] for slot, state in enumerate(self.states)
+                if state == pstream.COLLECTING]
+
+
+class Shard(object):
+    """A slice of the streams with its own lock. Streams are placed
+       by hashing the trigger name and trait key, so all the events
+       for one stream always land in the same shard.
+    """
+    def __init__(self):
+        # Reentrant, since a state change can happen while the
+        # shard is locked for a trigger check.
+        self.lock = threading.RLock()
+
+        # { trigger_name: { stream_id: InMemoryStream } }
+        self.active_streams = {}
+
+        # { (trigger_name, trait_key): InMemoryStream }
+        # Only streams that are still COLLECTING.
+        self.collecting = {}
+
+        # { (trigger_name, state): { stream_id: InMemoryStream } }
+        self.by_state = {}
+
+        # { (trait, value): { stream_id: InMemoryStream } }
+        # Across all triggers.
+        self.by_trait = {}
+
+        # { trigger_name: Slots }
+        self.slots = {}
+
+    def add(self, stream):
+        streams = self.active_streams.setdefault(stream.trigger_name, {})
+        streams[stream.sid] = stream
+        self.collecting[(stream.trigger_name, stream.trait_key)] = stream
+        self._index_state(stream)
+        for pair in stream.trait_key:
+            self.by_trait.setdefault(pair, {})[stream.sid] = stream
+        self.slots.setdefault(stream.trigger_name, Slots()).add(stream)
+
+    def remove(self, stream):
+        del self.active_streams[stream.trigger_name][stream.sid]
+        self._stop_collecting(stream)
+        self._unindex_state(stream)
+        for pair in stream.trait_key:
+            streams = self.by_trait.get(pair)
+            if streams:
+                streams.pop(stream.sid, None)
+                if not streams:
+                    del self.by_trait[pair]
+        self.slots[stream.trigger_name].remove(stream)
+
+    def set_state(self, stream, state):
+        if state != pstream.COLLECTING:
+            self._stop_collecting(stream)
+        self._unindex_state(stream)
+        stream.state = state
+        self._index_state(stream)
+        self.slots[stream.trigger_name].update(stream)
+
+    def touch(self, stream, when):
+        stream.last_update = when
+        self.slots[stream.trigger_name].update(stream)
+
+    def collecting_before(self, trigger_name, when):
+        slots = self.slots.get(trigger_name)
+        if slots is None:
+            return []
+        if when is None:
+            return slots.collecting()
+        return slots.collecting_before(when)
+
+    def in_state(self, trigger_name, state):
+        return self.by_state.get((trigger_name, state), {}).values()
+
+    def candidates(self, query):
+        """The streams a StreamQuery could match, from the
+           narrowest index available.
+        """
+        if query.trigger_name:
+            triggers = [query.trigger_name]
+        else:
+            triggers = self.active_streams.keys()
+        if query.stream_id:
+            return [streams[query.stream_id]
+                    for streams in (self.active_streams.get(t, {})
+                                    for t in triggers)
+                    if query.stream_id in streams]
+        if query.traits:
+            # The rarest trait value, query.matches() checks the rest.
+            return min((self.by_trait.get(pair, {}).values()
+                        for pair in pstream.trait_key(query.traits)),
+                       key=len)
+        if query.state:
+            return [s for t in triggers
+                      for s in self.in_state(t, query.state)]
+        return [s for t in triggers
+                  for s in self.active_streams.get(t, {}).values()]
+
+    def _index_state(self, stream):
+        key = (stream.trigger_name, stream.state)
+        self.by_state.setdefault(key, {})[stream.sid] = stream
+
+    def _unindex_state(self, stream):
+        streams = self.by_state.get((stream.trigger_name, stream.state))
+        if streams:
+            streams.pop(stream.sid, None)
+
+    def _stop_collecting(self, stream):
+        key = (stream.trigger_name, stream.trait_key)
+        if self.collecting.get(key) is stream:
+            del self.collecting[key]
 
 
 class InMemoryDriver(db_driver.DBDriver):
     """All the pipeline operations that need to be externalized
        to support concurrent processing.
+
+       Thread-safe. Streams are spread over num_shards shards, each
+       with its own lock, so ingest threads and the periodic
+       trigger/ready/purge passes only contend on the same shard.
+
+       With a journal.Journal the state survives restarts: it is
+       restored at startup and every change is logged, with periodic
+       snapshots from do_trigger_check().
     """
 
+    def __init__(self, trigger_defs, num_shards=1, journal=None):
+        super(InMemoryDriver, self).__init__(trigger_defs)
+        self.num_shards = num_shards
+        self.events_lock = threading.Lock()
+        self.journal = journal
+        self._reset()
+        if journal:
+            journal.restore(self._replay)
+
     def save_event(self, mid, event):
-        self.raw_events[mid] = event
+        with self.events_lock:
+            self.raw_events[mid] = event
+            if self.journal:
+                self.journal.log(('event', mid, event))
+
+    def _stored(self, events):
+        with self.events_lock:
+            return set(mid for mid, event in events
+                       if mid in self.raw_events)
+
+    def _appended(self, events):
+        with self.events_lock:
+            return set(mid for mid, event in events
+                       if mid in self.appended)
+
+    def _mark_appended(self, events):
+        with self.events_lock:
+            self.appended.update(mid for mid, event in events)
+
+    def _in_streams(self, trigger, trait_dict, message_id):
+        key = pstream.trait_key(trait_dict)
+        shard = self._get_shard(trigger.name, key)
+        query = db_driver.StreamQuery(trigger_name=trigger.name,
+                                      traits=trait_dict)
+        with shard.lock:
+            return any(stream.trigger_name == trigger.name and
+                       stream.trait_key == key and
+                       message_id in stream.messages
+                       for stream in shard.candidates(query))
 
     def append_event(self, message_id, trigger, event, trait_dict):
-        stream = None
-        streams = self.active_streams.get(trigger.name, {})
-        for sid, s in streams.iteritems():
-            if s.do_identifying_traits_match(event):
-                stream = s
-                break
-
-        is_new_stream = False
-        if not stream:
-            stream = self._create_stream(trigger.name,
-                                         trigger.get_identifying_trait_names(),
-                                         event)
-            is_new_stream = True
-
-        stream.messages.append(message_id)
-        now = datetime.datetime.utcnow()
-        stream.last_update = now
-        self._check_for_trigger(trigger, stream, event=event, now=now)
+        key = pstream.trait_key(trait_dict)
+        shard = self._get_shard(trigger.name, key)
+        with shard.lock:
+            now = self.clock()
+            size = trigger.event_size(event)
+            stream = shard.collecting.get((trigger.name, key))
+            if stream and trigger.capped and trigger.rollover:
+                cap = self._cap_hit(trigger, stream, now, size)
+                if cap:
+                    self._cap_reached(trigger, stream, cap)
+                    stream = None
+            is_new_stream = False
+            if not stream:
+                stream = InMemoryStream(trigger.name, trait_dict, shard)
+                stream.created = now
+                shard.add(stream)
+                is_new_stream = True
+
+            cap = None
+            if trigger.capped and not trigger.rollover:
+                cap = self._cap_hit(trigger, stream, now, size)
+            stream.messages.append(message_id)
+            stream.num_bytes += size
+            reducers.update(trigger.reducers, stream.aggregates, event)
+            shard.touch(stream, now)
+            if self.journal:
+                self.journal.log(('append', trigger.name, stream.sid,
+                                  trait_dict, message_id, now))
+            if cap:
+                self._cap_reached(trigger, stream, cap)
+            else:
+                self._check_for_trigger(trigger, stream, event=event,
+                                        now=now)
         return is_new_stream
 
+    def _cap_hit(self, trigger, stream, now, size):
+        return trigger.cap_hit(len(stream.messages), stream.num_bytes,
+                               stream.created, now, size)
+
     def do_trigger_check(self, state, chunk, now=None):
-        for trigger in self.trigger_defs:
-            for sid, stream in self.active_streams[trigger.name].iteritems():
-                self._check_for_trigger(trigger, stream, now=now)
+        if self.journal and self.journal.due():
+            self.snapshot()
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        # Triggers with a pushdown are checked a whole shard at a
+        # time against the slot arrays. Only the rest go through
+        # should_fire() one stream at a time.
+        for shard in self.shards:
+            with shard.lock:
+                for trigger in self.trigger_defs:
+                    pushdown = trigger.get_pushdown(now)
+                    if pushdown is None:
+                        streams = shard.active_streams.get(trigger.name, {})
+                        for stream in streams.values():
+                            self._check_for_trigger(trigger, stream, now=now)
+                    elif not pushdown.never:
+                        self._pushdown_trigger_check(shard, trigger,
+                                                     pushdown)
+
+    def _pushdown_trigger_check(self, shard, trigger, pushdown):
+        # Called with the shard locked.
+        streams = shard.collecting_before(trigger.name,
+                                          pushdown.last_update_before)
+        self._get_debugger(trigger.name).criteria_match(len(streams))
+        for stream in streams:
+            self.ready(trigger.name, stream)
 
     def purge_processed_streams(self, state, chunk):
-        togo = []
-        for rid, stream_map in self.active_streams.iteritems():
-            for sid, stream in stream_map.iteritems():
-                if stream.state == pstream.PROCESSED:
-                    togo.append((rid, sid))
-
-        for rid, sid in togo:
-            del self.active_streams[rid][sid]
+        for shard in self.shards:
+            with shard.lock:
+                for trigger_name in shard.active_streams.keys():
+                    for stream in shard.in_state(trigger_name,
+                                                 pstream.PROCESSED):
+                        shard.remove(stream)
+                        self._get_debugger(trigger_name).purged()
+                        if self.journal:
+                            self.journal.log(('purge', trigger_name,
+                                              stream.sid))
 
     def process_ready_streams(self, state, chunk, now):
         for trigger in self.trigger_defs:
-            for s in self._get_ready_streams(trigger.name):
+            for s in self._claim_ready_streams(trigger.name):
                 stream = LocalStream(s.sid, s.trigger_name, s.state,
                                      s.last_update,
-                                     s.identifying_traits, s)
-                stream.set_events(self._get_events(s.messages))
+                                     s.identifying_traits, s, self)
+                if trigger.needs_events:
+                    stream.load_events()
                 self._do_pipeline_callbacks(stream, trigger)
 
     def ready(self, trigger_name, stream):
-        self._change_stream_state(trigger_name, stream.sid, pstream.READY)
+        self._change_stream_state(stream, pstream.READY)
 
     def trigger(self, trigger_name, stream):
-        self._change_stream_state(trigger_name, stream.sid, pstream.TRIGGERED)
+        self._change_stream_state(stream, pstream.TRIGGERED)
 
     def processed(self, trigger_name, stream):
-        self._change_stream_state(trigger_name, stream.sid, pstream.PROCESSED)
+        self._change_stream_state(stream, pstream.PROCESSED)
 
     def error(self, trigger_name, stream, error):
-        self._change_stream_state(trigger_name, stream.sid, pstream.ERROR)
-        self.active_streams[trigger_name][stream.sid].last_error = error
+        self._change_stream_state(stream, pstream.ERROR, error)
 
     def commit_error(self, trigger_name, stream, error):
-        self._change_stream_state(trigger_name, stream.sid,
-                                  pstream.COMMIT_ERROR)
-        s = self.active_streams[trigger_name][stream.sid]
-        s.last_error = error
-        s.commit_errors += 1
+        self._change_stream_state(stream, pstream.COMMIT_ERROR, error,
+                                  commit_error=True)
 
     def get_num_active_streams(self, trigger_name):
-        return len(self.active_streams.get(trigger_name, {}))
-
-    def find_streams(self, **kwargs):
-        return []  # TODO(sandy): need this for tox tests.
-
-    def get_stream(self, stream_id, details):
-        for trigger in self.trigger_defs:
-            for s in self._get_ready_streams(trigger.name):
-                if s.sid == stream_id:
-                    result = LocalStream(s.sid, s.trigger_name, s.state,
-                                  s.last_update, s.identifying_traits, s)
-                    if details:
-                        result.load_events()
-                    return result.to_dict()
+        total = 0
+        for shard in self.shards:
+            with shard.lock:
+                total += len(shard.active_streams.get(trigger_name, {}))
+        return total
+
+    def _find_streams(self, query):
+        # Copy the matches out under the shard locks, then sort and
+        # page outside of them.
+        found = []
+        for shard in self.shards:
+            with shard.lock:
+                for s in shard.candidates(query):
+                    if query.matches(s.sid, s.trigger_name, s.state,
+                                     s.last_update, s.identifying_traits):
+                        found.append((s.last_update, s.sid, s,
+                                      s.state, s.identifying_traits))
+        if query.ordered:
+            found.sort(key=lambda x: x[:2])
+        if query.limit:
+            found = found[:query.limit]
+
+        for last_update, sid, s, state, traits in found:
+            if query.fields:
+                yield query.project({'stream_id': sid,
+                                     'trigger_name': s.trigger_name,
+                                     'state': state,
+                                     'last_update': last_update,
+                                     'identifying_traits': traits})
+                continue
+            result = LocalStream(sid, s.trigger_name, state, last_update,
+                                 traits, s, self)
+            if query.details:
+                result.load_events()
+            yield result.to_dict()
+
+    def _count_streams(self, query):
+        total = 0
+        for shard in self.shards:
+            with shard.lock:
+                total += sum(1 for s in shard.candidates(query)
+                             if query.matches(s.sid, s.trigger_name,
+                                              s.state, s.last_update,
+                                              s.identifying_traits))
+        if query.limit:
+            total = min(total, query.limit)
+        return total
 
     def flush_all(self):
-        # { trigger_name: { stream_id: InMemoryStream } }
-        self.active_streams = {}
+        self._reset()
+        if self.journal:
+            self.journal.reset()
+
+    def snapshot(self):
+        """Write a snapshot of all streams and events to the journal.
+
+           Ingest is only blocked while the WAL is rotated and the
+           state is copied (references only, not the events
+           themselves). The snapshot is written after that.
+        """
+        locks = [shard.lock for shard in self.shards] + [self.events_lock]
+        for lock in locks:
+            lock.acquire()
+        try:
+            first_wal_seq = self.journal.rotate()
+            events = self._snapshot_events()
+            streams = [('stream', s.trigger_name, s.sid, s.state,
+                        s.last_update, s.identifying_traits,
+                        list(s.messages), s.last_error, s.commit_errors)
+                       for shard in self.shards
+                       for stream_map in shard.active_streams.values()
+                       for s in stream_map.values()]
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        records = itertools.chain((('event', mid, event)
+                                   for mid, event in events), streams)
+        self.journal.write_snapshot(first_wal_seq, records)
+
+    def _snapshot_events(self):
+        # Called with everything locked. Drivers that keep events
+        # somewhere else return an empty list.
+        return self.raw_events.items()
+
+    def _reset(self):
+        self.shards = [Shard() for x in range(self.num_shards)]
 
         # Obviously keeping all these in memory is very
         # expensive. Only suitable for tiny tests.
         self.raw_events = {}  # { message_id: event_dict }
 
+        # The message_ids in all their streams. Not journaled, after
+        # a restart redelivered events are checked stream by stream.
+        self.appended = set()
+
+    def _replay(self, record):
+        # Apply a journal record, without logging it again.
+        kind = record[0]
+        if kind == 'event':
+            mid, event = record[1:]
+            self.raw_events[mid] = event
+        elif kind == 'stream':
+            (trigger_name, sid, state, last_update, traits, messages,
+             last_error, commit_errors) = record[1:]
+            stream = self._restore_stream(trigger_name, sid, traits)
+            stream.messages = messages
+            self._replay_aggregates(stream, messages)
+            stream.shard.touch(stream, last_update)
+            stream.created = last_update  # Close enough, for max_age.
+            stream.last_error = last_error
+            stream.commit_errors = commit_errors
+            stream.shard.set_state(stream, state)
+        elif kind == 'append':
+            trigger_name, sid, traits, mid, last_update = record[1:]
+            stream = self._find_stream(trigger_name, sid)
+            if not stream:
+                stream = self._restore_stream(trigger_name, sid, traits)
+                stream.created = last_update
+            stream.messages.append(mid)
+            self._replay_aggregates(stream, [mid])
+            stream.shard.touch(stream, last_update)
+        elif kind == 'state':
+            trigger_name, sid, state, last_error, commit_errors = record[1:]
+            stream = self._find_stream(trigger_name, sid)
+            if stream:
+                stream.shard.set_state(stream, state)
+                stream.last_error = last_error
+                stream.commit_errors = commit_errors
+        elif kind == 'purge':
+            trigger_name, sid = record[1:]
+            stream = self._find_stream(trigger_name, sid)
+            if stream:
+                stream.shard.remove(stream)
+
+    def _replay_aggregates(self, stream, message_ids):
+        # Aggregates aren't journaled, they're rebuilt from the events.
+        trigger = self.trigger_defs_dict.get(stream.trigger_name)
+        if trigger and trigger.reducers:
+            for event in self._get_events(message_ids):
+                reducers.update(trigger.reducers, stream.aggregates, event)
+
+    def _restore_stream(self, trigger_name, sid, traits):
+        key = pstream.trait_key(traits)
+        shard = self._get_shard(trigger_name, key)
+        stream = InMemoryStream(trigger_name, traits, shard)
+        stream.sid = sid
+        shard.add(stream)
+        return stream
+
+    def _find_stream(self, trigger_name, sid):
+        for shard in self.shards:
+            stream = shard.active_streams.get(trigger_name, {}).get(sid)
+            if stream:
+                return stream
+        return None
+
+    def _get_shard(self, trigger_name, trait_key):
+        return self.shards[hash((trigger_name, trait_key)) % self.num_shards]
+
     def _get_events(self, message_ids):
         return [self.raw_events[mid] for mid in message_ids]
 
-    def _get_ready_streams(self, trigger_name):
+    def _claim_ready_streams(self, trigger_name):
+        # Move the READY streams to TRIGGERED while holding the shard
+        # lock so concurrent ready passes never process a stream twice.
+        # The callbacks themselves run without any lock held.
         streams = []
-        for sid, stream in self.active_streams[trigger_name].iteritems():
-            if stream.state == pstream.READY:
-                streams.append(stream)
+        for shard in self.shards:
+            with shard.lock:
+                for stream in shard.in_state(trigger_name, pstream.READY):
+                    shard.set_state(stream, pstream.TRIGGERED)
+                    self._log_state(stream)
+                    streams.append(stream)
         return streams
 
-    def _create_stream(self, trigger_name, identifying_trait_names, event):
-        stream = InMemoryStream(trigger_name, identifying_trait_names, event)
-        streams = self.active_streams.get(trigger_name, {})
-        streams[stream.sid] = stream
-        self.active_streams[trigger_name] = streams
-        return stream
-
-    def _change_stream_state(self, trigger_name, stream_id, new_state):
-        self.active_streams[trigger_name][stream_id].state = new_state
+    def _change_stream_state(self, stream, new_state, error=None,
+                             commit_error=False):
+        # We may be handed the InMemoryStream or a LocalStream wrapper.
+        s = getattr(stream, 'inmemory_stream', stream)
+        with s.shard.lock:
+            s.shard.set_state(s, new_state)
+            if error is not None:
+                s.last_error = error
+            if commit_error:
+                s.commit_errors += 1
+            self._log_state(s)
+        if new_state == pstream.READY:
+            self._notify_ready()
+        return s
+
+    def _log_state(self, stream):
+        if self.journal:
+            self.journal.log(('state', stream.trigger_name, stream.sid,
+                              stream.state, stream.last_error,
+                              stream.commit_errors))
@@ -0,0 +1,198 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Snapshots and a write-ahead log for the in-memory driver.
+
+Both files are a plain sequence of marshal'ed records, written and
+read one record at a time so neither side ever holds the whole file
+in memory. marshal doesn't know about datetimes, so they are stored
+as tagged tuples (events decoded from JSON never contain tuples).
+Timezone-aware datetimes are converted to UTC and come back naive.
+
+  <dir>/snapshot      ('oahu-snapshot', version, first_wal_seq)
+                      followed by 'event' and 'stream' records.
+  <dir>/wal.<seq>     'event', 'append', 'state' and 'purge' records
+                      written since the snapshot was started.
+
+Restore loads the snapshot, then replays every WAL file from
+first_wal_seq on.
+"""
+
+import datetime
+import marshal
+import os
+import threading
+import time
+
+import dateutil.tz
+
+
+SNAPSHOT_VERSION = 1
+MARSHAL_VERSION = 2
+
+_DATETIME = '__datetime__'
+
+
+def encode(obj):
+    """Make obj marshal-safe."""
+    if isinstance(obj, dict):
+        return dict((k, encode(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [encode(v) for v in obj]
+    if isinstance(obj, datetime.datetime):
+        if obj.tzinfo is not None:
+            obj = obj.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+        return (_DATETIME, obj.year, obj.month, obj.day, obj.hour,
+                obj.minute, obj.second, obj.microsecond)
+    if isinstance(obj, tuple):
+        return tuple(encode(v) for v in obj)
+    return obj
+
+
+def decode(obj):
+    if isinstance(obj, dict):
+        return dict((k, decode(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [decode(v) for v in obj]
+    if isinstance(obj, tuple):
+        if obj and obj[0] == _DATETIME:
+            return datetime.datetime(*obj[1:])
+        return tuple(decode(v) for v in obj)
+    return obj
+
+
+def write_record(f, record):
+    # Encoded up front, so a record marshal can't handle raises
+    # before anything is written instead of tearing the file.
+    f.write(marshal.dumps(encode(record), MARSHAL_VERSION))
+
+
+def read_records(f):
+    """Yields records until the end of the file. A torn record at
+       the tail (a crash mid-write) ends the file.
+    """
+    while True:
+        try:
+            record = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            return
+        yield decode(record)
+
+
+class Journal(object):
+    def __init__(self, directory, snapshot_interval=300):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval  # seconds
+        self.lock = threading.Lock()
+        self.wal = None
+        self.wal_seq = 0
+        self.last_snapshot = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _wal_seqs(self):
+        return sorted(int(name.split('.')[1])
+                      for name in os.listdir(self.directory)
+                      if name.startswith('wal.'))
+
+    def _open_wal(self, seq):
+        if self.wal:
+            self.wal.close()
+        self.wal_seq = seq
+        self.wal = open(self._path('wal.%08d' % seq), 'ab')
+
+    def restore(self, apply):
+        """Feed every snapshot and WAL record to apply(record), in
+           order, then start a new WAL file.
+        """
+        first_seq = 0
+        path = self._path('snapshot')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                records = read_records(f)
+                header = next(records)
+                first_seq = header[2]
+                for record in records:
+                    apply(record)
+
+        seqs = [seq for seq in self._wal_seqs() if seq >= first_seq]
+        for seq in seqs:
+            with open(self._path('wal.%08d' % seq), 'rb') as f:
+                for record in read_records(f):
+                    apply(record)
+
+        self._open_wal(max(seqs + [first_seq]) + 1)
+
+    def log(self, record):
+        with self.lock:
+            write_record(self.wal, record)
+            self.wal.flush()
+
+    def sync(self):
+        """Force the WAL to disk."""
+        with self.lock:
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+
+    def rotate(self):
+        """Start a new WAL file and return its sequence number.
+           Everything logged before this call belongs in the
+           next snapshot.
+        """
+        with self.lock:
+            self._open_wal(self.wal_seq + 1)
+            return self.wal_seq
+
+    def due(self):
+        return time.time() - self.last_snapshot >= self.snapshot_interval
+
+    def write_snapshot(self, first_wal_seq, records):
+        """Stream records into a new snapshot, swap it in, then
+           drop the WAL files it covers.
+        """
+        tmp = self._path('snapshot.tmp')
+        with open(tmp, 'wb') as f:
+            write_record(f, ('oahu-snapshot', SNAPSHOT_VERSION,
+                             first_wal_seq))
+            for record in records:
+                write_record(f, record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._path('snapshot'))
+
+        for seq in self._wal_seqs():
+            if seq < first_wal_seq:
+                os.remove(self._path('wal.%08d' % seq))
+        self.last_snapshot = time.time()
+
+    def reset(self):
+        """Throw away everything on disk."""
+        with self.lock:
+            if self.wal:
+                self.wal.close()
+                self.wal = None
+            for name in os.listdir(self.directory):
+                if name.startswith('wal.') or name.startswith('snapshot'):
+                    os.remove(self._path(name))
+            self._open_wal(1)
+
+    def close(self):
+        with self.lock:
+            if self.wal:
+                self.wal.close()
+                self.wal = None
@@ -0,0 +1,287 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A DBDriver that needs no database.
+
+Raw events go into segmented, append-only files:
+
+  <dir>/events.<seq>   [header][message_id][marshal'ed event] ...
+
+The header is the body length and the message_id length, so the
+index of message_id -> (segment, offset, length) can be rebuilt at
+startup without decoding a single event. Events are read back through
+mmap when a stream is loaded.
+
+Streams live in memory (this is an InMemoryDriver) and are made
+durable with a journal.Journal in <dir>/streams.
+
+With sync (the default) the segment and the stream journal are
+fsync'ed at the end of every add_events() call, so acked events
+survive a power loss, not just a crash. Without it they are only
+flushed to the OS.
+
+Processed streams are purged as usual. A background compactor then
+snapshots the stream journal and rewrites sealed segments that are
+mostly garbage, keeping only the events a live stream still needs.
+It runs every compact_interval seconds, None turns it off.
+"""
+
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+
+import inmemory
+import journal
+
+
+HEADER = struct.Struct('>IH')  # body length, message_id length
+
+
+class Segment(object):
+    def __init__(self, path, seq):
+        self.path = path
+        self.seq = seq
+        self.file = open(path, 'a+b')
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self.map = None
+        self.sealed_at = None  # time.time() once no longer written to.
+
+    def append(self, message_id, body):
+        """Returns (offset, length) of the body."""
+        mid = message_id.encode('utf-8')
+        self.file.write(HEADER.pack(len(body), len(mid)))
+        self.file.write(mid)
+        offset = self.size + HEADER.size + len(mid)
+        self.file.write(body)
+        self.size = offset + len(body)
+        return offset, len(body)
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def read(self, offset, length):
+        if self.map is None or len(self.map) < offset + length:
+            # The active segment keeps growing, so remap as needed.
+            self.flush()
+            if self.map:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        return self.map[offset:offset + length]
+
+    def scan(self):
+        """Yields (message_id, offset, length) for every complete
+           record. A torn record at the tail is cut off.
+        """
+        self.file.seek(0)
+        position = 0
+        while True:
+            header = self.file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, mid_length = HEADER.unpack(header)
+            mid = self.file.read(mid_length)
+            offset = position + HEADER.size + mid_length
+            if len(mid) < mid_length or offset + length > self.size:
+                break
+            self.file.seek(length, os.SEEK_CUR)
+            yield mid.decode('utf-8'), offset, length
+            position = offset + length
+
+        if position < self.size:
+            self.file.truncate(position)
+            self.size = position
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self.map:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class LogFileDriver(inmemory.InMemoryDriver):
+    def __init__(self, trigger_defs, directory, num_shards=1,
+                 segment_size=64 * 1024 * 1024, snapshot_interval=300,
+                 compact_interval=600, compact_ratio=0.5, sync=True):
+        self.directory = directory
+        self.sync = sync
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio  # Rewrite if live < ratio.
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = {}  # { seq: Segment }
+        self.event_index = {}  # { message_id: (seq, offset, length) }
+        self._open_segments()
+
+        super(LogFileDriver, self).__init__(
+            trigger_defs, num_shards,
+            journal.Journal(os.path.join(directory, 'streams'),
+                            snapshot_interval))
+
+        if compact_interval:
+            compactor = threading.Thread(target=self._compact_forever,
+                                         args=(compact_interval,))
+            compactor.daemon = True
+            compactor.start()
+
+    def _stored(self, events):
+        with self.events_lock:
+            return set(mid for mid, event in events
+                       if mid in self.event_index)
+
+    def save_event(self, mid, event):
+        self.save_events([(mid, event)])
+
+    def save_events(self, events):
+        bodies = [(mid, marshal.dumps(journal.encode(event),
+                                      journal.MARSHAL_VERSION))
+                  for mid, event in events]
+        with self.events_lock:
+            for mid, body in bodies:
+                segment = self._active_segment()
+                offset, length = segment.append(mid, body)
+                self.event_index[mid] = (segment.seq, offset, length)
+            if self.sync:
+                self._active_segment().sync()
+            else:
+                self._active_segment().flush()
+
+    def add_events(self, events):
+        super(LogFileDriver, self).add_events(events)
+        if self.sync:
+            self.journal.sync()
+
+    def flush_all(self):
+        with self.events_lock:
+            for segment in self.segments.values():
+                segment.delete()
+            self.segments = {}
+            self.event_index = {}
+            self._new_segment(1)
+        super(LogFileDriver, self).flush_all()
+
+    def compact(self):
+        """Snapshot the stream journal, then rewrite the sealed
+           segments where less than compact_ratio of the bytes still
+           belong to a live stream.
+        """
+        self.snapshot()
+
+        live = set()
+        for shard in self.shards:
+            with shard.lock:
+                for streams in shard.active_streams.values():
+                    for stream in streams.values():
+                        live.update(stream.messages)
+
+        # Events only reach a stream after they are saved, so leave
+        # freshly sealed segments alone for a while.
+        grace = time.time() - 60
+        with self.events_lock:
+            sizes = {}
+            for mid, (seq, offset, length) in self.event_index.iteritems():
+                if mid in live:
+                    sizes[seq] = sizes.get(seq, 0) + length
+
+            for seq, segment in sorted(self.segments.items()):
+                if not segment.sealed_at or segment.sealed_at > grace:
+                    continue
+                if sizes.get(seq, 0) >= segment.size * self.compact_ratio:
+                    continue
+                self._rewrite_segment(segment, live)
+
+    def _compact_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.compact()
+            except Exception as e:
+                print "Compaction failed:", e
+
+    def _rewrite_segment(self, segment, live):
+        # Called with events_lock held.
+        for mid, offset, length in list(segment.scan()):
+            if mid in live and self.event_index.get(mid) == (segment.seq,
+                                                             offset, length):
+                body = segment.read(offset, length)
+                target = self._active_segment()
+                new_offset, new_length = target.append(mid, body)
+                self.event_index[mid] = (target.seq, new_offset, new_length)
+            elif self.event_index.get(mid, (None,))[0] == segment.seq:
+                del self.event_index[mid]
+                self.appended.discard(mid)
+        self._active_segment().flush()
+        # Everything we copied has to be on disk before the original
+        # goes away.
+        os.fsync(self._active_segment().file.fileno())
+        del self.segments[segment.seq]
+        segment.delete()
+
+    def _snapshot_events(self):
+        return []  # The segments are the events' snapshot.
+
+    def _get_events(self, message_ids):
+        events = []
+        with self.events_lock:
+            for mid in message_ids:
+                seq, offset, length = self.event_index[mid]
+                body = self.segments[seq].read(offset, length)
+                events.append(journal.decode(marshal.loads(body)))
+        return events
+
+    def _open_segments(self):
+        seqs = sorted(int(name.split('.')[1])
+                      for name in os.listdir(self.directory)
+                      if name.startswith('events.'))
+        for seq in seqs:
+            segment = Segment(self._segment_path(seq), seq)
+            for mid, offset, length in segment.scan():
+                self.event_index[mid] = (seq, offset, length)
+            segment.sealed_at = time.time()
+            self.segments[seq] = segment
+        self._new_segment(max(seqs + [0]) + 1)
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, 'events.%08d' % seq)
+
+    def _new_segment(self, seq):
+        self.active_seq = seq
+        self.segments[seq] = Segment(self._segment_path(seq), seq)
+
+    def _active_segment(self):
+        segment = self.segments[self.active_seq]
+        if segment.size >= self.segment_size:
+            if self.sync:
+                segment.sync()
+            else:
+                segment.flush()
+            segment.sealed_at = time.time()
+            self._new_segment(self.active_seq + 1)
+            segment = self.segments[self.active_seq]
+        return segment
@@ -16,36 +16,96 @@
 import copy
 import datetime
 import json
+import threading
+import time
 import uuid
 
+import bson
 import pymongo
 
+import cache
+import codec
+import config as pconfig
 import db_driver
+import partition
+import reducers
 import stream as pstream
 
 
 # Collections:
-# ["events"] = event docs
+# ["events"] = event docs, or ["events_YYYYMMDD"] per day with the
+#              'daily' layout. With an event codec the docs are just
+#              codec.INDEXED + {'message_id', 'body': compressed rest}.
+#              'appended' is set once the event is in all its
+#              streams, see DBDriver.add_events().
 #
 # ["trigger_defs"] = { 'trigger_name',
 #                      'stream_id',
 #                      'identifying_traits': {trait: value, ...},
+#                      'traits': [{'k': trait, 'v': value}, ...],  # indexed
 #                      'last_update',
 #                      'commit_errors',
 #                      'last_error',
 #                      'state',
+#                      'state_version',
+#                      'transition_id',  # last bulk state change
+#                      'partition',  # hash of stream_id, see partition.py
+#                      'aggregates': {name: value},  # see reducers.py
 #                    }
 #
-# ["streams'] = {'stream_id', 'message_id'}
+# ["streams'] = {'stream_id', 'message_id', 'when',
+#               'bucket'}  # day of the event, for the 'daily' layout
+#
+# ["raw_events"] = full notifications, when only distilled events
+#                  are used (see distill.py) but we still want these.
+#
+# ["ready_events"] = capped, {'when', 'count'} - a wake-up call for
+#                    ready workers, inserted when streams become READY.
+
+
+# MongoClient keeps its own connection pool and is thread-safe, so
+# every driver in the process with the same settings shares one.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(uri, pool_size, write_concern, read_preference):
+    key = (uri, pool_size, tuple(sorted(write_concern.items())),
+           read_preference)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            kwargs = dict(write_concern, maxPoolSize=pool_size)
+            if read_preference:
+                kwargs['readPreference'] = read_preference
+            client = pymongo.MongoClient(uri, **kwargs)
+            _clients[key] = client
+        return client
+
+
+class _DefaultConfig(pconfig.Config):
+    """Connection settings used when no Config is supplied."""
+    def get_driver(self):
+        return None
+
+    def get_distiller_config(self):
+        return None
+
+
+# What append_event() needs back from a capped stream's update.
+CAP_FIELDS = ['stream_id', 'trigger_name', 'state', 'last_update',
+              'identifying_traits', 'state_version', 'created',
+              'num_events', 'num_bytes']
 
 
 class Stream(pstream.Stream):
     def __init__(self, uuid, trigger_name, state, last_update,
-                 identifying_traits, driver):
+                 identifying_traits, driver, state_version=1):
         super(Stream, self).__init__(uuid, trigger_name, state, last_update,
                                      identifying_traits)
         self.driver = driver
         self.events_loaded = False
+        self.state_version = state_version
 
     def load_events(self):
         if self.events_loaded:
@@ -65,26 +125,171 @@ class MongoDBDriver(db_driver.DBDriver):
        For testing only. Do not attempt to use in production.
     """
 
-    def __init__(self, trigger_defs):
+    def __init__(self, trigger_defs, conf=None):
         super(MongoDBDriver, self).__init__(trigger_defs)
-        self.client = pymongo.MongoClient()
-        self.db = self.client['stacktach']
+        if conf is None:
+            conf = _DefaultConfig()
+        self.client = get_client(conf.get_mongo_uri(),
+                                 conf.get_mongo_pool_size(),
+                                 conf.get_mongo_write_concern(),
+                                 conf.get_mongo_read_preference())
+        self.db = self.client[conf.get_mongo_database()]
+        self.timeouts = conf.get_mongo_timeouts()
+
+        # {operation class: write concern kwargs}
+        self.default_write_concern = conf.get_mongo_write_concern()
+        self.write_concerns = conf.get_mongo_write_concerns()
+        if self._effective_write_concern('state').get('w') == 0:
+            raise ValueError("State changes are compare-and-swap "
+                             "operations and need acknowledged writes.")
+
+        self.event_layout = conf.get_mongo_event_layout()
+        if self.event_layout not in ('single', 'daily'):
+            raise ValueError("Unknown event layout: %s" % self.event_layout)
+        self.event_retention = conf.get_mongo_event_retention()
+        self.purge_batch_size = conf.get_purge_batch_size()
+        self.purge_rate = conf.get_purge_rate()
+        self.indexed_events = set()  # daily collections we've indexed
+
+        # {(trigger_name, trait_key): stream_id} of COLLECTING streams.
+        self.open_streams = cache.LRUCache(conf.get_mongo_stream_cache_size())
+
+        # {message_id: BSON} shared by all the stream loads. Kept
+        # encoded, so every load decodes its own copy of the event.
+        self.event_cache = cache.LRUCache(conf.get_mongo_event_cache_size(),
+                                          sizeof=len)
 
         self.events = self.db['events']
-        self.events.ensure_index("message_id")
-        self.events.ensure_index("when")
-        self.events.ensure_index("_context_request_id")
-
+        self.raw_events = self.db['raw_events']
+        self.codec = None
+        if conf.get_mongo_event_codec():
+            self.codec = codec.Codec(conf.get_mongo_event_codec())
         self.tdef_collection = self.db['trigger_defs']
-        self.tdef_collection.ensure_index("trigger_name")
-        self.tdef_collection.ensure_index("stream_id")
-        self.tdef_collection.ensure_index("state")
-        self.tdef_collection.ensure_index("last_update")
-        self.tdef_collection.ensure_index("identifying_traits")
-
         self.streams = self.db['streams']
-        self.streams.ensure_index('stream_id')
-        self.streams.ensure_index('when')
+        self.ready_events = self.db['ready_events']
+        self.ready_events_checked = False
+        self.ready_cursor = None
+        # Per thread, counts the streams readied during add_events().
+        self.batch = threading.local()
+        self.last_ready_id = None
+
+    def init_db(self):
+        if self.event_layout == 'single':
+            self._index_events(self.events)
+            if self.event_retention:
+                self.events.create_index("timestamp",
+                        expireAfterSeconds=self.event_retention * 86400)
+        self.raw_events.create_index("message_id")
+        if self.event_retention:
+            self.raw_events.create_index("timestamp",
+                        expireAfterSeconds=self.event_retention * 86400)
+        self.indexed_events.clear()
+
+        self.tdef_collection.create_index("trigger_name")
+        self.tdef_collection.create_index("stream_id")
+        self.tdef_collection.create_index("state")
+        self.tdef_collection.create_index("last_update")
+        self.tdef_collection.create_index("identifying_traits")
+        self.tdef_collection.create_index([("trigger_name", pymongo.ASCENDING),
+                                           ("state", pymongo.ASCENDING),
+                                           ("last_update", pymongo.ASCENDING)])
+
+        self.tdef_collection.create_index([("partition", pymongo.ASCENDING),
+                                           ("state", pymongo.ASCENDING)])
+        # find_streams(traits=...), multikey.
+        self.tdef_collection.create_index([("traits.k", pymongo.ASCENDING),
+                                           ("traits.v", pymongo.ASCENDING)])
+        # find_streams() keyset pagination.
+        self.tdef_collection.create_index([("last_update", pymongo.ASCENDING),
+                                           ("stream_id", pymongo.ASCENDING)])
+
+        self.streams.create_index('stream_id')
+        self.streams.create_index('when')
+        self.streams.create_index('message_id')  # purge reference check
+
+        self.db['workers'].create_index('worker_id')
+        self.db['workers'].create_index('group')
+
+        self.ready_events_checked = False
+        self._check_ready_events()
+
+    def get_membership(self, group, worker_id, timeout):
+        return partition.MongoMembership(self.db['workers'], group,
+                                         worker_id, timeout)
+
+    def _refresh_partition(self, state, now):
+        # The hash ranges we own moved, so our skip/limit
+        # window no longer means anything.
+        if self.partitioner and self.partitioner.refresh(now):
+            state.offset = 0
+
+    def _partition_filter(self):
+        if not self.partitioner:
+            return {}
+        return {'$or': [{'partition': {'$gte': start, '$lt': end}}
+                        for start, end in self.partitioner.ranges]}
+
+    def _write_concern(self, operation):
+        return self.write_concerns.get(operation, {})
+
+    def _effective_write_concern(self, operation):
+        return dict(self.default_write_concern,
+                    **self._write_concern(operation))
+
+    def _acknowledged(self, operation):
+        """The operation's write concern, but never w=0."""
+        concern = dict(self._write_concern(operation))
+        if self._effective_write_concern(operation).get('w') == 0:
+            concern['w'] = 1
+        return concern
+
+    def _event_write_concern(self):
+        # With dedup on, the unique index catches the redeliveries
+        # the filter has forgotten, but only if we hear back.
+        if self.dedup:
+            return self._acknowledged('ingest')
+        return self._write_concern('ingest')
+
+    def _find(self, collection, *args, **kwargs):
+        cursor = collection.find(*args, **kwargs)
+        timeout = self.timeouts.get(collection.name)
+        if timeout:
+            cursor = cursor.max_time_ms(timeout)
+        return cursor
+
+    def _index_events(self, collection):
+        # Unique, so redelivered events are never stored twice.
+        collection.create_index("message_id", unique=True)
+        collection.create_index("when")
+        collection.create_index("_context_request_id")
+
+    def _bucket(self, event):
+        """Day the event belongs to, ie: '2014-01-31'."""
+        return str(event.get('audit_bucket') or event['timestamp'])[:10]
+
+    def _events_for(self, bucket):
+        """Events collection holding the given day."""
+        if self.event_layout == 'single' or not bucket:
+            return self.events
+        name = 'events_' + bucket.replace('-', '')
+        collection = self.db[name]
+        if name not in self.indexed_events:
+            self._index_events(collection)
+            self.indexed_events.add(name)
+        return collection
+
+    def _daily_collections(self):
+        """[(datetime.date, name)] of the per-day events collections."""
+        days = []
+        for name in self.db.collection_names():
+            if not name.startswith('events_'):
+                continue
+            try:
+                day = datetime.datetime.strptime(name[7:], "%Y%m%d").date()
+            except ValueError:
+                continue
+            days.append((day, name))
+        return sorted(days)
 
     def _scrub_event(self, event):
         if type(event) is list:
@@ -104,60 +309,276 @@ class MongoDBDriver(db_driver.DBDriver):
             for k, v in to_add:
                 event[k] = v
 
-    def save_event(self, message_id, event):
-        safe = copy.deepcopy(event)
-        self._scrub_event(safe)
+    def _event_doc(self, message_id, event):
+        if self.codec:
+            fields, body = self.codec.split(event)
+            safe = dict(fields, body=bson.Binary(body))
+        else:
+            safe = copy.deepcopy(event)
+            self._scrub_event(safe)
         safe['message_id'] = message_id  # Force to known location.
-        self.events.insert(safe)
+        return safe
+
+    def _from_event_doc(self, doc):
+        if 'body' not in doc:
+            return doc
+        body = doc.pop('body')
+        return codec.LazyEvent(doc, body)
+
+    def save_event(self, message_id, event):
+        return self.save_events([(message_id, event)])
+
+    def save_events(self, events):
+        # One round trip for the whole batch (per day collection).
+        by_bucket = {}
+        for message_id, event in events:
+            doc = self._event_doc(message_id, event)
+            doc['_id'] = bson.ObjectId()  # See _not_inserted()
+            by_bucket.setdefault(self._bucket(event), []).append(doc)
+        duplicates = set()
+        for bucket, docs in by_bucket.iteritems():
+            collection = self._events_for(bucket)
+            try:
+                collection.insert(docs, continue_on_error=True,
+                                  **self._event_write_concern())
+            except pymongo.errors.DuplicateKeyError:
+                duplicates.update(self._not_inserted(collection, docs))
+        return duplicates
+
+    def _not_inserted(self, collection, docs):
+        # Any message_id stored under an _id that isn't one of
+        # ours was there before this batch.
+        ours = {}
+        for doc in docs:
+            ours.setdefault(doc['message_id'], set()).add(doc['_id'])
+        return set(doc['message_id'] for doc in
+                   self._find(collection,
+                              {'message_id': {'$in': ours.keys()}},
+                              {'message_id': True})
+                   if doc['_id'] not in ours[doc['message_id']])
+
+    def _stored(self, events):
+        stored = set()
+        for bucket, message_ids in self._by_bucket(events).iteritems():
+            stored.update(doc['message_id'] for doc in
+                          self._find(self._events_for(bucket),
+                                     {'message_id': {'$in': message_ids}},
+                                     {'message_id': True}))
+        return stored
+
+    def _appended(self, events):
+        appended = set()
+        for bucket, message_ids in self._by_bucket(events).iteritems():
+            appended.update(doc['message_id'] for doc in
+                            self._find(self._events_for(bucket),
+                                       {'message_id': {'$in': message_ids},
+                                        'appended': True},
+                                       {'message_id': True}))
+        return appended
+
+    def _mark_appended(self, events):
+        for bucket, message_ids in self._by_bucket(events).iteritems():
+            self._events_for(bucket).update(
+                            {'message_id': {'$in': message_ids}},
+                            {'$set': {'appended': True}}, multi=True,
+                            **self._write_concern('ingest'))
+
+    def _by_bucket(self, events):
+        by_bucket = {}
+        for message_id, event in events:
+            by_bucket.setdefault(self._bucket(event), []).append(message_id)
+        return by_bucket
+
+    def _in_streams(self, trigger, trait_dict, message_id):
+        stream_ids = [row['stream_id'] for row in
+                      self._find(self.streams, {'message_id': message_id},
+                                 {'stream_id': True})]
+        if not stream_ids:
+            return False
+        return self._find(self.tdef_collection,
+                          {'stream_id': {'$in': stream_ids},
+                           'trigger_name': trigger.name,
+                           'identifying_traits': trait_dict}
+                          ).limit(1).count(True) > 0
+
+    def _open_stream_key(self, trigger_name, trait_dict):
+        return (trigger_name, pstream.trait_key(trait_dict))
+
+    def _touch_stream(self, stream_id, now, ops, trigger_def=None, size=0):
+        """Bump last_update if the stream is still COLLECTING.
+           Acknowledged, since a miss means our cache is stale.
+
+           For triggers with caps, returns the stream as it was
+           before the update (or None). With rollover, a stream the
+           event won't fit in is left alone and counts as a miss.
+        """
+        query = {'stream_id': stream_id, 'state': pstream.COLLECTING}
+        update = dict(ops, **{'$set': {'last_update': now}})
+        if not (trigger_def and trigger_def.capped):
+            result = self.tdef_collection.update(
+                                query, update, **self._write_concern('state'))
+            return result['n'] > 0
+        if trigger_def.rollover:
+            query.update(self._room_filter(trigger_def, now, size))
+        return self.tdef_collection.find_and_modify(query, update,
+                                                    fields=CAP_FIELDS)
+
+    def _room_filter(self, trigger_def, now, size):
+        # Streams with room for one more event of this size, the
+        # query form of trigger_def.cap_hit() with rollover.
+        spec = {}
+        if trigger_def.max_events:
+            spec['num_events'] = {'$lt': trigger_def.max_events}
+        if trigger_def.max_bytes:
+            spec['num_bytes'] = {'$lte': trigger_def.max_bytes - size}
+        if trigger_def.max_age:
+            spec['created'] = {'$gte': now - datetime.timedelta(
+                                                seconds=trigger_def.max_age)}
+        return spec
+
+    def _stream_cap(self, trigger_def, doc, now, size):
+        # The cap this event hits on the stream doc (pre-update), if any.
+        if not trigger_def.capped:
+            return None
+        return trigger_def.cap_hit(doc.get('num_events', 0),
+                                   doc.get('num_bytes', 0),
+                                   doc.get('created'), now, size)
+
+    def save_raw_events(self, events):
+        docs = [self._event_doc(message_id, event)
+                for message_id, event in events]
+        if docs:
+            self.raw_events.insert(docs, **self._write_concern('ingest'))
 
     def append_event(self, message_id, trigger_def, event, trait_dict):
         # Find the stream (or make one) and tack on the message_id.
-
+        now = self.clock()
+        # Reducer updates ride along with the last_update write.
+        ops = reducers.mongo_update(trigger_def.reducers, event)
+        size = trigger_def.event_size(event)
+        if trigger_def.capped:
+            ops.setdefault('$inc', {}).update(num_events=1, num_bytes=size)
+        key = self._open_stream_key(trigger_def.name, trait_dict)
         stream_id = None
-        for doc in self.tdef_collection.find({'trigger_name': trigger_def.name,
-                                              'state': pstream.COLLECTING,
-                                              'identifying_traits': trait_dict}
-                                            ).limit(1):
-            stream_id = doc['stream_id']
+        if key:
+            stream_id = self.open_streams.get(key)
+            if stream_id:
+                before = self._touch_stream(stream_id, now, ops,
+                                            trigger_def, size)
+                if not before:
+                    # Another worker moved it out of COLLECTING (or,
+                    # with rollover, it is full).
+                    self.open_streams.discard(key, stream_id)
+                    stream_id = None
+        if stream_id:
+            self._append_to_stream(stream_id, message_id, event)
+            if trigger_def.capped:
+                self._after_append(trigger_def, before, now, size)
+            return False
+
+        before = None
+        for doc in self._find(self.tdef_collection,
+                               {'trigger_name': trigger_def.name,
+                                'state': pstream.COLLECTING,
+                                'identifying_traits': trait_dict}
+                              ).limit(1):
+            cap = None
+            if trigger_def.rollover:
+                cap = self._stream_cap(trigger_def, doc, now, size)
+            if cap:
+                self._cap_reached(trigger_def,
+                                  self._stream_from_mongo(doc, False), cap)
+            else:
+                stream_id = doc['stream_id']
+                before = doc
             break
 
-        now  = datetime.datetime.utcnow()
         update_time = True
         if not stream_id:
             # Make a new Stream for this trait_dict ...
             stream_id = str(uuid.uuid4())
             stream = {'stream_id': stream_id,
+                      'partition': partition.hash_key(stream_id),
                       'trigger_name': trigger_def.name,
                       'last_update': now,
                       'identifying_traits': trait_dict,
+                      'traits': [{'k': k, 'v': v}
+                                 for k, v in sorted(trait_dict.items())],
                       'state_version': 1,
                       'commit_errors': 0,
                       'last_error': "",
                       'state': pstream.COLLECTING,
+                      'aggregates': reducers.update(trigger_def.reducers,
+                                                    {}, event),
                      }
+            if trigger_def.capped:
+                stream.update(created=now, num_events=1, num_bytes=size)
+                before = dict(stream, num_events=0, num_bytes=0)
             update_time = False
-            self.tdef_collection.insert(stream)
+            self.tdef_collection.insert(stream,
+                                        **self._write_concern('state'))
+        if key:
+            self.open_streams.put(key, stream_id)
 
-        # Add this message_id to the stream collection ...
-        entry = {'stream_id': stream_id,
-                 'when': event['timestamp'],
-                 'message_id': message_id}
-        self.streams.insert(entry)
+        self._append_to_stream(stream_id, message_id, event)
 
         if update_time:
             self.tdef_collection.update({'stream_id': stream_id},
-                                        {'$set': {'last_update': now}})
+                                        dict(ops,
+                                             **{'$set': {'last_update': now}}),
+                                        **self._write_concern('ingest'))
+        if trigger_def.capped:
+            self._after_append(trigger_def, before, now, size)
         return not update_time  # a new stream if we didn't update the time.
 
+    def _after_append(self, trigger_def, before, now, size):
+        # Without rollover, the event that fills a stream fires it.
+        if trigger_def.rollover:
+            return
+        cap = self._stream_cap(trigger_def, before, now, size)
+        if cap:
+            self._cap_reached(trigger_def,
+                              self._stream_from_mongo(before, False), cap)
+
+    def _append_to_stream(self, stream_id, message_id, event):
+        # Add this message_id to the stream collection ...
+        entry = {'stream_id': stream_id,
+                 'when': event['timestamp'],
+                 'message_id': message_id,
+                 'bucket': self._bucket(event)}
+        self.streams.insert(entry, **self._write_concern('ingest'))
+
     def do_trigger_check(self, state, chunk, now=None):
-        # TODO(sandy) - we need to get the expiry time as part of the
-        #               stream document so the search is optimal.
+        # Triggers whose criteria can be expressed as a query are
+        # transitioned server-side. Only the rest are pulled into
+        # Python and checked one stream at a time.
+        if now is None:
+            now = datetime.datetime.utcnow()
+        self._refresh_partition(state, now)
         num = 0
         ready = 0
+        pushed = 0
+
+        python_triggers = []
+        for trigger in self.trigger_defs:
+            pushdown = trigger.get_pushdown(now)
+            if pushdown is None:
+                python_triggers.append(trigger.name)
+            else:
+                pushed += self._pushdown_trigger_check(trigger, pushdown)
+
+        if not python_triggers:
+            print "%s - %d ready by query" % (now, pushed)
+            state.offset = 0
+            return
 
-        query = self.tdef_collection.find({'state': pstream.COLLECTING}).sort(
-                                [('last_update', pymongo.ASCENDING)]
+        query = self._find(self.tdef_collection,
+                           dict(self._partition_filter(),
+                                state=pstream.COLLECTING,
+                                trigger_name={'$in': python_triggers})
+                            ).sort([('last_update', pymongo.ASCENDING)]
                             ).skip(state.offset).limit(chunk)
+        self.begin_transitions()
         for doc in query:
             trigger_name = doc['trigger_name']
             trigger = self.trigger_defs_dict[trigger_name]
@@ -166,139 +587,418 @@ class MongoDBDriver(db_driver.DBDriver):
             stream = self._stream_from_mongo(doc, False)
             if self._check_for_trigger(trigger, stream, now=now):
                 ready += 1
+        conflicts = len(self.flush_transitions())
+        ready -= conflicts
 
         size = query.retrieved
-        print "%s - checked %d (%d ready) off/lim/sz=%d/%d/%d" % (
-                                                    now, num, ready,
-                                                    state.offset, chunk, size)
+        print "%s - checked %d (%d ready, %d conflicts, %d ready by query) " \
+              "off/lim/sz=%d/%d/%d" % (now, num, ready, conflicts, pushed,
+                                       state.offset, chunk, size)
         if size < chunk:
             state.offset = 0
         else:
             state.offset += num
 
+    def _pushdown_trigger_check(self, trigger, pushdown):
+        if pushdown.never:
+            return 0
+        query = dict(self._partition_filter(),
+                     state=pstream.COLLECTING,
+                     trigger_name=trigger.name)
+        if pushdown.last_update_before is not None:
+            query['last_update'] = {'$lt': pushdown.last_update_before}
+        result = self.tdef_collection.update(query,
+                                {'$set': {'state': pstream.READY},
+                                 '$inc': {'state_version': 1}},
+                                multi=True, **self._write_concern('state'))
+        self._get_debugger(trigger.name).criteria_match(result['n'])
+        if result['n']:
+            self._notify_ready(result['n'])
+        return result['n']
+
     def purge_processed_streams(self, state, chunk):
+        # Delete in small batches, optionally throttled, so a big
+        # trigger wave doesn't turn into one huge remove().
         now = datetime.datetime.utcnow()
-        print "%s - purged %d" % (now,
-            self.tdef_collection.remove({'state': pstream.PROCESSED})['n'])
+        self._refresh_partition(state, now)
+        query = dict(self._partition_filter(), state=pstream.PROCESSED)
+        started = time.time()
+        purged = 0
+        while chunk <= 0 or purged < chunk:
+            size = self.purge_batch_size
+            if chunk > 0:
+                size = min(size, chunk - purged)
+            docs = list(self._find(self.tdef_collection, query,
+                                   {'stream_id': True, 'trigger_name': True}
+                                   ).limit(size))
+            if not docs:
+                break
+            stream_ids = [doc['stream_id'] for doc in docs]
+            self._purge_stream_events(stream_ids)
+            self.tdef_collection.remove({'stream_id': {'$in': stream_ids},
+                                         'state': pstream.PROCESSED},
+                                        **self._write_concern('purge'))
+            for doc in docs:
+                self._get_debugger(doc['trigger_name']).purged()
+            purged += len(docs)
+
+            if self.purge_rate:
+                ahead = purged / float(self.purge_rate) - \
+                                                (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        dropped = self._drop_expired_events(now)
+        print "%s - purged %d in %.2fs, dropped %d event collections" % (
+                                now, purged, time.time() - started, dropped)
+
+    def _purge_stream_events(self, stream_ids):
+        """Remove the message rows of the streams and any events
+           no other stream refers to.
+        """
+        buckets = {}
+        for row in self._find(self.streams,
+                              {'stream_id': {'$in': stream_ids}},
+                              {'message_id': True, 'bucket': True}):
+            buckets[row['message_id']] = row.get('bucket')
+        wc = self._write_concern('purge')
+        self.streams.remove({'stream_id': {'$in': stream_ids}}, **wc)
+        if not buckets:
+            return
+
+        # Events are shared between streams of different triggers.
+        shared = set(row['message_id'] for row in
+                     self._find(self.streams,
+                                {'message_id': {'$in': buckets.keys()}},
+                                {'message_id': True}))
+        by_bucket = {}
+        for message_id, bucket in buckets.iteritems():
+            if message_id not in shared:
+                by_bucket.setdefault(bucket, []).append(message_id)
+        for bucket, message_ids in by_bucket.iteritems():
+            self._events_for(bucket).remove(
+                            {'message_id': {'$in': message_ids}}, **wc)
+
+    def _drop_expired_events(self, now):
+        if self.event_layout != 'daily' or not self.event_retention:
+            return 0
+        cutoff = (now - datetime.timedelta(days=self.event_retention)).date()
+        dropped = 0
+        for day, name in self._daily_collections():
+            if day >= cutoff:
+                break
+            self.db.drop_collection(name)
+            self.indexed_events.discard(name)
+            dropped += 1
+        return dropped
 
     def _load_events(self, stream):
-        events = []
-        hit = False
-        x = self.streams.find({'stream_id': stream.uuid}) \
-                             .sort('when', pymongo.ASCENDING)
-        #print "Stream: %s" % stream.uuid
-        for mdoc in x:
-            for e in self.events.find({'message_id': mdoc['message_id']}):
-                events.append(e)
-                #print e['event_type'], e['payload'].get(
-                #        'audit_period_beginning',
-                #        "nothinghere")[-8:] == "00:00:00", e['timestamp']
-        stream.set_events(events)
+        rows = list(self._find(self.streams, {'stream_id': stream.uuid})
+                                .sort('when', pymongo.ASCENDING))
+        by_bucket = {}
+        for row in rows:
+            by_bucket.setdefault(row.get('bucket'), []).append(
+                                                        row['message_id'])
+        found = {}
+        use_cache = self.trigger_defs_dict[stream.trigger_name].cache_events
+        if use_cache:
+            for message_ids in by_bucket.values():
+                for message_id in message_ids:
+                    raw = self.event_cache.get(message_id)
+                    if raw is not None:
+                        found[message_id] = self._from_event_doc(
+                                                bson.BSON(raw).decode())
+        for bucket, message_ids in by_bucket.iteritems():
+            missing = [message_id for message_id in message_ids
+                       if message_id not in found]
+            if not missing:
+                continue
+            for e in self._find(self._events_for(bucket),
+                                {'message_id': {'$in': missing}},
+                                {'appended': False}):
+                if use_cache:
+                    self.event_cache.put(e['message_id'],
+                                         bson.BSON.encode(e))
+                found[e['message_id']] = self._from_event_doc(e)
+        # Expired (or dropped) events just fall out of the stream.
+        stream.set_events([found[row['message_id']] for row in rows
+                           if row['message_id'] in found])
 
     def process_ready_streams(self, state, chunk, now):
         num = 0
         locked = 0
-        query = self.tdef_collection.find({'state': pstream.READY}
+        self._refresh_partition(state, now)
+        query = self._find(self.tdef_collection,
+                           dict(self._partition_filter(), state=pstream.READY)
                                          ).limit(chunk).skip(state.offset)
+        self.begin_transitions()
         for ready in query:
             result = self.tdef_collection.update(
                 {'_id': ready['_id'],
                  'state_version': ready['state_version']},
                 {'$set': {'state': pstream.TRIGGERED},
                  '$inc': {'state_version': 1}},
-                 safe=True)
+                 **self._write_concern('state'))
             if result['n'] == 0:
                 locked += 1
                 continue  # Someone else got it first, move to next one.
 
-            stream = self._stream_from_mongo(ready, True)
+            trigger = self.trigger_defs_dict[ready['trigger_name']]
+            stream = self._stream_from_mongo(ready, trigger.needs_events)
+            stream.state = pstream.TRIGGERED
+            stream.state_version += 1
 
             num += 1
-            trigger = self.trigger_defs_dict[ready['trigger_name']]
             self._do_pipeline_callbacks(stream, trigger)
+        conflicts = len(self.flush_transitions())
         size = query.retrieved
         if size < chunk:
             state.offset = 0
         else:
             state.offset += num
 
-        print "%s - processed %d/%d (%d locked, off/lim/sz: %d/%d/%d)" % (
-                                                now, num,
-                                                chunk, locked,
-                                                state.offset, chunk, size)
+        print "%s - processed %d/%d (%d locked, %d conflicts, " \
+              "off/lim/sz: %d/%d/%d)" % (now, num, chunk, locked, conflicts,
+                                         state.offset, chunk, size)
+        print "%s - event cache: %.1f%% hits (%d/%d), %d events, %d bytes" % (
+                now, self.event_cache.hit_rate() * 100,
+                self.event_cache.hits,
+                self.event_cache.hits + self.event_cache.misses,
+                len(self.event_cache), self.event_cache.size)
 
     def trigger(self, trigger_name, stream):
-        self.tdef_collection.update({'stream_id': stream.uuid},
-                                 {'$set': {'state': pstream.TRIGGERED}})
+        self._change_state(trigger_name, stream, pstream.TRIGGERED)
 
     def ready(self, trigger_name, stream):
-        self.tdef_collection.update({'stream_id': stream.uuid},
-                                 {'$set': {'state': pstream.READY}})
+        self._change_state(trigger_name, stream, pstream.READY)
 
     def processed(self, trigger_name, stream):
-        self.tdef_collection.update({'stream_id': stream.uuid},
-                                 {'$set': {'state': pstream.PROCESSED}})
+        self._change_state(trigger_name, stream, pstream.PROCESSED)
 
     def error(self, trigger_name, stream, error):
-        self.tdef_collection.update({'stream_id': stream.uuid},
-                                 {'$set': {'state': pstream.ERROR,
-                                           'last_error': error}})
+        self._change_state(trigger_name, stream, pstream.ERROR,
+                           {'last_error': error})
 
     def commit_error(self, trigger_name, stream, error):
-        self.tdef_collection.update({'stream_id': stream.uuid},
-                                 {'$set': {'state': pstream.COMMIT_ERROR,
-                                           'last_error': error},
-                                  '$inc': {'commit_errors': 1},
-                                 })
+        self._change_state(trigger_name, stream, pstream.COMMIT_ERROR,
+                           {'last_error': error}, {'commit_errors': 1})
+
+    def _change_state(self, trigger_name, stream, new_state, sets=None,
+                      incs=None):
+        # Every state change is a compare-and-swap on state_version,
+        # so we never clobber a stream another worker has moved on.
+        sets = dict(sets or {}, state=new_state)
+        incs = dict(incs or {}, state_version=1)
+        if self.transitions is not None:
+            key = (stream.state_version, tuple(sorted(sets.items())),
+                   tuple(sorted(incs.items())))
+            self.transitions.add(key, trigger_name, stream)
+        else:
+            result = self.tdef_collection.update(
+                                {'stream_id': stream.uuid,
+                                 'state_version': stream.state_version},
+                                {'$set': sets, '$inc': incs},
+                                **self._write_concern('state'))
+            if result['n'] == 0:
+                self._get_debugger(trigger_name).state_conflict()
+                return
+            if new_state == pstream.READY:
+                self._notify_ready()
+        if stream.state == pstream.COLLECTING:
+            self._forget_open_stream(stream)
+        stream.state = new_state
+        stream.state_version += 1
+
+    def _forget_open_stream(self, stream):
+        key = self._open_stream_key(stream.trigger_name,
+                                    stream.identifying_traits)
+        if key:
+            self.open_streams.discard(key, stream.uuid)
+
+    def _flush_transitions(self, transitions):
+        # One multi-update per (version, target state) group. Each
+        # group is stamped with a transition_id so that, if fewer
+        # documents matched than expected, we can find out exactly
+        # which streams lost the race.
+        failed = []
+        readied = 0
+        for key, entries in transitions.groups.iteritems():
+            version, sets, incs = key
+            transition_id = str(uuid.uuid4())
+            stream_ids = [stream.uuid for trigger_name, stream in entries]
+            sets = dict(sets, transition_id=transition_id)
+            result = self.tdef_collection.update(
+                                {'stream_id': {'$in': stream_ids},
+                                 'state_version': version},
+                                {'$set': sets, '$inc': dict(incs)},
+                                multi=True, **self._write_concern('state'))
+            if sets['state'] == pstream.READY:
+                readied += result['n']
+            if result['n'] == len(stream_ids):
+                continue
+
+            done = set(doc['stream_id'] for doc in self._find(
+                                self.tdef_collection,
+                                {'stream_id': {'$in': stream_ids},
+                                 'transition_id': transition_id},
+                                {'stream_id': True}))
+            failed.extend((trigger_name, stream)
+                          for trigger_name, stream in entries
+                          if stream.uuid not in done)
+        if readied:
+            self._notify_ready(readied)
+        return failed
+
+    def add_events(self, events):
+        # One ready_events entry per batch, not one per stream readied.
+        self.batch.readied = 0
+        try:
+            super(MongoDBDriver, self).add_events(events)
+        finally:
+            readied, self.batch.readied = self.batch.readied, None
+            if readied:
+                self._notify_ready(readied)
+
+    def _notify_ready(self, count=1):
+        if getattr(self.batch, 'readied', None) is not None:
+            self.batch.readied += count
+            return
+        super(MongoDBDriver, self)._notify_ready()
+        self._check_ready_events()
+        # Just a wake-up call, the READY transition doesn't wait
+        # for it. A lost one only delays workers to their next poll.
+        self.ready_events.insert({'when': datetime.datetime.utcnow(),
+                                  'count': count}, w=0)
+
+    def _check_ready_events(self):
+        """Make sure ready_events is a capped collection, even if
+           'pipeline init-db' was never run. An uncapped one would
+           grow forever and can't be tailed.
+        """
+        if self.ready_events_checked:
+            return
+        try:
+            self.db.create_collection('ready_events', capped=True,
+                                      size=1024 * 1024)
+            # A tailable cursor on an empty capped collection dies
+            # at once.
+            self.ready_events.insert({'when': datetime.datetime.utcnow(),
+                                      'count': 0})
+        except pymongo.errors.CollectionInvalid:
+            if not self.ready_events.options().get('capped'):
+                raise RuntimeError("ready_events is not a capped "
+                                   "collection. Drop it and run "
+                                   "'pipeline init-db'.")
+        self.ready_events_checked = True
+
+    def wait_for_ready(self, timeout):
+        # Tail the capped ready_events collection, so workers in
+        # other processes wake up as soon as a stream is READY.
+        deadline = time.time() + timeout
+        retried = False
+        while time.time() < deadline:
+            try:
+                if self.ready_cursor is None or not self.ready_cursor.alive:
+                    self.ready_cursor = self._tail_ready_events()
+                doc = self.ready_cursor.next()
+            except StopIteration:
+                # Nothing new within the server's await period.
+                time.sleep(min(1.0, max(0, deadline - time.time())))
+                continue
+            except pymongo.errors.PyMongoError as e:
+                self.ready_cursor = None
+                if not retried:
+                    retried = True  # A dead cursor, say. Tail again.
+                    continue
+                print "Falling back to polling for ready streams:", e
+                time.sleep(max(0, deadline - time.time()))
+                return False
+            self.last_ready_id = doc['_id']
+            return True
+        return False
+
+    def _tail_ready_events(self):
+        self._check_ready_events()
+        if self.last_ready_id is None:
+            # Start after the newest entry, we only want what's next.
+            newest = list(self.ready_events.find().sort(
+                                '$natural', pymongo.DESCENDING).limit(1))
+            if newest:
+                self.last_ready_id = newest[0]['_id']
+        query = {}
+        if self.last_ready_id is not None:
+            query = {'_id': {'$gt': self.last_ready_id}}
+        return self.ready_events.find(query, tailable=True, await_data=True)
 
     def get_num_active_streams(self, trigger_name):
-        return self.tdef_collection.find({'trigger_name': trigger_name}
-                                        ).count()
+        return self._find(self.tdef_collection,
+                          {'trigger_name': trigger_name}).count()
 
     def _stream_from_mongo(self, record, details):
         s = Stream(record['stream_id'], record['trigger_name'], record['state'],
-                   record['last_update'], record['identifying_traits'], self)
+                   record['last_update'], record['identifying_traits'], self,
+                   record.get('state_version', 1))
+        s.aggregates = record.get('aggregates', {})
         if details:
             s.load_events()
         return s
 
-    def find_streams(self, **kwargs):
-        query = self.tdef_collection
-
-        hits = 0
-
-        details = kwargs.get('details')
-
-        state = kwargs.get('state')
-        if state:
-            query = query.find({'state': state})
-            hits += 1
-
-        name = kwargs.get('trigger_name')
-        if name:
-            query = query.find({'trigger_name': name})
-            hits += 1
-
-        older = kwargs.get('older_than')
-        if older:
-            query = query.find({'last_update': {'$lt': older}})
-            hits += 1
-
-        younger = kwargs.get('younger_than')
-        if younger:
-            query = query.find({'last_update': {'$gt': younger}})
-            hits += 1
-
-        if not hits:
-            query = query.find({})
-
-        return [self._stream_from_mongo(r, details).to_dict() for r in query]
-
-    def get_stream(self, stream_id, details):
-        return [self._stream_from_mongo(r, details).to_dict()
-                for r in self.tdef_collection.find({'stream_id': stream_id})]
+    def _stream_filter(self, query):
+        spec = {}
+        for field in ['stream_id', 'state', 'trigger_name']:
+            value = getattr(query, field)
+            if value:
+                spec[field] = value
+
+        if query.traits:
+            spec['traits'] = {'$all': [{'$elemMatch': {'k': k, 'v': v}}
+                                       for k, v in query.traits.items()]}
+
+        bounds = {}
+        if query.older_than:
+            bounds['$lt'] = query.older_than
+        if query.younger_than:
+            bounds['$gt'] = query.younger_than
+        if bounds:
+            spec['last_update'] = bounds
+
+        if query.after:
+            last_update, stream_id = query.after
+            spec['$or'] = [{'last_update': {'$gt': last_update}},
+                           {'last_update': last_update,
+                            'stream_id': {'$gt': stream_id}}]
+        return spec
+
+    def _find_streams(self, query):
+        fields = None
+        if query.fields:
+            fields = dict((field, True) for field in query.fields)
+            fields['_id'] = False
+        cursor = self._find(self.tdef_collection, self._stream_filter(query),
+                            fields)
+        if query.ordered:
+            cursor = cursor.sort([('last_update', pymongo.ASCENDING),
+                                  ('stream_id', pymongo.ASCENDING)])
+        if query.limit:
+            cursor = cursor.limit(query.limit)
+        for doc in cursor:
+            if query.fields:
+                yield doc
+            else:
+                yield self._stream_from_mongo(doc, query.details).to_dict()
+
+    def _count_streams(self, query):
+        cursor = self._find(self.tdef_collection, self._stream_filter(query))
+        if query.limit:
+            cursor = cursor.limit(query.limit)
+        return cursor.count(with_limit_and_skip=True)
 
     def flush_all(self):
+        self.open_streams.clear()
         self.db.drop_collection('trigger_defs')
         self.db.drop_collection('streams')
         self.db.drop_collection('events')
+        self.db.drop_collection('raw_events')
+        for day, name in self._daily_collections():
+            self.db.drop_collection(name)
+        self.init_db()
@@ -0,0 +1,33 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import dateutil.parser
+
+
+def normalize(event):
+    """Sort out the timestamps and audit bucket of a raw
+       notification, in place. Shared by the yagi handler and
+       the replay tool so both feed the drivers the same events.
+       The drivers distill the events, if configured.
+    """
+    payload = event['payload']
+
+    when = dateutil.parser.parse(event['timestamp'])
+    audit = when
+    a_beginning = payload.get('audit_period_beginning')
+    if a_beginning:
+        audit = dateutil.parser.parse(a_beginning)
+    event['audit_bucket'] = str(audit.date())
+    event['timestamp'] = when  # force to datetime
+    return event
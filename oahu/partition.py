@@ -0,0 +1,156 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Consistent-hash partitioning of streams across pipeline workers.
+
+Every stream gets a fixed position on a 32-bit hash ring when it is
+created. Each live worker places a number of virtual nodes on the same
+ring and owns the arcs that end at its nodes. When a worker joins or
+leaves, only the arcs next to its nodes change hands.
+
+Ownership is recomputed from the membership record on every pass, so
+for a short while after a change two workers may both look at a stream
+(harmless, state changes are compare-and-swap) or nobody will (it gets
+picked up on the next pass).
+"""
+
+import bisect
+import datetime
+import hashlib
+
+
+RING_SIZE = 2 ** 32
+
+
+def hash_key(key):
+    """Position of key on the ring, 0 <= hash < RING_SIZE."""
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    def __init__(self, members, replicas=64):
+        self.members = sorted(members)
+        self.replicas = replicas
+        self.points = []  # [(hash, member), ...] sorted by hash.
+        for member in self.members:
+            for x in range(replicas):
+                self.points.append((hash_key("%s-%d" % (member, x)), member))
+        self.points.sort()
+        self.hashes = [h for h, member in self.points]
+
+    def owner(self, key_hash):
+        if not self.points:
+            return None
+        index = bisect.bisect_left(self.hashes, key_hash) % len(self.points)
+        return self.points[index][1]
+
+    def get_ranges(self, member):
+        """The [start, end) hash ranges owned by member, merged
+           where they are adjacent.
+        """
+        if not self.points:
+            return []
+
+        ranges = []
+        previous = self.points[-1][0]
+        for h, owner in self.points:
+            if owner == member:
+                if previous < h:
+                    ranges.append((previous + 1, h + 1))
+                else:
+                    # The arc that wraps around the top of the ring.
+                    ranges.append((previous + 1, RING_SIZE))
+                    ranges.append((0, h + 1))
+            previous = h
+
+        merged = []
+        for start, end in sorted(ranges):
+            if start >= end:
+                continue
+            if merged and merged[-1][1] >= start:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+
+class Membership(object):
+    """The set of live workers in a group, kept alive by heartbeats.
+       Drivers that support partitioning provide an implementation
+       via DBDriver.get_membership().
+    """
+    def __init__(self, group, worker_id, timeout):
+        self.group = group
+        self.worker_id = worker_id
+        self.timeout = timeout  # Seconds without a heartbeat == gone.
+
+    def heartbeat(self, now):
+        """Record that this worker is alive and return the sorted
+           list of live worker ids in the group.
+        """
+        raise NotImplementedError()
+
+    def leave(self):
+        raise NotImplementedError()
+
+
+class MongoMembership(Membership):
+    def __init__(self, collection, group, worker_id, timeout):
+        super(MongoMembership, self).__init__(group, worker_id, timeout)
+        self.collection = collection
+
+    def heartbeat(self, now):
+        self.collection.update({'worker_id': self.worker_id},
+                               {'$set': {'group': self.group,
+                                         'heartbeat': now}},
+                               upsert=True)
+        cutoff = now - datetime.timedelta(seconds=self.timeout)
+        self.collection.remove({'group': self.group,
+                                'heartbeat': {'$lt': cutoff}})
+        return sorted(doc['worker_id'] for doc in self.collection.find(
+                                            {'group': self.group},
+                                            {'worker_id': True}))
+
+    def leave(self):
+        self.collection.remove({'worker_id': self.worker_id})
+
+
+class Partitioner(object):
+    def __init__(self, membership, replicas=64):
+        self.membership = membership
+        self.replicas = replicas
+        self.ring = HashRing([], replicas)
+        self.ranges = []
+
+    def refresh(self, now):
+        """Heartbeat and rebuild the ring if the membership changed.
+           Returns True on a rebalance.
+        """
+        members = self.membership.heartbeat(now)
+        if members == self.ring.members:
+            return False
+        self.ring = HashRing(members, self.replicas)
+        self.ranges = self.ring.get_ranges(self.membership.worker_id)
+        owned = sum(end - start for start, end in self.ranges)
+        print "%s - rebalanced: %d workers, %s owns %.1f%%" % (
+                    now, len(members), self.membership.worker_id,
+                    100.0 * owned / RING_SIZE)
+        return True
+
+    def owns(self, key_hash):
+        return self.ring.owner(key_hash) == self.membership.worker_id
+
+    def leave(self):
+        self.membership.leave()
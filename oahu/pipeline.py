@@ -33,6 +33,9 @@ class Pipeline(object):
     def add_event(self, event):
         self.db_driver.add_event(event)
 
+    def add_events(self, events):
+        self.db_driver.add_events(events)
+
     # These methods are called as periodic tasks and
     # may be expensive (in that they may iterate over
     # all streams).
@@ -19,6 +19,9 @@ import abc
 class PipelineCallback(object):
     __metaclass__ = abc.ABCMeta
 
+    # Set to False if the callback only uses stream.aggregates.
+    needs_events = True
+
     @abc.abstractmethod
     def on_trigger(self, stream, scratchpad):
         pass
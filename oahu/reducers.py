@@ -0,0 +1,115 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Aggregates kept up to date as events are added to a stream, so
+callbacks can use stream.aggregates without loading the events.
+
+    TriggerDefinition(..., reducers=[
+        reducers.Count('updates', event_type='compute.instance.update'),
+        reducers.Min('first', 'timestamp'),
+        reducers.Max('last', 'timestamp'),
+        reducers.Sum('disk_gb', 'payload/disk_gb')])
+
+Paths are / separated, like identifying trait names. Events
+without the path (or of another event_type) are skipped.
+"""
+
+
+class Reducer(object):
+    op = None  # The mongo update operator.
+    needs_path = True
+
+    def __init__(self, name, path=None, event_type=None):
+        if '.' in name or name.startswith('$'):
+            raise ValueError("Bad aggregate name: %s" % name)
+        if self.needs_path and not path:
+            raise ValueError("%s reducer %s needs a path" % (
+                                    self.__class__.__name__, name))
+        self.name = name
+        self.path = path
+        self.event_type = event_type
+
+    def value(self, event):
+        """The value to fold in for this event, or None."""
+        if self.event_type and event.get('event_type') != self.event_type:
+            return None
+        return self.extract(event)
+
+    def extract(self, event):
+        parts = self.path.split('/')
+        try:
+            for part in parts[:-1]:
+                event = event[part]
+            return event[parts[-1]]
+        except (KeyError, TypeError):
+            return None
+
+    def fold(self, current, value):
+        raise NotImplementedError()
+
+
+class Count(Reducer):
+    op = '$inc'
+    needs_path = False
+
+    def extract(self, event):
+        return 1
+
+    def fold(self, current, value):
+        return (current or 0) + value
+
+
+class Sum(Reducer):
+    op = '$inc'
+
+    def fold(self, current, value):
+        return (current or 0) + value
+
+
+class Min(Reducer):
+    op = '$min'
+
+    def fold(self, current, value):
+        return value if current is None else min(current, value)
+
+
+class Max(Reducer):
+    op = '$max'
+
+    def fold(self, current, value):
+        return value if current is None else max(current, value)
+
+
+def update(reducers, aggregates, event):
+    """Fold event into the aggregates dict, in place."""
+    for reducer in reducers:
+        value = reducer.value(event)
+        if value is not None:
+            aggregates[reducer.name] = reducer.fold(
+                                    aggregates.get(reducer.name), value)
+    return aggregates
+
+
+def mongo_update(reducers, event):
+    """The same as update(), as mongo update operators:
+       {'$inc': {'aggregates.name': value}, ...}
+    """
+    ops = {}
+    for reducer in reducers:
+        value = reducer.value(event)
+        if value is not None:
+            ops.setdefault(reducer.op, {})['aggregates.' + reducer.name] = \
+                                                                    value
+    return ops
@@ -0,0 +1,161 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Push archived notifications through the pipeline.
+
+   The archives are JSON lines, optionally gzipped, in the order
+   the notifications were sent. Decoding and normalizing is done
+   in a process pool; the writes and trigger checks stay in this
+   process. The driver's clock follows the event timestamps, so
+   the trigger checks fire in event time rather than wall time.
+"""
+
+import collections
+import datetime
+import gzip
+import itertools
+import json
+import multiprocessing
+import time
+
+import notification
+import stream as pstream
+
+
+class EventClock(object):
+    """Returns the latest event time seen so far."""
+    def __init__(self):
+        self.now = None
+
+    def advance(self, events):
+        for event in events:
+            if self.now is None or event['timestamp'] > self.now:
+                self.now = event['timestamp']
+
+    def __call__(self):
+        return self.now
+
+
+def read_lines(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def decode(lines):
+    return [notification.normalize(json.loads(line)) for line in lines]
+
+
+def _chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _decoded(pool, batches, ahead):
+    # Like pool.imap, in order, but with at most ahead batches in
+    # flight. Otherwise a slow pipeline has the whole archive
+    # decoded and waiting in memory.
+    pending = collections.deque()
+    for batch in batches:
+        pending.append(pool.apply_async(decode, (batch,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def replay(pipeline, paths, batch_size=1000, processes=None,
+           check_interval=60, chunk=1000, report_every=10):
+    """Feed the events in paths to pipeline in batches of batch_size.
+       Every check_interval seconds of event time the trigger check
+       and ready processing run, with chunk streams per call.
+       After the last event every stream is checked, and the READY
+       ones processed, whatever the chunk size.
+       Returns the number of events replayed.
+    """
+    db_driver = pipeline.db_driver
+    clock = EventClock()
+    db_driver.set_clock(clock)
+
+    lines = itertools.chain.from_iterable(read_lines(p) for p in paths)
+    pool = multiprocessing.Pool(processes)
+    ahead = 2 * (processes or multiprocessing.cpu_count())
+    interval = datetime.timedelta(seconds=check_interval)
+    next_check = None
+    start = last_report = time.time()
+    total = reported = 0
+    try:
+        for events in _decoded(pool, _chunks(lines, batch_size), ahead):
+            clock.advance(events)
+            pipeline.add_events(events)
+            total += len(events)
+
+            if next_check is None:
+                next_check = clock.now + interval
+            if clock.now >= next_check:
+                _check(pipeline, clock.now, chunk)
+                next_check = clock.now + interval
+
+            now = time.time()
+            if now - last_report > report_every:
+                print "%s - replayed %d events (%d/sec), event time %s" % (
+                        datetime.datetime.utcnow(), total,
+                        (total - reported) / (now - last_report), clock.now)
+                last_report = now
+                reported = total
+    except:
+        pool.terminate()  # Don't wait for decodes nobody will read.
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    if clock.now:
+        _final_check(pipeline, clock.now)
+    elapsed = time.time() - start
+    print "%s - replayed %d events in %.1fs (%d/sec), %d duplicates" % (
+            datetime.datetime.utcnow(), total, elapsed,
+            total / max(elapsed, 0.001), db_driver.duplicates)
+    return total
+
+
+def _check(pipeline, now, chunk):
+    pipeline.do_trigger_check(chunk, now)
+    pipeline.process_ready_streams(chunk, now)
+
+
+def _final_check(pipeline, now):
+    # One pass over every stream, then process READY streams
+    # until there are none left (or a pass gets nowhere).
+    db_driver = pipeline.db_driver
+    pipeline.cursor_state.offset = 0
+    collecting = db_driver.count_streams(state=pstream.COLLECTING)
+    if collecting:
+        pipeline.do_trigger_check(collecting, now)
+    ready = db_driver.count_streams(state=pstream.READY)
+    while ready:
+        pipeline.cursor_state.offset = 0
+        pipeline.process_ready_streams(ready, now)
+        left = db_driver.count_streams(state=pstream.READY)
+        if left >= ready:
+            break
+        ready = left
@@ -0,0 +1,581 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import marshal
+import sqlite3
+import threading
+import uuid
+
+import db_driver
+import journal
+import reducers
+import stream as pstream
+
+
+# Tables:
+# events = message_id, event_type, timestamp, body (marshal'ed event)
+#
+# streams = stream_id, trigger_name, state, state_version, last_update,
+#           identifying_traits (json), trait_key (canonical json),
+#           commit_errors, last_error, aggregates (marshal'ed)
+#
+# stream_events = stream_id, message_id, timestamp
+#
+# stream_traits = stream_id, trait, value (json) - one row per
+#                 identifying trait, for find_streams(traits=...)
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS events (
+            message_id TEXT PRIMARY KEY,
+            event_type TEXT,
+            timestamp TIMESTAMP,
+            body BLOB)""",
+    """CREATE TABLE IF NOT EXISTS streams (
+            stream_id TEXT PRIMARY KEY,
+            trigger_name TEXT,
+            state INTEGER,
+            state_version INTEGER,
+            last_update TIMESTAMP,
+            identifying_traits TEXT,
+            trait_key TEXT,
+            commit_errors INTEGER DEFAULT 0,
+            last_error TEXT DEFAULT '',
+            aggregates BLOB,
+            created TIMESTAMP,
+            num_events INTEGER DEFAULT 0,
+            num_bytes INTEGER DEFAULT 0)""",
+    """CREATE TABLE IF NOT EXISTS stream_events (
+            stream_id TEXT,
+            message_id TEXT,
+            timestamp TIMESTAMP)""",
+    """CREATE TABLE IF NOT EXISTS stream_traits (
+            stream_id TEXT,
+            trait TEXT,
+            value TEXT)""",
+    """CREATE INDEX IF NOT EXISTS stream_traits_by_value
+            ON stream_traits (trait, value)""",
+    """CREATE INDEX IF NOT EXISTS stream_traits_by_stream
+            ON stream_traits (stream_id)""",
+    """CREATE INDEX IF NOT EXISTS streams_by_state
+            ON streams (trigger_name, state, last_update)""",
+    """CREATE INDEX IF NOT EXISTS streams_by_traits
+            ON streams (trigger_name, trait_key, state)""",
+    """CREATE INDEX IF NOT EXISTS streams_ready
+            ON streams (state)""",
+    """CREATE INDEX IF NOT EXISTS streams_by_update
+            ON streams (last_update, stream_id)""",
+    """CREATE INDEX IF NOT EXISTS stream_events_by_stream
+            ON stream_events (stream_id, timestamp)""",
+    """CREATE INDEX IF NOT EXISTS stream_events_by_message
+            ON stream_events (message_id)""",
+]
+
+STREAM_COLUMNS = ("stream_id, trigger_name, state, state_version, "
+                  "last_update, identifying_traits, aggregates")
+
+
+def _trait_key(trait_dict):
+    return json.dumps(trait_dict, sort_keys=True)
+
+
+def _pack(value):
+    return sqlite3.Binary(marshal.dumps(journal.encode(value),
+                                        journal.MARSHAL_VERSION))
+
+
+def _unpack(blob):
+    return journal.decode(marshal.loads(str(blob)))
+
+
+class Stream(pstream.Stream):
+    def __init__(self, uuid, trigger_name, state, last_update,
+                 identifying_traits, driver, state_version=1):
+        super(Stream, self).__init__(uuid, trigger_name, state, last_update,
+                                     identifying_traits)
+        self.driver = driver
+        self.state_version = state_version
+
+    def load_events(self):
+        if self.events is None:
+            self.driver._load_events(self)
+
+
+class SQLiteDriver(db_driver.DBDriver):
+    """Embedded DBDriver for single node deployments and for
+       testing without a database server.
+
+       One connection is shared by all threads and guarded by a
+       lock. The database runs in WAL mode and every add_events()
+       batch is a single transaction.
+    """
+
+    QUERY_PAGE_SIZE = 500  # find_streams() rows read per lock
+
+    def __init__(self, trigger_defs, path="oahu.db"):
+        super(SQLiteDriver, self).__init__(trigger_defs)
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0  # Nested _transaction() calls.
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        self.init_db()
+
+    def init_db(self):
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+            self.conn.commit()
+
+    def _transaction(self):
+        return _Transaction(self)
+
+    def add_event(self, event):
+        with self._transaction():
+            super(SQLiteDriver, self).add_event(event)
+
+    def add_events(self, events):
+        with self._transaction():
+            super(SQLiteDriver, self).add_events(events)
+
+    def save_event(self, message_id, event):
+        self.save_events([(message_id, event)])
+
+    def save_events(self, events):
+        rows = [(message_id, event.get('event_type'), event.get('timestamp'),
+                 _pack(event))
+                for message_id, event in events]
+        with self._transaction():
+            self.conn.executemany("INSERT OR REPLACE INTO events "
+                                  "VALUES (?, ?, ?, ?)", rows)
+
+    def _stored(self, events):
+        message_ids = [message_id for message_id, event in events]
+        stored = set()
+        with self.lock:
+            for x in range(0, len(message_ids), 500):
+                ids = message_ids[x:x + 500]
+                stored.update(row[0] for row in self.conn.execute(
+                                "SELECT message_id FROM events "
+                                "WHERE message_id IN (%s)" %
+                                ", ".join("?" * len(ids)), ids))
+        return stored
+
+    def _appended(self, events):
+        # add_events() is a single transaction, so a stored event
+        # made it into its streams too.
+        return self._stored(events)
+
+    def _mark_appended(self, events):
+        pass
+
+    def _in_streams(self, trigger, trait_dict, message_id):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM stream_events se "
+                "JOIN streams s ON s.stream_id = se.stream_id "
+                "WHERE se.message_id = ? AND s.trigger_name = ? "
+                "AND s.trait_key = ? LIMIT 1",
+                (message_id, trigger.name,
+                 _trait_key(trait_dict))).fetchone() is not None
+
+    def append_event(self, message_id, trigger, event, trait_dict):
+        trait_key = _trait_key(trait_dict)
+        now = self.clock()
+        size = trigger.event_size(event)
+        with self._transaction():
+            row = self.conn.execute(
+                    "SELECT " + STREAM_COLUMNS + ", created, num_events, "
+                    "num_bytes FROM streams "
+                    "WHERE trigger_name = ? AND trait_key = ? AND state = ? "
+                    "LIMIT 1",
+                    (trigger.name, trait_key, pstream.COLLECTING)).fetchone()
+            if row and trigger.capped and trigger.rollover:
+                stream = self._stream_from_row(row[:-3])
+                cap = trigger.cap_hit(row[-2], row[-1], row[-3], now, size)
+                if cap:
+                    self._cap_reached(trigger, stream, cap)
+                    row = None
+
+            cap = None
+            is_new_stream = row is None
+            if is_new_stream:
+                stream = Stream(str(uuid.uuid4()), trigger.name,
+                                pstream.COLLECTING, now, trait_dict, self)
+                reducers.update(trigger.reducers, stream.aggregates, event)
+                self.conn.execute(
+                    "INSERT INTO streams (stream_id, trigger_name, state, "
+                    "state_version, last_update, identifying_traits, "
+                    "trait_key, aggregates, created, num_events, num_bytes) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)",
+                    (stream.uuid, trigger.name, stream.state,
+                     stream.state_version, now, json.dumps(trait_dict),
+                     trait_key, _pack(stream.aggregates), now, size))
+                self.conn.executemany(
+                    "INSERT INTO stream_traits VALUES (?, ?, ?)",
+                    [(stream.uuid, trait, json.dumps(value))
+                     for trait, value in trait_dict.iteritems()])
+                if trigger.capped and not trigger.rollover:
+                    cap = trigger.cap_hit(0, 0, now, now, size)
+            else:
+                stream = self._stream_from_row(row[:-3])
+                stream.last_update = now
+                if trigger.capped and not trigger.rollover:
+                    cap = trigger.cap_hit(row[-2], row[-1], row[-3], now,
+                                          size)
+                if trigger.reducers:
+                    reducers.update(trigger.reducers, stream.aggregates,
+                                    event)
+                    self.conn.execute("UPDATE streams SET last_update = ?, "
+                                      "aggregates = ?, "
+                                      "num_events = num_events + 1, "
+                                      "num_bytes = num_bytes + ? "
+                                      "WHERE stream_id = ?",
+                                      (now, _pack(stream.aggregates), size,
+                                       stream.uuid))
+                else:
+                    self.conn.execute("UPDATE streams SET last_update = ?, "
+                                      "num_events = num_events + 1, "
+                                      "num_bytes = num_bytes + ? "
+                                      "WHERE stream_id = ?",
+                                      (now, size, stream.uuid))
+
+            self.conn.execute("INSERT INTO stream_events VALUES (?, ?, ?)",
+                              (stream.uuid, message_id,
+                               event.get('timestamp')))
+            if cap:
+                self._cap_reached(trigger, stream, cap)
+            else:
+                self._check_for_trigger(trigger, stream, event=event,
+                                        now=now)
+        return is_new_stream
+
+    def do_trigger_check(self, state, chunk, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        num = 0
+        ready = 0
+        pushed = 0
+
+        python_triggers = []
+        with self._transaction():
+            for trigger in self.trigger_defs:
+                pushdown = trigger.get_pushdown(now)
+                if pushdown is None:
+                    python_triggers.append(trigger.name)
+                elif not pushdown.never:
+                    pushed += self._pushdown_trigger_check(trigger, pushdown)
+
+        if python_triggers:
+            with self._transaction():
+                rows = self.conn.execute(
+                    "SELECT " + STREAM_COLUMNS + " FROM streams "
+                    "WHERE state = ? AND trigger_name IN (%s) "
+                    "ORDER BY last_update LIMIT ? OFFSET ?" %
+                        ", ".join("?" * len(python_triggers)),
+                    [pstream.COLLECTING] + python_triggers +
+                        [chunk, state.offset]).fetchall()
+
+                self.begin_transitions()
+                for row in rows:
+                    num += 1
+                    stream = self._stream_from_row(row)
+                    trigger = self.trigger_defs_dict[stream.trigger_name]
+                    if self._check_for_trigger(trigger, stream, now=now):
+                        ready += 1
+                ready -= len(self.flush_transitions())
+
+        print "%s - checked %d (%d ready, %d ready by query) off/lim=%d/%d" % (
+                                now, num, ready, pushed, state.offset, chunk)
+        if num < chunk or chunk < 0:
+            state.offset = 0
+        else:
+            state.offset += num
+
+    def _pushdown_trigger_check(self, trigger, pushdown):
+        sql = ("UPDATE streams SET state = ?, "
+               "state_version = state_version + 1 "
+               "WHERE trigger_name = ? AND state = ?")
+        args = [pstream.READY, trigger.name, pstream.COLLECTING]
+        if pushdown.last_update_before is not None:
+            sql += " AND last_update < ?"
+            args.append(pushdown.last_update_before)
+        n = self.conn.execute(sql, args).rowcount
+        self._get_debugger(trigger.name).criteria_match(n)
+        if n:
+            self._notify_ready()
+        return n
+
+    def purge_processed_streams(self, state, chunk):
+        # Cascade to the stream's rows and to any events that no
+        # other stream refers to.
+        with self._transaction():
+            rows = self.conn.execute("SELECT stream_id, trigger_name "
+                                     "FROM streams WHERE state = ? LIMIT ?",
+                                     (pstream.PROCESSED, chunk)).fetchall()
+            stream_ids = [stream_id for stream_id, _ in rows]
+            for x in range(0, len(stream_ids), 500):
+                ids = stream_ids[x:x + 500]
+                marks = ", ".join("?" * len(ids))
+                message_ids = [row[0] for row in self.conn.execute(
+                                "SELECT message_id FROM stream_events "
+                                "WHERE stream_id IN (%s)" % marks, ids)]
+                self.conn.execute("DELETE FROM stream_events "
+                                  "WHERE stream_id IN (%s)" % marks, ids)
+                self.conn.execute("DELETE FROM stream_traits "
+                                  "WHERE stream_id IN (%s)" % marks, ids)
+                self.conn.execute("DELETE FROM streams "
+                                  "WHERE stream_id IN (%s)" % marks, ids)
+                self.conn.executemany(
+                    "DELETE FROM events WHERE message_id = ? AND NOT EXISTS "
+                    "(SELECT 1 FROM stream_events "
+                    " WHERE stream_events.message_id = events.message_id)",
+                    [(message_id,) for message_id in message_ids])
+        for _, trigger_name in rows:
+            self._get_debugger(trigger_name).purged()
+        print "%s - purged %d" % (datetime.datetime.utcnow(), len(stream_ids))
+
+    def process_ready_streams(self, state, chunk, now):
+        # Claim the streams first, then run the callbacks outside of
+        # any transaction so ingest isn't blocked while they run.
+        with self._transaction():
+            rows = self.conn.execute(
+                    "SELECT " + STREAM_COLUMNS + " FROM streams "
+                    "WHERE state = ? LIMIT ?",
+                    (pstream.READY, chunk)).fetchall()
+            self.begin_transitions()
+            streams = [self._stream_from_row(row) for row in rows]
+            for stream in streams:
+                self.trigger(stream.trigger_name, stream)
+            lost = set(stream.uuid
+                       for trigger_name, stream in self.flush_transitions())
+        locked = len(lost)
+        streams = [s for s in streams if s.uuid not in lost]
+        for stream in streams:
+            if self.trigger_defs_dict[stream.trigger_name].needs_events:
+                stream.load_events()
+
+        self.begin_transitions()
+        for stream in streams:
+            trigger = self.trigger_defs_dict[stream.trigger_name]
+            self._do_pipeline_callbacks(stream, trigger)
+        with self._transaction():
+            conflicts = len(self.flush_transitions())
+
+        print "%s - processed %d/%d (%d locked, %d conflicts)" % (
+                            now, len(streams), chunk, locked, conflicts)
+
+    def trigger(self, trigger_name, stream):
+        self._change_state(trigger_name, stream, pstream.TRIGGERED)
+
+    def ready(self, trigger_name, stream):
+        self._change_state(trigger_name, stream, pstream.READY)
+
+    def processed(self, trigger_name, stream):
+        self._change_state(trigger_name, stream, pstream.PROCESSED)
+
+    def error(self, trigger_name, stream, error):
+        self._change_state(trigger_name, stream, pstream.ERROR, error)
+
+    def commit_error(self, trigger_name, stream, error):
+        self._change_state(trigger_name, stream, pstream.COMMIT_ERROR, error,
+                           commit_error=True)
+
+    def _change_state(self, trigger_name, stream, new_state, error=None,
+                      commit_error=False):
+        if self.transitions is not None:
+            key = (stream.state_version, new_state, error, commit_error)
+            self.transitions.add(key, trigger_name, stream)
+        else:
+            with self._transaction():
+                failed = self._update_states(stream.state_version, new_state,
+                                             error, commit_error,
+                                             [stream.uuid])
+            if failed:
+                self._get_debugger(trigger_name).state_conflict()
+                return
+            if new_state == pstream.READY:
+                self._notify_ready()
+        stream.state = new_state
+        stream.state_version += 1
+
+    def _flush_transitions(self, transitions):
+        failed = []
+        readied = 0
+        with self._transaction():
+            for key, entries in transitions.groups.iteritems():
+                stream_ids = [stream.uuid for trigger_name, stream in entries]
+                lost = set(self._update_states(*key, stream_ids=stream_ids))
+                failed.extend((trigger_name, stream)
+                              for trigger_name, stream in entries
+                              if stream.uuid in lost)
+                if key[1] == pstream.READY:
+                    readied += len(stream_ids) - len(lost)
+        if readied:
+            self._notify_ready()
+        return failed
+
+    def _update_states(self, version, new_state, error, commit_error,
+                       stream_ids):
+        """Compare-and-swap stream_ids from version to new_state.
+           Returns the stream_ids that had moved on. There are no
+           round trips, so one statement per stream (all in the
+           caller's transaction) is cheap and tells us exactly
+           which ones failed.
+        """
+        sql = "UPDATE streams SET state = ?, state_version = state_version + 1"
+        args = [new_state]
+        if error is not None:
+            sql += ", last_error = ?"
+            args.append(error)
+        if commit_error:
+            sql += ", commit_errors = commit_errors + 1"
+        sql += " WHERE stream_id = ? AND state_version = ?"
+
+        return [stream_id for stream_id in stream_ids
+                if not self.conn.execute(sql, args + [stream_id,
+                                                      version]).rowcount]
+
+    def get_num_active_streams(self, trigger_name):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM streams "
+                                     "WHERE trigger_name = ?",
+                                     (trigger_name,)).fetchone()[0]
+
+    def _stream_where(self, query, after):
+        where = []
+        args = []
+        for name, column, op in [('stream_id', 'stream_id', '='),
+                                 ('state', 'state', '='),
+                                 ('trigger_name', 'trigger_name', '='),
+                                 ('older_than', 'last_update', '<'),
+                                 ('younger_than', 'last_update', '>')]:
+            value = getattr(query, name)
+            if value:
+                where.append("%s %s ?" % (column, op))
+                args.append(value)
+        for trait, value in sorted((query.traits or {}).items()):
+            where.append("stream_id IN (SELECT stream_id FROM stream_traits "
+                         "WHERE trait = ? AND value = ?)")
+            args.extend([trait, json.dumps(value)])
+        if after:
+            last_update, stream_id = after
+            where.append("(last_update > ? OR "
+                         "(last_update = ? AND stream_id > ?))")
+            args.extend([last_update, last_update, stream_id])
+        return where, args
+
+    def _find_streams(self, query):
+        # Read a page at a time, keyset style, so the shared
+        # connection is never held while the caller iterates.
+        after = query.after
+        remaining = query.limit
+        while remaining is None or remaining > 0:
+            where, args = self._stream_where(query, after)
+            sql = "SELECT " + STREAM_COLUMNS + " FROM streams"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            size = self.QUERY_PAGE_SIZE
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            sql += " ORDER BY last_update, stream_id LIMIT %d" % size
+            with self.lock:
+                rows = self.conn.execute(sql, args).fetchall()
+
+            for row in rows:
+                if query.fields:
+                    s = self._stream_from_row(row)
+                    yield query.project({
+                                'stream_id': s.uuid,
+                                'trigger_name': s.trigger_name,
+                                'state': s.state,
+                                'last_update': s.last_update,
+                                'identifying_traits': s.identifying_traits})
+                else:
+                    yield self._stream_dict(row, query.details)
+            if len(rows) < size:
+                break
+            after = (rows[-1][4], rows[-1][0])
+
+    def _count_streams(self, query):
+        where, args = self._stream_where(query, query.after)
+        sql = "SELECT 1 FROM streams"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if query.limit:
+            sql += " LIMIT %d" % query.limit
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM (%s)" % sql,
+                                     args).fetchone()[0]
+
+    def flush_all(self):
+        with self._transaction():
+            for table in ['events', 'streams', 'stream_events',
+                          'stream_traits']:
+                self.conn.execute("DELETE FROM %s" % table)
+
+    def _stream_from_row(self, row):
+        (stream_id, trigger_name, state, version, last_update, traits,
+         aggregates) = row
+        stream = Stream(stream_id, trigger_name, state, last_update,
+                        json.loads(traits), self, version)
+        if aggregates is not None:
+            stream.aggregates = _unpack(aggregates)
+        return stream
+
+    def _stream_dict(self, row, details):
+        stream = self._stream_from_row(row)
+        if details:
+            stream.load_events()
+        return stream.to_dict()
+
+    def _load_events(self, stream):
+        with self.lock:
+            rows = self.conn.execute(
+                        "SELECT events.body FROM stream_events "
+                        "JOIN events "
+                        "ON events.message_id = stream_events.message_id "
+                        "WHERE stream_events.stream_id = ? "
+                        "ORDER BY stream_events.timestamp",
+                        (stream.uuid,)).fetchall()
+        stream.set_events([_unpack(row[0]) for row in rows])
+
+
+class _Transaction(object):
+    """Reentrant: only the outermost block commits (or rolls back).
+       Holds the driver lock for its whole duration.
+    """
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        self.driver.lock.acquire()
+        self.driver.depth += 1
+
+    def __exit__(self, exc_type, exc_value, tb):
+        driver = self.driver
+        driver.depth -= 1
+        try:
+            if driver.depth == 0:
+                if exc_type is None:
+                    driver.conn.commit()
+                else:
+                    driver.conn.rollback()
+        finally:
+            driver.lock.release()
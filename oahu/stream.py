@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import abc
+import json
 
 
 COLLECTING = 1
@@ -31,6 +32,22 @@ readable = {COLLECTING: "Collecting",
             COMMIT_ERROR: "Commit Error"}
 
 
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        # Lists and dicts are keyed by their canonical JSON, tagged
+        # so they never collide with a string trait value.
+        return ('json', json.dumps(value, sort_keys=True, default=str))
+
+
+def trait_key(identifying_traits):
+    """A hashable, order-independent key for a trait dict."""
+    return tuple(sorted((trait, _hashable(value))
+                        for trait, value in identifying_traits.items()))
+
+
 class Stream(object):
     # ORM-like object for the Stream. Instances of this class will come
     # and go as the DBDriver needs them.
@@ -48,14 +65,19 @@ class Stream(object):
         self.state = state
         self.identifying_traits = identifying_traits
         self.events = None  # Lazy loaded for stream processing only.
+        self.aggregates = {}  # {name: value} from the trigger's reducers.
 
     def to_dict(self):
-        # TODO(sandy) ... tack on the event particulars.
-        return {'stream_id': self.uuid,
-                'trigger_name': self.trigger_name,
-                'state': readable[self.state],
-                'last_updated': str(self.last_update),
-                'distinquishing_traits': self.identifying_traits}
+        d = {'stream_id': self.uuid,
+             'trigger_name': self.trigger_name,
+             'state': readable[self.state],
+             'last_updated': str(self.last_update),
+             'distinquishing_traits': self.identifying_traits}
+        if self.aggregates:
+            d['aggregates'] = self.aggregates
+        if self.events is not None:
+            d['events'] = self.events
+        return d
 
     def set_events(self, events):
         self.events = events
@@ -13,16 +13,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+
+import criteria as pcriteria
+
 
 class TriggerDefinition(object):
     def __init__(self, name, identifying_trait_names, criteria,
-                 pipeline_callbacks, debug=False, dumper=None):
+                 pipeline_callbacks, debug=False, dumper=None,
+                 cache_events=True, reducers=None, max_events=None,
+                 max_bytes=None, max_age=None, rollover=False):
         self.name = name
         self.identifying_trait_names = identifying_trait_names
-        self.criteria = criteria
+        self.criteria = pcriteria.compile_criteria(criteria)
         self.pipeline_callbacks = pipeline_callbacks
         self.debug = debug  # True/False, debug this TriggerDef?
         self.dumper = dumper  # Which debugging dumper to use if True?
+        # Share loaded events with other triggers' streams? Turn off
+        # for triggers whose events nobody else wants.
+        self.cache_events = cache_events
+        # [reducers.Reducer, ...] maintained in stream.aggregates
+        self.reducers = reducers or []
+        # Caps on a single stream, see cap_hit().
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_age = max_age  # Seconds since the stream was created.
+        self.rollover = rollover
 
     def __str__(self):
         return "<TriggerDef %s>" % self.name
@@ -47,6 +63,55 @@ class TriggerDefinition(object):
                 return False
         return True
 
+    @property
+    def needs_events(self):
+        """False if the callbacks get by on stream.aggregates, so
+           the events needn't be loaded for them.
+        """
+        return any(getattr(callback, 'needs_events', True)
+                   for callback in self.pipeline_callbacks)
+
+    @property
+    def capped(self):
+        return bool(self.max_events or self.max_bytes or self.max_age)
+
+    def event_size(self, event):
+        """Roughly what the event adds to a stream, for max_bytes."""
+        if not self.max_bytes:
+            return 0
+        return len(json.dumps(event, default=str))
+
+    def cap_hit(self, num_events, num_bytes, created, now, size):
+        """Given a stream's counters before an event of size bytes
+           is added, return the name of the cap it hits, or None.
+
+           Without rollover the event is added and the stream is
+           forced READY when it reaches a cap. With rollover the
+           stream is forced READY when the event would take it over
+           a cap, and the event starts a fresh stream instead. So
+           those streams stay within the caps (unless a single event
+           is bigger than max_bytes).
+        """
+        if self.rollover:
+            if self.max_events and num_events + 1 > self.max_events:
+                return "max_events"
+            if self.max_bytes and num_bytes + size > self.max_bytes \
+                    and num_events:
+                return "max_bytes"
+            if self.max_age and created and \
+                    (now - created).total_seconds() > self.max_age:
+                return "max_age"
+            return None
+
+        if self.max_events and num_events + 1 >= self.max_events:
+            return "max_events"
+        if self.max_bytes and num_bytes + size >= self.max_bytes:
+            return "max_bytes"
+        if self.max_age and created and \
+                (now - created).total_seconds() >= self.max_age:
+            return "max_age"
+        return None
+
     def get_identifying_trait_names(self):
         return self.identifying_trait_names
 
@@ -77,3 +142,9 @@ class TriggerDefinition(object):
         """
         return self.criteria.should_fire(stream, last_event, debugger,
                                          now=now)
+
+    def get_pushdown(self, now):
+        """Returns a criteria.Pushdown if the periodic check for
+           this trigger can be done by the storage layer, else None.
+        """
+        return self.criteria.get_pushdown(now)
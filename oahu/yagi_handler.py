@@ -14,7 +14,6 @@
 # limitations under the License.
 
 import datetime
-import dateutil.parser
 
 import yagi.config
 import yagi.handler
@@ -22,7 +21,10 @@ import yagi.log
 import yagi.utils
 
 import oahu.config
-from oahu import mongodb_driver as driver
+from oahu import bloom
+from oahu import distill
+from oahu import ingest
+from oahu import notification
 from oahu import pipeline
 from oahu import pipeline_callback
 
@@ -32,6 +34,10 @@ LOG = yagi.log.logger
 
 class OahuHandler(yagi.handler.BaseHandler):
     """Write the event to the Oaha pipeline.
+
+       [oahu] section options:
+         config_class - oahu Config class, in simport format
+         flush_on_start - wipe the database on startup (default false)
     """
     AUTO_ACK = True
 
@@ -43,42 +49,148 @@ class OahuHandler(yagi.handler.BaseHandler):
         config_simport_location = self.config['config_class']
         self.oahu_config = oahu.config.get_config(config_simport_location)
         self.driver = self.oahu_config.get_driver()
+        distill.configure(self.driver, self.oahu_config)
+        bloom.configure(self.driver, self.oahu_config)
         self.pipeline = pipeline.Pipeline(self.driver)
 
-        # TODO(sandy) - wipe the database every time, for now.
-        self.driver.flush_all()
+        # Wiping the database would throw away whatever a journal
+        # or event log is there to restore, so only on request.
+        if self.config.get('flush_on_start', 'false').lower() == 'true':
+            self.driver.flush_all()
 
         self.last = datetime.datetime.utcnow()
         self.processed = 0
 
     def handle_messages(self, messages, env):
+        events = []
         for event in self.iterate_payloads(messages, env):
-            # TODO(sandy) - we will need to run the raw event
-            # through the distiller and use the reduced set of Traits.
-            # But, until we do, we're going to massage the full notification
-            # to get what we need.
-
-            payload = event['payload']
-
-            when = dateutil.parser.parse(event['timestamp'])
-            audit = when
-            a_beginning = payload.get('audit_period_beginning')
-            if a_beginning:
-                audit = dateutil.parser.parse(a_beginning)
-            event['audit_bucket'] = str(audit.date())
-            event['timestamp'] = when  # force to datetime
-
             try:
-                self.pipeline.add_event(event)
+                events.append(notification.normalize(event))
             except Exception as ex:
-                print ex
-
-            self.processed += 1
-
+                print "Skipping unreadable event:", ex
+
+        # One batch per delivery, so drivers that support it can
+        # store the lot in a single transaction/round trip. If that
+        # fails, one at a time so a bad event only loses itself.
+        try:
+            self.pipeline.add_events(events)
+        except Exception as ex:
+            print "Batch of %d events failed, retrying one by one: %s" % (
+                                len(events), ex)
+            for event in events:
+                try:
+                    self.pipeline.add_events([event])
+                except Exception as ex:
+                    print ex
+
+        self.processed += len(events)
+        self.report()
+
+    def report(self):
         now = datetime.datetime.utcnow()
 
         if (now - self.last).seconds > 10:
             self.last = now
-            print "Added %d events at %s" % (self.processed, now)
+            print "Added %d events at %s, %d duplicates dropped so far" % (
+                                self.processed, now, self.driver.duplicates)
             self.processed = 0
             self.driver.dump_debuggers(criteria_match=False, errors=False)
+
+
+class AsyncOahuHandler(OahuHandler):
+    """Queue the events for a pool of writer threads instead of
+       writing them on the consumer.
+
+       Messages are only acked once their batch has been written,
+       and requeued if the write failed. Messages that can't be
+       normalized are rejected, events without a _unique_id are
+       dropped by the driver (see bad_events). Redelivered events only
+       go to the streams they didn't make it into the first time,
+       see DBDriver.add_events(). When the queue is full
+       handle_messages blocks, which stops consumption until the
+       writers catch up.
+
+       The channel isn't thread-safe, so the writers only report
+       which messages are done and everything is acked here, on
+       the consumer thread: on every delivery and while waiting
+       for room in the queue. Once max_unacked messages are
+       waiting for their write, handle_messages waits for some
+       of them to finish, so the broker's prefetch window never
+       fills up with messages we could have acked. Until the
+       next delivery, at most max_unacked messages stay unacked.
+
+       [oahu] section options:
+         writer_threads - size of the writer pool (default 1). More
+                          than one only if the driver can take
+                          concurrent add_events() for the same
+                          streams, MongoDBDriver can't.
+         queue_size - deliveries held before blocking (default 100)
+         batch_size - events merged into one write (default 500)
+         max_unacked - keep below the prefetch count (default 100)
+    """
+    AUTO_ACK = False
+
+    def __init__(self, app=None, queue_name=None):
+        super(AsyncOahuHandler, self).__init__(app, queue_name)
+        self.queue = ingest.IngestQueue(
+                            self.pipeline,
+                            writers=int(self.config.get('writer_threads', 1)),
+                            max_depth=int(self.config.get('queue_size', 100)),
+                            batch_size=int(self.config.get('batch_size', 500)))
+        self.max_unacked = int(self.config.get('max_unacked', 100))
+        self.unacked = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def handle_messages(self, messages, env):
+        # The writers hand the messages back rather than ack
+        # them, acks are on us.
+        self.ack_completed()
+
+        events = []
+        good = []
+        for message in messages:
+            try:
+                normalized = [notification.normalize(event) for event in
+                              self.iterate_payloads([message], env)]
+            except Exception as ex:
+                # Redelivering it won't help. Dead-lettered, if the
+                # queue has somewhere to send it.
+                print "Rejecting unreadable message:", ex
+                self.rejected += 1
+                message.reject()
+                continue
+            events.extend(normalized)
+            good.append(message)
+        messages = good
+        self.unacked += len(messages)
+        while messages and not self.queue.put(events, messages,
+                                              timeout=0.5):
+            self.ack_completed()  # Queue full, keep acking meanwhile.
+        while self.unacked >= self.max_unacked:
+            self.ack_completed(timeout=0.5)
+
+        self.processed += len(events)
+        self.report()
+
+    def ack_completed(self, timeout=None):
+        # Consumer thread only.
+        for messages, ok in self.queue.completed(timeout):
+            self.unacked -= len(messages)
+            for message in messages:
+                if ok:
+                    message.ack()
+                else:
+                    self.failed += 1
+                    message.requeue()
+
+    def report(self):
+        now = datetime.datetime.utcnow()
+
+        if (now - self.last).seconds > 10:
+            print "%s - queue depth %d, lag %s (max %s), " \
+                  "%d written, %d failed, %d requeued, %d rejected" % (
+                        now, self.queue.depth(), self.queue.lag,
+                        self.queue.reset_max_lag(), self.queue.written,
+                        self.queue.failed, self.failed, self.rejected)
+        super(AsyncOahuHandler, self).report()
@@ -0,0 +1,251 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""MongoDBDriver tests. These need a mongod on localhost."""
+
+import datetime
+import unittest
+import uuid
+
+import mock
+import pymongo
+
+from oahu import criteria
+from oahu import mongodb_driver
+from oahu import pipeline
+from oahu import pipeline_callback
+from oahu import stream
+from oahu import trigger_definition
+
+
+class DoneCallback(pipeline_callback.PipelineCallback):
+    def on_trigger(self, stream, scratchpad):
+        pass
+
+    def commit(self, stream, scratchpad):
+        pass
+
+
+class TestConfig(mongodb_driver._DefaultConfig):
+    def get_mongo_database(self):
+        return "oahu_test"  # flush_all() drops everything in it.
+
+
+class DailyConfig(TestConfig):
+    def get_mongo_event_layout(self):
+        return "daily"
+
+
+class UnacknowledgedConfig(TestConfig):
+    def get_mongo_write_concern(self):
+        return {'w': 0}
+
+
+class FastIngestConfig(TestConfig):
+    def get_mongo_write_concerns(self):
+        return {'ingest': {'w': 0}}
+
+
+class Forgetful(object):
+    """A dedup filter that never remembers, so storage has to."""
+    def add(self, message_id):
+        return False
+
+
+class TestMongoDBDriver(unittest.TestCase):
+    def setUp(self):
+        self.start = datetime.datetime(2014, 5, 1)
+
+    def _driver(self, triggers, conf=None):
+        driver = mongodb_driver.MongoDBDriver(triggers, conf or TestConfig())
+        driver.flush_all()
+        driver.set_clock(lambda: self.start)
+        return driver
+
+    def _trigger(self, name, crit=None, callbacks=None, traits=None):
+        return trigger_definition.TriggerDefinition(
+                        name, traits or ["request_id"],
+                        crit or criteria.Inactive(60), callbacks or [],
+                        debug=True)
+
+    def _add(self, driver, request_id, **extra):
+        event = dict({'_unique_id': str(uuid.uuid4()),
+                      'request_id': request_id,
+                      'timestamp': self.start}, **extra)
+        driver.add_event(event)
+        return event
+
+    def _streams(self, driver, **kwargs):
+        return [driver._stream_from_mongo(doc, False) for doc in
+                driver.tdef_collection.find(kwargs)]
+
+    def test_state_writes_acknowledged(self):
+        self.assertRaises(ValueError, mongodb_driver.MongoDBDriver,
+                          [self._trigger("t")], UnacknowledgedConfig())
+
+    def test_duplicates_detected_with_unacknowledged_ingest(self):
+        driver = self._driver([self._trigger("t")], FastIngestConfig())
+        self.assertEqual({'w': 0}, driver._event_write_concern())
+        driver.set_dedup(Forgetful())
+        self.assertEqual({'w': 1}, driver._event_write_concern())
+        event = self._add(driver, "req")
+        driver.add_event(dict(event))  # Redelivered, after the window.
+        self.assertEqual(1, driver.duplicates)
+        self.assertEqual(1, driver.streams.find().count())
+
+    def test_redelivery_after_failed_append(self):
+        driver = self._driver([self._trigger("first"),
+                               self._trigger("second")])
+        events = [{'_unique_id': str(uuid.uuid4()),
+                   'request_id': "req",
+                   'timestamp': self.start} for x in range(3)]
+
+        append_event = driver.append_event
+        calls = []
+
+        def fail_once(message_id, trigger, event, trait_dict):
+            calls.append(message_id)
+            if len(calls) == 4:  # The second event, second trigger.
+                raise Exception("Boom")
+            return append_event(message_id, trigger, event, trait_dict)
+
+        with mock.patch.object(driver, 'append_event',
+                               side_effect=fail_once):
+            self.assertRaises(Exception, driver.add_events, events)
+        driver.add_events(events)
+        driver.add_events(events)
+
+        self.assertEqual(3, driver.duplicates)
+        for s in self._streams(driver):
+            self.assertEqual(3, driver.streams.find(
+                                        {'stream_id': s.uuid}).count())
+        self.assertEqual(6, driver.streams.find().count())
+
+    def test_transition_conflicts(self):
+        driver = self._driver([self._trigger("t")])
+        for x in range(3):
+            self._add(driver, "req-%d" % x)
+        streams = self._streams(driver)
+
+        # Another worker gets to the first stream before our flush.
+        driver.tdef_collection.update({'stream_id': streams[0].uuid},
+                                      {'$inc': {'state_version': 1}})
+        driver.begin_transitions()
+        for s in streams:
+            driver.ready("t", s)
+        failed = driver.flush_transitions()
+
+        self.assertEqual([streams[0].uuid], [s.uuid for t, s in failed])
+        self.assertEqual(2, driver.count_streams(state=stream.READY))
+        self.assertEqual(1, driver._get_debugger("t")._state_conflicts)
+
+    def test_pushdown_trigger_check(self):
+        driver = self._driver([self._trigger("t")])
+        p = pipeline.Pipeline(driver)
+        for x in range(5):
+            self._add(driver, "req-%d" % x)
+        self._add(driver, "req-0")
+
+        p.do_trigger_check(1000, self.start + datetime.timedelta(seconds=30))
+        self.assertEqual(0, driver.count_streams(state=stream.READY))
+        p.do_trigger_check(1000, self.start + datetime.timedelta(seconds=61))
+        self.assertEqual(5, driver.count_streams(state=stream.READY))
+        self.assertEqual(5, driver._get_debugger("t")._criteria_match)
+        self.assertTrue(all(s.state_version == 2
+                            for s in self._streams(driver)))
+
+    def test_purge_cascade(self):
+        # Both triggers collect the same events.
+        callback = DoneCallback()
+        by_request = self._trigger("by_request", callbacks=[callback])
+        by_instance = self._trigger(
+                        "by_instance", traits=["instance_id"],
+                        crit=criteria.EventType("never"),
+                        callbacks=[callback])
+        driver = self._driver([by_request, by_instance])
+        p = pipeline.Pipeline(driver)
+        events = [self._add(driver, "req-%d" % x, instance_id="i-1",
+                            event_type="compute.instance.update")
+                  for x in range(3)]
+        message_ids = [e['_unique_id'] for e in events]
+
+        later = self.start + datetime.timedelta(seconds=120)
+        p.do_trigger_check(1000, later)
+        p.process_ready_streams(1000, later)
+        p.purge_streams(1000)
+
+        self.assertEqual(0, driver.count_streams(trigger_name="by_request"))
+        self.assertEqual(3, driver.streams.find().count())
+        self.assertEqual(3, driver.events.find().count())
+
+        # Once the last stream referring to them goes, so do the events.
+        s = self._streams(driver, trigger_name="by_instance")[0]
+        driver.processed("by_instance", s)
+        p.purge_streams(1000)
+        self.assertEqual(0, driver.streams.find().count())
+        self.assertEqual(0, driver.events.find(
+                                {'message_id': {'$in': message_ids}}).count())
+        self.assertEqual(1, driver._get_debugger("by_instance")._purged)
+
+    def test_ready_events_coalesced(self):
+        # Streams capped at one event are readied on ingest.
+        trigger = trigger_definition.TriggerDefinition(
+                        "t", ["request_id"], criteria.Inactive(60), [],
+                        max_events=1)
+        driver = self._driver([trigger])
+        before = driver.ready_events.find().count()
+        driver.add_events([{'_unique_id': str(uuid.uuid4()),
+                            'request_id': "req-%d" % x,
+                            'timestamp': self.start}
+                           for x in range(3)])
+        self.assertEqual(3, driver.count_streams(state=stream.READY))
+        self.assertEqual([3], [doc['count'] for doc in
+                               driver.ready_events.find().skip(before)])
+
+    def test_wait_for_ready_retries_tail(self):
+        driver = self._driver([self._trigger("t")])
+        cursor = mock.Mock(alive=True)
+        cursor.next.return_value = {'_id': "next"}
+        dead = mock.Mock(alive=True)
+        dead.next.side_effect = pymongo.errors.OperationFailure("gone")
+        with mock.patch.object(driver, '_tail_ready_events',
+                               side_effect=[dead, cursor]):
+            self.assertTrue(driver.wait_for_ready(5))
+        self.assertEqual("next", driver.last_ready_id)
+
+        driver.ready_cursor = None
+        with mock.patch.object(driver, '_tail_ready_events',
+                               side_effect=[dead, dead]):
+            with mock.patch('time.sleep') as sleep:
+                self.assertFalse(driver.wait_for_ready(5))
+        self.assertEqual(1, sleep.call_count)  # Polls out the rest.
+
+    def test_uncapped_ready_events(self):
+        driver = self._driver([self._trigger("t")])
+        driver.db.drop_collection('ready_events')
+        self.addCleanup(driver.db.drop_collection, 'ready_events')
+        driver.ready_events.insert({'count': 0})  # Plain collection.
+        driver = mongodb_driver.MongoDBDriver([self._trigger("t")],
+                                              TestConfig())
+        self.assertRaises(RuntimeError, driver._notify_ready)
+
+    def test_daily_layout(self):
+        driver = self._driver([self._trigger("t")], DailyConfig())
+        self._add(driver, "req", audit_bucket="2014-05-01")
+        self._add(driver, "req", audit_bucket="2014-05-02")
+        self.assertEqual(["events_20140501", "events_20140502"],
+                         [name for day, name in driver._daily_collections()])
+        s = self._streams(driver)[0]
+        s.load_events()
+        self.assertEqual(2, len(s.events))
@@ -0,0 +1,113 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+import uuid
+
+import mock
+
+from oahu import bloom
+from oahu import criteria
+from oahu import inmemory
+from oahu import trigger_definition
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        f = bloom.ScalableBloomFilter(100, 0.01)
+        keys = [str(uuid.uuid4()) for x in range(1000)]
+        for key in keys:
+            f.add(key)
+        for key in keys:
+            self.assertTrue(key in f)
+        self.assertTrue(len(f.filters) > 1)  # Grew past the capacity.
+
+    def test_false_positive_rate(self):
+        f = bloom.ScalableBloomFilter(1000, 0.01)
+        for x in range(5000):
+            f.add("in-%d" % x)
+        false = sum(1 for x in range(10000) if "out-%d" % x in f)
+        self.assertTrue(false < 200, false)
+
+    def test_window(self):
+        with mock.patch('time.time') as now:
+            now.return_value = 1000
+            f = bloom.WindowedBloomFilter(60)
+            self.assertFalse(f.add("a"))
+            now.return_value = 1070  # Rotated once, still remembered.
+            self.assertTrue("a" in f)
+            self.assertFalse(f.add("b"))
+            now.return_value = 1140  # "a" is forgotten by now.
+            self.assertFalse("a" in f)
+            self.assertTrue("b" in f)
+
+
+class TestDedup(unittest.TestCase):
+    def test_redelivery(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [])
+        driver = inmemory.InMemoryDriver([trigger])
+        driver.set_dedup(bloom.WindowedBloomFilter(60))
+        events = [{'_unique_id': str(uuid.uuid4()),
+                   '_context_request_id': "req",
+                   'timestamp': datetime.datetime.utcnow()}
+                  for x in range(10)]
+        driver.add_events(events)
+        driver.add_events(events[:5] + [events[0]])
+        driver.add_event(events[9])
+
+        self.assertEqual(7, driver.duplicates)
+        streams = driver.shards[0].active_streams["by_request"].values()
+        self.assertEqual(10, len(streams[0].messages))
+
+    def test_redelivery_after_failed_append(self):
+        triggers = [trigger_definition.TriggerDefinition(
+                        name, ["_context_request_id"],
+                        criteria.Inactive(60), [])
+                    for name in ["first", "second"]]
+        driver = inmemory.InMemoryDriver(triggers)
+        driver.set_dedup(bloom.WindowedBloomFilter(60))
+        events = [{'_unique_id': str(uuid.uuid4()),
+                   '_context_request_id': "req",
+                   'timestamp': datetime.datetime.utcnow()}
+                  for x in range(4)]
+
+        append_event = driver.append_event
+        calls = []
+
+        def fail_once(message_id, trigger, event, trait_dict):
+            calls.append(message_id)
+            if len(calls) == 4:  # The second event, second trigger.
+                raise Exception("Boom")
+            return append_event(message_id, trigger, event, trait_dict)
+
+        with mock.patch.object(driver, 'append_event',
+                               side_effect=fail_once):
+            self.assertRaises(Exception, driver.add_events, events)
+
+        # The whole batch comes back, all of it already stored.
+        driver.add_events(events)
+        driver.add_events(events)
+
+        self.assertEqual(4, driver.duplicates)
+        mids = [driver._get_message_id(event) for event in events]
+        streams = [stream for shard in driver.shards
+                          for streams in shard.active_streams.values()
+                          for stream in streams.values()]
+        self.assertEqual(2, len(streams))
+        for stream in streams:
+            self.assertEqual(mids, stream.messages)
@@ -0,0 +1,57 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from oahu import cache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        c = cache.LRUCache(2)
+        c.put('a', 1)
+        c.put('b', 2)
+        self.assertEqual(1, c.get('a'))
+        c.put('c', 3)
+        self.assertEqual(None, c.get('b'))
+        self.assertEqual(1, c.get('a'))
+        self.assertEqual(3, c.get('c'))
+        self.assertEqual(2, len(c))
+        self.assertEqual((3, 1), (c.hits, c.misses))
+
+    def test_discard_only_matching_value(self):
+        c = cache.LRUCache(2)
+        c.put('a', 1)
+        c.discard('a', 2)
+        self.assertEqual(1, c.get('a'))
+        c.discard('a', 1)
+        self.assertEqual(None, c.get('a'))
+
+    def test_disabled(self):
+        c = cache.LRUCache(0)
+        c.put('a', 1)
+        self.assertEqual(0, len(c))
+
+    def test_bounded_by_size(self):
+        c = cache.LRUCache(10, sizeof=len)
+        c.put('a', "12345")
+        c.put('b', "1234")
+        c.put('c', "123")
+        self.assertEqual(None, c.get('a'))
+        self.assertEqual(7, c.size)
+        c.put('d', "12345678901")  # Bigger than the whole cache.
+        self.assertEqual(None, c.get('d'))
+        c.discard('b')
+        self.assertEqual(3, c.size)
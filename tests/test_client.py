@@ -0,0 +1,69 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from oahu import client
+from oahu import config
+from oahu import criteria
+from oahu import inmemory
+from oahu import trigger_definition
+
+
+class ReplayConfig(config.Config):
+    def __init__(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [])
+        self.driver = inmemory.InMemoryDriver([trigger])
+
+    def get_driver(self):
+        return self.driver
+
+    def get_distiller_config(self):
+        return None
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+        path = os.path.join(self.dir, "events.json")
+        with open(path, 'w') as f:
+            for n in range(5):
+                f.write(json.dumps({'_unique_id': "msg-%d" % n,
+                                    '_context_request_id': "req",
+                                    'timestamp': "2014-05-01 12:00:0%d" % n,
+                                    'payload': {}}) + "\n")
+        conf = ReplayConfig()
+        argv = ["pipeline", "replay", "tests.test_client:ReplayConfig", path,
+                "--processes=1", "--batch_size=2"]
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch.object(config, 'get_config',
+                                   return_value=conf):
+                client.main()
+
+        self.assertEqual(1, conf.driver.count_streams(
+                                traits={'_context_request_id': "req"}))
@@ -0,0 +1,54 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from oahu import codec
+
+
+EVENT = {'_unique_id': "1234",
+         'event_type': 'compute.instance.update',
+         'timestamp': datetime.datetime(2014, 1, 2, 3, 4, 5, 6),
+         'payload': {'instance_id': "ins-1",
+                     'launched_at': datetime.datetime(2014, 1, 1),
+                     'name': u"caf\xe9",
+                     'metadata': [{'key': 'a', 'value': 'b'}]}}
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        for spec in ["json", "json+zlib", "json+none"]:
+            blob = codec.Codec(spec).encode(EVENT)
+            self.assertEqual(EVENT, codec.decode(blob))
+
+    def test_lazy_event(self):
+        fields, blob = codec.Codec("json+zlib").split(EVENT)
+        self.assertEqual(['_unique_id', 'event_type', 'timestamp'],
+                         sorted(fields))
+        event = codec.LazyEvent(fields, blob)
+        self.assertEqual("1234", event['_unique_id'])
+        self.assertTrue(event._blob is not None)
+        self.assertEqual("ins-1", event['payload']['instance_id'])
+        self.assertTrue(event._blob is None)
+
+        self.assertEqual(EVENT, codec.LazyEvent(fields, blob))
+        self.assertEqual(EVENT, codec.LazyEvent(fields, blob).copy())
+        self.assertEqual(None, codec.LazyEvent(fields, blob).get('nope'))
+        self.assertRaises(KeyError, lambda: event['nope'])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, codec.Codec, "pickle+zlib")
+        self.assertRaises(ValueError, codec.Codec, "json+bzip")
@@ -0,0 +1,97 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from oahu import criteria
+from oahu import debugging
+
+
+class Stream(object):
+    def __init__(self, last_update):
+        self.last_update = last_update
+
+
+class Exploding(criteria.Criteria):
+    def should_fire(self, stream, last_event, debugger, now=None):
+        raise Exception("Should have short-circuited")
+
+
+class TestCriteria(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.datetime.utcnow()
+        self.old = Stream(self.now - datetime.timedelta(days=2))
+        self.exists = {'event_type': 'compute.instance.exists'}
+
+    def test_inactive_over_a_day(self):
+        debugger = debugging.NoOpTriggerDebugger()
+        self.assertTrue(criteria.Inactive(60).should_fire(
+                                    self.old, None, debugger, self.now))
+
+    def test_compile_flattens_and_orders(self):
+        inactive = criteria.Inactive(60)
+        event_type = criteria.EventType('compute.instance.exists')
+        eod = criteria.EndOfDayExists('compute.instance.exists')
+        tree = criteria.And([eod, criteria.And([inactive,
+                                                criteria.And([event_type])])])
+        compiled = criteria.compile_criteria(tree)
+        self.assertTrue(isinstance(compiled, criteria.And))
+        self.assertEqual([event_type, inactive, eod], compiled.criteria_list)
+
+    def test_compile_double_negation(self):
+        inactive = criteria.Inactive(60)
+        compiled = criteria.compile_criteria(
+                        criteria.Not(criteria.Not(inactive)))
+        self.assertTrue(compiled is inactive)
+
+    def test_and_short_circuits(self):
+        tree = criteria.compile_criteria(criteria.And([
+                    Exploding(), criteria.EventType('compute.instance.update')]))
+        debugger = debugging.TriggerDebugger("test")
+        self.assertFalse(tree.should_fire(self.old, self.exists, debugger,
+                                          self.now))
+        self.assertEqual({'wrong event type': 1}, debugger._reasons)
+        self.assertEqual(0, debugger._criteria_match)
+
+    def test_or_and_not(self):
+        debugger = debugging.TriggerDebugger("test")
+        tree = criteria.Or([criteria.EventType('compute.instance.update'),
+                            criteria.Not(criteria.Inactive(60))])
+        self.assertFalse(tree.should_fire(self.old, self.exists, debugger,
+                                          self.now))
+        self.assertEqual({'OR failed (wrong event type, NOT failed)': 1},
+                         debugger._reasons)
+
+        tree = criteria.Or([criteria.Inactive(60), Exploding()])
+        self.assertTrue(tree.should_fire(self.old, None, debugger, self.now))
+        self.assertEqual(1, debugger._criteria_match)
+
+    def test_pushdown(self):
+        tree = criteria.compile_criteria(criteria.And([
+                    criteria.Inactive(60), criteria.Inactive(120)]))
+        pushdown = tree.get_pushdown(self.now)
+        self.assertEqual(self.now - datetime.timedelta(seconds=120),
+                         pushdown.last_update_before)
+
+        tree = criteria.Or([criteria.Inactive(60),
+                            criteria.EventType('compute.instance.exists')])
+        pushdown = tree.get_pushdown(self.now)
+        self.assertEqual(self.now - datetime.timedelta(seconds=60),
+                         pushdown.last_update_before)
+
+        tree = criteria.And([criteria.Inactive(60),
+                             criteria.EndOfDayExists('x')])
+        self.assertEqual(None, tree.get_pushdown(self.now))
@@ -0,0 +1,68 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+
+from oahu import criteria
+from oahu import distill
+from oahu import inmemory
+from oahu import trigger_definition
+
+
+NOW = datetime.datetime.utcnow()
+
+EVENT = {'_unique_id': "1234",
+         'event_type': 'compute.instance.exists',
+         'timestamp': NOW,
+         '_context_request_id': "req-1",
+         '_context_project_id': "tenant-1",
+         'payload': {'instance_id': "ins-1",
+                     'audit_period_beginning': "2014-01-01 00:00:00",
+                     'image_meta': {'big': "x" * 1000}}}
+
+
+class TestDistiller(unittest.TestCase):
+    def test_distill(self):
+        d = distill.Distiller({
+                'instance_id': 'payload/instance_id',
+                'tenant_id': ['payload/tenant_id', '_context_project_id'],
+                'payload/audit_period_beginning':
+                                    'payload/audit_period_beginning',
+                'missing': 'payload/nope'})
+        self.assertEqual({'_unique_id': "1234",
+                          'event_type': 'compute.instance.exists',
+                          'timestamp': NOW,
+                          'instance_id': "ins-1",
+                          'tenant_id': "tenant-1",
+                          'payload': {'audit_period_beginning':
+                                      "2014-01-01 00:00:00"}},
+                         d.distill(EVENT))
+
+    def test_driver_stores_distilled(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_instance", ["instance_id"],
+                        criteria.Inactive(60), [])
+        driver = inmemory.InMemoryDriver([trigger])
+        driver.set_distiller(distill.Distiller(
+                                {'instance_id': 'payload/instance_id'}))
+        driver.add_events([EVENT])
+        self.assertEqual({'_unique_id': "1234",
+                          'event_type': 'compute.instance.exists',
+                          'timestamp': NOW,
+                          'instance_id': "ins-1"},
+                         driver.raw_events["1234"])
+        self.assertEqual(1, driver.count_streams(
+                                traits={'instance_id': "ins-1"}))
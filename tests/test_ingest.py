@@ -0,0 +1,107 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+
+from oahu import ingest
+
+
+class FakePipeline(object):
+    def __init__(self):
+        self.writes = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def add_events(self, events):
+        self.gate.wait()
+        if any(event.get('bad') for event in events):
+            raise Exception("boom")
+        self.writes.append(list(events))
+
+
+class TestIngestQueue(unittest.TestCase):
+    def test_batches_and_acks(self):
+        pipeline = FakePipeline()
+        pipeline.gate.clear()  # Hold the writer so the queue fills up.
+        queue = ingest.IngestQueue(pipeline, writers=1, max_depth=10,
+                                   batch_size=4)
+        for x in range(6):
+            queue.put([{'n': x}], x)
+        pipeline.gate.set()
+        queue.stop()
+
+        self.assertEqual(6, queue.written)
+        self.assertTrue(len(pipeline.writes) < 6)  # Merged writes.
+        self.assertEqual(range(6), sorted(t for t, ok in queue.completed()))
+        self.assertEqual([], queue.completed())
+
+    def test_failed_writes_are_not_acked(self):
+        queue = ingest.IngestQueue(FakePipeline())
+        queue.put([{'bad': True}], 'a')
+        queue.stop()
+        self.assertEqual([('a', False)], queue.completed())
+        self.assertEqual(1, queue.failed)
+
+    def test_backpressure(self):
+        pipeline = FakePipeline()
+        pipeline.gate.clear()
+        queue = ingest.IngestQueue(pipeline, max_depth=1, batch_size=1)
+        queue.put([{}])  # Taken by the writer, which then blocks.
+        queue.put([{}])  # Fills the queue, eventually.
+
+        done = threading.Event()
+
+        def put():
+            queue.put([{}])
+            done.set()
+        threading.Thread(target=put).start()
+
+        self.assertFalse(done.wait(0.5))
+        pipeline.gate.set()
+        self.assertTrue(done.wait(5))
+        queue.stop()
+        self.assertEqual(3, queue.written)
+
+    def test_put_timeout(self):
+        pipeline = FakePipeline()
+        pipeline.gate.clear()
+        queue = ingest.IngestQueue(pipeline, max_depth=1, batch_size=1)
+        queue.put([{}], 'a')  # Taken by the writer, which then blocks.
+        queue.put([{}], 'b')
+        self.assertFalse(queue.put([{}], 'c', timeout=0.1))
+
+        pipeline.gate.set()
+        done = queue.completed(timeout=5)
+        self.assertEqual(('a', True), done[0])
+        self.assertTrue(queue.put([{}], 'c', timeout=5))
+        queue.stop()
+        done.extend(queue.completed())
+        self.assertEqual(['a', 'b', 'c'], sorted(t for t, ok in done))
+
+    def test_failed_merge_is_split(self):
+        pipeline = FakePipeline()
+        pipeline.gate.clear()
+        queue = ingest.IngestQueue(pipeline, max_depth=10, batch_size=10)
+        queue.put([{}], 'first')  # Taken alone, the writer blocks.
+        queue.put([{'n': 1}], 'a')
+        queue.put([{'bad': True}], 'b')
+        queue.put([{'n': 2}], 'c')
+        pipeline.gate.set()
+        queue.stop()
+
+        self.assertEqual([('a', True), ('b', False), ('c', True),
+                          ('first', True)], sorted(queue.completed()))
+        self.assertEqual(3, queue.written)
+        self.assertEqual(1, queue.failed)
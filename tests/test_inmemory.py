@@ -0,0 +1,365 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import shutil
+import tempfile
+import threading
+import unittest
+import uuid
+
+import dateutil.tz
+
+from oahu import criteria
+from oahu import db_driver
+from oahu import inmemory
+from oahu import journal
+from oahu import pipeline
+from oahu import pipeline_callback
+from oahu import stream
+from oahu import trigger_definition
+
+
+class CollectingCallback(pipeline_callback.PipelineCallback):
+    def __init__(self):
+        super(CollectingCallback, self).__init__()
+        self.lock = threading.Lock()
+        self.message_ids = []
+
+    def on_trigger(self, stream, scratchpad):
+        with self.lock:
+            self.message_ids.extend(e['_unique_id'] for e in stream.events)
+
+    def commit(self, stream, scratchpad):
+        pass
+
+
+class TestShardedInMemoryDriver(unittest.TestCase):
+    def test_concurrent_ingest_and_processing(self):
+        num_threads = 8
+        requests_per_thread = 50
+        events_per_request = 20
+
+        callback = CollectingCallback()
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(0), [callback])
+        driver = inmemory.InMemoryDriver([trigger], num_shards=4)
+        p = pipeline.Pipeline(driver)
+
+        added = []
+        added_lock = threading.Lock()
+        done = threading.Event()
+
+        def ingest():
+            requests = [str(uuid.uuid4()) for x in range(requests_per_thread)]
+            mine = []
+            for x in range(events_per_request):
+                for request_id in requests:
+                    event = {'_unique_id': str(uuid.uuid4()),
+                             '_context_request_id': request_id,
+                             'event_type': 'compute.instance.update',
+                             'timestamp': datetime.datetime.utcnow()}
+                    p.add_event(event)
+                    mine.append(event['_unique_id'])
+            with added_lock:
+                added.extend(mine)
+
+        def process():
+            # Periodic passes racing the ingest threads.
+            while not done.is_set():
+                now = datetime.datetime.utcnow()
+                p.do_trigger_check(-1, now)
+                p.process_ready_streams(-1, now)
+                p.purge_streams(-1)
+
+        threads = [threading.Thread(target=ingest)
+                   for x in range(num_threads)]
+        processors = [threading.Thread(target=process) for x in range(2)]
+        for t in threads + processors:
+            t.start()
+        for t in threads:
+            t.join()
+        done.set()
+        for t in processors:
+            t.join()
+
+        later = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        p.do_trigger_check(-1, later)
+        p.process_ready_streams(-1, later)
+        p.purge_streams(-1)
+
+        total = num_threads * requests_per_thread * events_per_request
+        self.assertEqual(total, len(added))
+        self.assertEqual(total, len(callback.message_ids))
+        self.assertEqual(set(added), set(callback.message_ids))
+        self.assertEqual(0, driver.get_num_active_streams("by_request"))
+
+
+class TestBadEvents(unittest.TestCase):
+    def test_dropped_from_batch(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [])
+        driver = inmemory.InMemoryDriver([trigger])
+        events = [{'_unique_id': str(uuid.uuid4()),
+                   '_context_request_id': "req",
+                   'timestamp': datetime.datetime.utcnow()}
+                  for x in range(3)]
+        driver.add_events(events[:1] + [{'_context_request_id': "req"}] +
+                          events[1:])
+
+        self.assertEqual(1, driver.bad_events)
+        self.assertEqual(3, len(driver.raw_events))
+        self.assertRaises(db_driver.BadEvent, driver.add_event, {})
+
+
+class TestUnhashableTraits(unittest.TestCase):
+    def test_list_trait_values(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_tags", ["tags"], criteria.Inactive(60), [])
+        driver = inmemory.InMemoryDriver([trigger], num_shards=4)
+        for tags in [["a", "b"], ["a", "b"], ["b"], "[\"b\"]"]:
+            driver.add_event({'_unique_id': str(uuid.uuid4()),
+                              'tags': tags,
+                              'timestamp': datetime.datetime.utcnow()})
+
+        self.assertEqual(3, driver.count_streams())
+        s = next(driver.find_streams(traits={'tags': ["a", "b"]},
+                                     details=True))
+        self.assertEqual(2, len(s['events']))
+        self.assertEqual(1, driver.count_streams(traits={'tags': ["b"]}))
+
+
+class TestSlotTriggerCheck(unittest.TestCase):
+    def test_pushdown_check(self):
+        triggers = [trigger_definition.TriggerDefinition(
+                        "inactive", ["request_id"],
+                        criteria.Inactive(60), []),
+                    trigger_definition.TriggerDefinition(
+                        "both", ["request_id"],
+                        criteria.And([criteria.Inactive(60),
+                                      criteria.Inactive(120)]), [])]
+        driver = inmemory.InMemoryDriver(triggers, num_shards=2)
+        start = datetime.datetime(2014, 5, 1)
+        clock = [start]
+        driver.set_clock(lambda: clock[0])
+        for x in range(10):
+            clock[0] = start + datetime.timedelta(seconds=x * 30)
+            driver.add_event({'_unique_id': str(uuid.uuid4()),
+                              'request_id': "req-%d" % x})
+
+        # Idle for 300, 270, ... 30 seconds.
+        now = start + datetime.timedelta(seconds=300)
+        driver.do_trigger_check(None, -1, now)
+        for name, ready in [("inactive", 8), ("both", 6)]:
+            self.assertEqual(ready, driver.count_streams(
+                                trigger_name=name, state=stream.READY))
+
+        # Purged slots are reused by new streams.
+        for s in driver.find_streams(state=stream.READY):
+            driver.processed(s['trigger_name'],
+                             driver._find_stream(s['trigger_name'],
+                                                 s['stream_id']))
+        driver.purge_processed_streams(None, -1)
+        clock[0] = now
+        driver.add_event({'_unique_id': str(uuid.uuid4()),
+                          'request_id': "req-new"})
+        slots = [shard.slots["inactive"] for shard in driver.shards]
+        self.assertEqual(10, sum(len(s.streams) for s in slots))
+        driver.do_trigger_check(None, -1, now)
+        self.assertEqual(3, driver.count_streams(trigger_name="inactive"))
+        self.assertEqual(0, driver.count_streams(state=stream.READY))
+
+
+class TestStreamCaps(unittest.TestCase):
+    def _run(self, **caps):
+        trigger = trigger_definition.TriggerDefinition(
+                        "capped", ["request_id"], criteria.Inactive(600),
+                        [], debug=True, **caps)
+        driver = inmemory.InMemoryDriver([trigger])
+        start = datetime.datetime(2014, 5, 1)
+        clock = [start]
+        driver.set_clock(lambda: clock[0])
+        for x in range(10):
+            clock[0] = start + datetime.timedelta(seconds=x * 10)
+            driver.add_event({'_unique_id': "msg-%d" % x,
+                              'request_id': "req"})
+        sizes = sorted((s['state'], len(s['events']))
+                       for s in driver.find_streams(details=True))
+        return sizes, driver._get_debugger("capped")._cap_hits
+
+    def test_max_events(self):
+        sizes, hits = self._run(max_events=4)
+        self.assertEqual([("Collecting", 2), ("Ready", 4), ("Ready", 4)],
+                         sizes)
+        self.assertEqual({'max_events': 2}, hits)
+
+    def test_max_age(self):
+        # Without rollover the event that reaches the cap is kept ...
+        sizes, hits = self._run(max_age=25)
+        self.assertEqual([("Collecting", 2), ("Ready", 4), ("Ready", 4)],
+                         sizes)
+        # ... with rollover it starts the next stream.
+        sizes, hits = self._run(max_age=25, rollover=True)
+        self.assertEqual([("Collecting", 1), ("Ready", 3), ("Ready", 3),
+                          ("Ready", 3)], sizes)
+        self.assertEqual({'max_age': 3}, hits)
+
+    def test_max_bytes_rollover(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "capped", ["request_id"], criteria.Inactive(600),
+                        [], max_bytes=100, rollover=True)
+        size = trigger.event_size({'_unique_id': "msg-0",
+                                   'request_id': "req"})
+        sizes, hits = self._run(max_bytes=size * 3, rollover=True)
+        self.assertEqual([("Collecting", 1), ("Ready", 3), ("Ready", 3),
+                          ("Ready", 3)], sizes)
+        self.assertEqual({'max_bytes': 3}, hits)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _state(self, driver):
+        return sorted((s.sid, s.state, list(s.messages), s.last_update)
+                      for shard in driver.shards
+                      for streams in shard.active_streams.values()
+                      for s in streams.values())
+
+    def test_restore_snapshot_and_wal(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [])
+        driver = inmemory.InMemoryDriver([trigger], num_shards=4,
+                                         journal=journal.Journal(
+                                                        self.directory))
+        now = datetime.datetime.utcnow()
+        for x in range(40):
+            if x == 20:
+                driver.snapshot()
+            driver.add_event({'_unique_id': str(uuid.uuid4()),
+                              '_context_request_id': "req-%d" % (x % 8),
+                              'timestamp': now})
+        driver.do_trigger_check(None, -1, now + datetime.timedelta(days=1))
+        driver.journal.close()
+
+        restored = inmemory.InMemoryDriver([trigger], num_shards=2,
+                                           journal=journal.Journal(
+                                                        self.directory))
+        self.assertEqual(self._state(driver), self._state(restored))
+        self.assertEqual(driver.raw_events, restored.raw_events)
+
+    def test_bad_record_leaves_wal_intact(self):
+        j = journal.Journal(self.directory)
+        j.restore(lambda record: None)
+        j.log(('purge', "t", "a"))
+        self.assertRaises(ValueError, j.log, ('purge', "t", object()))
+        j.log(('purge', "t", "b"))
+        j.close()
+
+        records = []
+        journal.Journal(self.directory).restore(records.append)
+        self.assertEqual([('purge', "t", "a"), ('purge', "t", "b")],
+                         records)
+
+    def test_aware_datetimes_stored_as_utc(self):
+        when = datetime.datetime(2014, 5, 1, 12, tzinfo=dateutil.tz.tzoffset(
+                                                            None, 3600))
+        self.assertEqual(datetime.datetime(2014, 5, 1, 11),
+                         journal.decode(journal.encode(when)))
+
+
+class TestFindStreams(unittest.TestCase):
+    def setUp(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [])
+        self.driver = inmemory.InMemoryDriver([trigger], num_shards=4)
+        now = datetime.datetime.utcnow()
+        for x in range(10):
+            self.driver.add_event({'_unique_id': str(uuid.uuid4()),
+                                   '_context_request_id': "req-%d" % x,
+                                   'timestamp': now})
+        streams = [s for shard in self.driver.shards
+                   for by_id in shard.active_streams.values()
+                   for s in by_id.values()]
+        for s in streams[:4]:
+            self.driver.ready("by_request", s)
+
+    def test_filters(self):
+        self.assertEqual(10, self.driver.count_streams())
+        self.assertEqual(4, self.driver.count_streams(state=stream.READY))
+        self.assertEqual(6, self.driver.count_streams(
+                                trigger_name="by_request",
+                                state=stream.COLLECTING))
+        self.assertEqual(3, self.driver.count_streams(limit=3))
+        self.assertEqual(0, self.driver.count_streams(trigger_name="nope"))
+
+    def test_fields_and_pages(self):
+        seen = []
+        after = None
+        while True:
+            page = list(self.driver.find_streams(
+                            fields=['stream_id', 'last_update'],
+                            limit=3, after=after))
+            if not page:
+                break
+            for s in page:
+                self.assertEqual(['last_update', 'stream_id'], sorted(s))
+            seen.extend(s['stream_id'] for s in page)
+            after = (page[-1]['last_update'], page[-1]['stream_id'])
+        self.assertEqual(10, len(set(seen)))
+        self.assertEqual(10, len(seen))
+
+    def test_get_stream(self):
+        s = next(self.driver.find_streams(state=stream.READY))
+        found = self.driver.get_stream(s['stream_id'], details=True)
+        self.assertEqual(1, len(found))
+        self.assertEqual("Ready", found[0]['state'])
+        self.assertEqual(1, len(found[0]['events']))
+        self.assertRaises(ValueError, self.driver.find_streams,
+                          fields=['bogus'])
+
+    def test_traits_across_triggers(self):
+        triggers = [trigger_definition.TriggerDefinition(
+                        name, traits, criteria.Inactive(60), [])
+                    for name, traits in [
+                        ("by_instance", ["instance_id"]),
+                        ("by_request", ["instance_id",
+                                        "_context_request_id"])]]
+        driver = inmemory.InMemoryDriver(triggers, num_shards=4)
+        for x in range(12):
+            driver.add_event({'_unique_id': str(uuid.uuid4()),
+                              'instance_id': "ins-%d" % (x % 3),
+                              '_context_request_id': "req-%d" % x,
+                              'timestamp': datetime.datetime.utcnow()})
+        self.assertEqual(5, driver.count_streams(
+                                traits={'instance_id': "ins-1"}))
+        self.assertEqual(1, driver.count_streams(
+                                traits={'instance_id': "ins-1",
+                                        '_context_request_id': "req-4"}))
+        self.assertEqual(0, driver.count_streams(
+                                traits={'instance_id': "ins-1",
+                                        '_context_request_id': "req-5"}))
+        found = list(driver.find_streams(traits={'instance_id': "ins-2"},
+                                         trigger_name="by_instance",
+                                         fields=['identifying_traits']))
+        self.assertEqual([{'identifying_traits': {'instance_id': "ins-2"}}],
+                         found)
@@ -0,0 +1,89 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import mock
+
+from oahu import criteria
+from oahu import logfile_driver
+from oahu import trigger_definition
+
+
+class TestLogFileDriver(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.trigger = trigger_definition.TriggerDefinition(
+                            "by_request", ["_context_request_id"],
+                            criteria.Inactive(60), [])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _driver(self):
+        return logfile_driver.LogFileDriver([self.trigger], self.directory,
+                                            num_shards=2, segment_size=2048)
+
+    def test_restart_and_compact(self):
+        driver = self._driver()
+        now = datetime.datetime.utcnow()
+        events = [{'_unique_id': str(uuid.uuid4()),
+                   '_context_request_id': "req-%d" % (x % 5),
+                   'timestamp': now + datetime.timedelta(seconds=x),
+                   'payload': {'x': x}} for x in range(100)]
+        driver.add_events(events)
+        driver.journal.close()
+
+        driver = self._driver()
+        self.assertEqual(100, len(driver.event_index))
+        self.assertEqual(5, driver.get_num_active_streams("by_request"))
+        found = next(driver.find_streams(
+                        traits={'_context_request_id': "req-0"},
+                        fields=['stream_id']))
+        stream = driver._find_stream("by_request", found['stream_id'])
+        loaded = driver._get_events(stream.messages)
+        self.assertEqual(20, len(loaded))
+        self.assertEqual(stream.messages, [e['_unique_id'] for e in loaded])
+        self.assertTrue(isinstance(loaded[0]['timestamp'],
+                                   datetime.datetime))
+
+        later = now + datetime.timedelta(days=1)
+        driver.do_trigger_check(None, -1, later)
+        driver.process_ready_streams(None, -1, later)
+        driver.purge_processed_streams(None, -1)
+        for segment in driver.segments.values():
+            if segment.sealed_at:
+                segment.sealed_at -= 3600
+        driver.compact()
+        self.assertEqual(0, driver.get_num_active_streams("by_request"))
+        self.assertEqual({}, driver.event_index)
+
+    def test_sync(self):
+        events = [{'_unique_id': str(uuid.uuid4()),
+                   '_context_request_id': "req",
+                   'timestamp': datetime.datetime.utcnow()}]
+        for sync, expected in [(True, 2), (False, 0)]:
+            driver = logfile_driver.LogFileDriver(
+                            [self.trigger], self.directory, sync=sync)
+            with mock.patch('os.fsync') as fsync:
+                driver.add_events(events)
+            # The event segment and the stream journal.
+            self.assertEqual(expected, fsync.call_count)
+            driver.flush_all()
+            driver.journal.close()
@@ -0,0 +1,42 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+from oahu import partition
+
+
+class TestHashRing(unittest.TestCase):
+    def test_ranges_cover_ring_once(self):
+        members = ["worker-%d" % x for x in range(5)]
+        ring = partition.HashRing(members)
+        total = 0
+        for member in members:
+            ranges = ring.get_ranges(member)
+            total += sum(end - start for start, end in ranges)
+            for x in range(500):
+                h = random.randrange(partition.RING_SIZE)
+                in_range = any(start <= h < end for start, end in ranges)
+                self.assertEqual(ring.owner(h) == member, in_range)
+        self.assertEqual(partition.RING_SIZE, total)
+
+    def test_join_only_moves_keys_to_new_member(self):
+        before = partition.HashRing(["a", "b", "c"])
+        after = partition.HashRing(["a", "b", "c", "d"])
+        for x in range(2000):
+            h = random.randrange(partition.RING_SIZE)
+            if after.owner(h) != "d":
+                self.assertEqual(before.owner(h), after.owner(h))
@@ -0,0 +1,136 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from oahu import criteria
+from oahu import inmemory
+from oahu import journal
+from oahu import pipeline
+from oahu import pipeline_callback
+from oahu import reducers
+from oahu import trigger_definition
+
+
+REDUCERS = [reducers.Count('events'),
+            reducers.Count('exists', event_type='compute.instance.exists'),
+            reducers.Sum('disk', 'payload/disk_gb'),
+            reducers.Min('first', 'timestamp'),
+            reducers.Max('last', 'timestamp')]
+
+
+class AggregatesCallback(pipeline_callback.PipelineCallback):
+    needs_events = False
+
+    def __init__(self):
+        self.streams = []
+
+    def on_trigger(self, stream, scratchpad):
+        events = stream.events
+        stream.load_events()  # Still possible, on demand.
+        self.streams.append((events, stream.aggregates, stream.events))
+
+    def commit(self, stream, scratchpad):
+        pass
+
+
+def make_events(now):
+    return [{'_unique_id': str(uuid.uuid4()),
+             '_context_request_id': "req",
+             'event_type': 'compute.instance.update',
+             'payload': {'disk_gb': x},
+             'timestamp': now + datetime.timedelta(seconds=x)}
+            for x in range(1, 5)] + \
+           [{'_unique_id': str(uuid.uuid4()),
+             '_context_request_id': "req",
+             'event_type': 'compute.instance.exists',
+             'payload': {},
+             'timestamp': now}]
+
+
+class TestReducers(unittest.TestCase):
+    def test_update(self):
+        now = datetime.datetime.utcnow()
+        aggregates = {}
+        for event in make_events(now):
+            reducers.update(REDUCERS, aggregates, event)
+        self.assertEqual({'events': 5, 'exists': 1, 'disk': 10,
+                          'first': now,
+                          'last': now + datetime.timedelta(seconds=4)},
+                         aggregates)
+
+    def test_mongo_update(self):
+        now = datetime.datetime.utcnow()
+        ops = reducers.mongo_update(REDUCERS, make_events(now)[-1])
+        self.assertEqual({'$inc': {'aggregates.events': 1,
+                                   'aggregates.exists': 1},
+                          '$min': {'aggregates.first': now},
+                          '$max': {'aggregates.last': now}}, ops)
+
+    def test_bad_name(self):
+        self.assertRaises(ValueError, reducers.Count, 'a.b')
+
+    def test_path_required(self):
+        for reducer in [reducers.Sum, reducers.Min, reducers.Max]:
+            self.assertRaises(ValueError, reducer, 'total')
+
+    def test_callbacks_without_events(self):
+        callback = AggregatesCallback()
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [callback],
+                        reducers=REDUCERS)
+        driver = inmemory.InMemoryDriver([trigger])
+        p = pipeline.Pipeline(driver)
+        now = datetime.datetime.utcnow()
+        events = make_events(now)
+        for event in events:
+            p.add_event(event)
+        later = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+        p.do_trigger_check(-1, later)
+        p.process_ready_streams(-1, later)
+
+        self.assertEqual(1, len(callback.streams))
+        before, aggregates, loaded = callback.streams[0]
+        self.assertEqual(None, before)
+        self.assertEqual(events, loaded)
+        self.assertEqual(5, aggregates['events'])
+        self.assertEqual(10, aggregates['disk'])
+
+    def test_rebuilt_from_journal(self):
+        directory = tempfile.mkdtemp()
+        try:
+            trigger = trigger_definition.TriggerDefinition(
+                            "by_request", ["_context_request_id"],
+                            criteria.Inactive(60), [], reducers=REDUCERS)
+            driver = inmemory.InMemoryDriver(
+                            [trigger], journal=journal.Journal(directory))
+            for x, event in enumerate(make_events(datetime.datetime.utcnow())):
+                if x == 2:
+                    driver.snapshot()
+                driver.add_event(event)
+            driver.journal.close()
+
+            restored = inmemory.InMemoryDriver(
+                            [trigger], journal=journal.Journal(directory))
+            self.assertEqual(
+                list(driver.find_streams())[0]['aggregates'],
+                list(restored.find_streams())[0]['aggregates'])
+        finally:
+            shutil.rmtree(directory)
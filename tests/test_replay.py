@@ -0,0 +1,130 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from oahu import criteria
+from oahu import inmemory
+from oahu import pipeline
+from oahu import replay
+from oahu import sqlite_driver
+from oahu import stream
+from oahu import trigger_definition
+
+
+class CheckedInPython(criteria.Inactive):
+    def get_pushdown(self, now):
+        return None
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _archive(self, name, events):
+        path = os.path.join(self.dir, name)
+        with gzip.open(path, 'wb') as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+        return path
+
+    def test_replay_in_event_time(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [])
+        driver = inmemory.InMemoryDriver([trigger])
+        start = datetime.datetime(2014, 5, 1, 12, 0, 0)
+
+        def event(n, request, seconds):
+            when = start + datetime.timedelta(seconds=seconds)
+            return {'_unique_id': "msg-%d" % n,
+                    '_context_request_id': request,
+                    'timestamp': str(when),
+                    'payload': {'audit_period_beginning': "2014-04-30"}}
+
+        # req-1 goes quiet at once; req-2 keeps going for 10 minutes.
+        first = [event(0, "req-1", 0)] + \
+                [event(n, "req-2", n * 10) for n in range(1, 31)]
+        second = [event(n, "req-2", n * 10) for n in range(31, 61)]
+        paths = [self._archive("a.json.gz", first),
+                 self._archive("b.json.gz", second)]
+
+        total = replay.replay(pipeline.Pipeline(driver), paths,
+                              batch_size=10, processes=2, check_interval=60)
+        self.assertEqual(61, total)
+
+        def count(request, state):
+            return driver.count_streams(
+                    traits={'_context_request_id': request}, state=state)
+
+        # Only req-1 was inactive for a minute of event time.
+        self.assertEqual(0, count("req-1", stream.COLLECTING))
+        self.assertEqual(1, count("req-2", stream.COLLECTING))
+        s = next(driver.find_streams(
+                    traits={'_context_request_id': "req-2"}))
+        self.assertEqual(str(start + datetime.timedelta(seconds=600)),
+                         s['last_updated'])
+
+    def test_decode(self):
+        events = replay.decode([json.dumps({
+                    'timestamp': "2014-05-01 12:00:00",
+                    'payload': {}})])
+        self.assertEqual(datetime.datetime(2014, 5, 1, 12),
+                         events[0]['timestamp'])
+        self.assertEqual("2014-05-01", events[0]['audit_bucket'])
+
+    def test_final_check_covers_every_stream(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        CheckedInPython(60), [])
+        driver = sqlite_driver.SQLiteDriver(
+                        [trigger], path=os.path.join(self.dir, "oahu.db"))
+        events = [{'_unique_id': "msg-%d" % n,
+                   '_context_request_id': "req-%d" % n,
+                   'timestamp': "2014-05-01 12:00:0%d" % n,
+                   'payload': {}} for n in range(5)]
+        events.append({'_unique_id': "last",
+                       '_context_request_id': "req-last",
+                       'timestamp': "2014-05-01 12:05:00",
+                       'payload': {}})
+        path = self._archive("a.json.gz", events)
+
+        replay.replay(pipeline.Pipeline(driver), [path], batch_size=1,
+                      processes=1, check_interval=3600, chunk=1)
+
+        # A chunk of 1 would have left all but one of these.
+        self.assertEqual(1, driver.count_streams(state=stream.COLLECTING))
+        self.assertEqual(0, driver.count_streams(state=stream.READY))
+
+    def test_bad_archive(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "by_request", ["_context_request_id"],
+                        criteria.Inactive(60), [])
+        driver = inmemory.InMemoryDriver([trigger])
+        path = os.path.join(self.dir, "bad.json")
+        with open(path, 'w') as f:
+            f.write("{not json\n" * 100)
+
+        self.assertRaises(ValueError, replay.replay,
+                          pipeline.Pipeline(driver), [path],
+                          batch_size=1, processes=2)
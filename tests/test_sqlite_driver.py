@@ -0,0 +1,189 @@
+# Copyright (c) 2014 Dark Secret Software Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+from oahu import criteria
+from oahu import pipeline
+from oahu import pipeline_callback
+from oahu import reducers
+from oahu import sqlite_driver
+from oahu import stream
+from oahu import trigger_definition
+
+
+class Callback(pipeline_callback.PipelineCallback):
+    def __init__(self):
+        super(Callback, self).__init__()
+        self.streams = []
+
+    def on_trigger(self, stream, scratchpad):
+        self.streams.append([e['_unique_id'] for e in stream.events])
+
+    def commit(self, stream, scratchpad):
+        pass
+
+
+class TestSQLiteDriver(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.callback = Callback()
+        self.trigger = trigger_definition.TriggerDefinition(
+                            "by_request", ["_context_request_id"],
+                            criteria.Inactive(60), [self.callback])
+        self.driver = sqlite_driver.SQLiteDriver(
+                            [self.trigger],
+                            os.path.join(self.directory, "oahu.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pipeline(self):
+        p = pipeline.Pipeline(self.driver)
+        now = datetime.datetime.utcnow()
+        events = [{'_unique_id': str(uuid.uuid4()),
+                   '_context_request_id': "req-%d" % (x % 4),
+                   'event_type': 'compute.instance.update',
+                   'timestamp': now + datetime.timedelta(seconds=x)}
+                  for x in range(40)]
+        p.add_events(events)
+        self.assertEqual(4, self.driver.get_num_active_streams("by_request"))
+
+        later = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+        p.do_trigger_check(-1, later)
+        p.process_ready_streams(-1, later)
+        self.assertEqual(4, len(self.callback.streams))
+        for ids in self.callback.streams:
+            self.assertEqual(10, len(ids))
+
+        p.purge_streams(-1)
+        self.assertEqual(0, self.driver.get_num_active_streams("by_request"))
+        self.assertEqual(0, self.driver.conn.execute(
+                                "SELECT COUNT(*) FROM events").fetchone()[0])
+
+    def test_state_conflict(self):
+        self.driver.add_event({'_unique_id': str(uuid.uuid4()),
+                               '_context_request_id': "req",
+                               'timestamp': datetime.datetime.utcnow()})
+        s = next(self.driver.find_streams(trigger_name="by_request"))
+        mine = self.driver.get_stream(s['stream_id'], False)
+        row = self.driver.conn.execute("SELECT " + sqlite_driver.STREAM_COLUMNS
+                                       + " FROM streams").fetchone()
+        first = self.driver._stream_from_row(row)
+        second = self.driver._stream_from_row(row)
+
+        self.driver.begin_transitions()
+        self.driver.ready("by_request", first)
+        self.assertEqual([], self.driver.flush_transitions())
+
+        self.driver.begin_transitions()
+        self.driver.ready("by_request", second)
+        failed = self.driver.flush_transitions()
+        self.assertEqual([("by_request", second)], failed)
+        self.assertEqual(1, len(mine))
+        self.assertEqual(stream.READY, self.driver.conn.execute(
+                                "SELECT state FROM streams").fetchone()[0])
+
+    def test_purge_chunk(self):
+        self.trigger.debug = True
+        now = datetime.datetime.utcnow()
+        self.driver.add_events([{'_unique_id': str(uuid.uuid4()),
+                                 '_context_request_id': "req-%d" % x,
+                                 'timestamp': now} for x in range(5)])
+        later = now + datetime.timedelta(minutes=5)
+        p = pipeline.Pipeline(self.driver)
+        p.do_trigger_check(-1, later)
+        p.process_ready_streams(-1, later)
+
+        p.purge_streams(3)
+        debugger = self.driver._get_debugger("by_request")
+        self.assertEqual(3, debugger._purged)
+        self.assertEqual(2, self.driver.get_num_active_streams("by_request"))
+
+    def test_find_streams_pages(self):
+        now = datetime.datetime.utcnow()
+        self.driver.add_events([{'_unique_id': str(uuid.uuid4()),
+                                 '_context_request_id': "req-%d" % x,
+                                 'timestamp': now} for x in range(7)])
+        self.driver.QUERY_PAGE_SIZE = 2
+        self.assertEqual(7, len(list(self.driver.find_streams())))
+        self.assertEqual(5, self.driver.count_streams(limit=5))
+
+        first = list(self.driver.find_streams(limit=4,
+                                              fields=['stream_id',
+                                                      'last_update']))
+        last = first[-1]
+        rest = list(self.driver.find_streams(
+                        after=(last['last_update'], last['stream_id']),
+                        fields=['stream_id']))
+        self.assertEqual(4, len(first))
+        self.assertEqual(3, len(rest))
+        self.assertEqual(7, len(set(s['stream_id'] for s in first + rest)))
+
+    def test_find_streams_by_trait(self):
+        now = datetime.datetime.utcnow()
+        self.driver.add_events([{'_unique_id': str(uuid.uuid4()),
+                                 '_context_request_id': "req-%d" % (x % 3),
+                                 'timestamp': now} for x in range(9)])
+        found = list(self.driver.find_streams(
+                        traits={'_context_request_id': "req-1"},
+                        fields=['identifying_traits']))
+        self.assertEqual([{'identifying_traits':
+                            {'_context_request_id': "req-1"}}], found)
+        self.assertEqual(0, self.driver.count_streams(
+                                traits={'_context_request_id': "req-9"}))
+
+    def test_aggregates(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "counted", ["_context_request_id"],
+                        criteria.Inactive(60), [],
+                        reducers=[reducers.Count('events'),
+                                  reducers.Max('last', 'timestamp')])
+        driver = sqlite_driver.SQLiteDriver(
+                        [trigger], os.path.join(self.directory, "agg.db"))
+        now = datetime.datetime.utcnow()
+        driver.add_events([{'_unique_id': str(uuid.uuid4()),
+                            '_context_request_id': "req",
+                            'timestamp': now + datetime.timedelta(seconds=x)}
+                           for x in range(3)])
+        found = driver.get_stream(next(driver.find_streams(
+                                    fields=['stream_id']))['stream_id'])
+        self.assertEqual({'events': 3,
+                          'last': now + datetime.timedelta(seconds=2)},
+                         found[0]['aggregates'])
+
+    def test_caps(self):
+        trigger = trigger_definition.TriggerDefinition(
+                        "capped", ["_context_request_id"],
+                        criteria.Inactive(60), [], debug=True,
+                        max_events=3, rollover=True)
+        driver = sqlite_driver.SQLiteDriver(
+                        [trigger], os.path.join(self.directory, "caps.db"))
+        now = datetime.datetime.utcnow()
+        driver.add_events([{'_unique_id': str(uuid.uuid4()),
+                            '_context_request_id': "req",
+                            'timestamp': now}
+                           for x in range(7)])
+        self.assertEqual(2, driver.count_streams(state=stream.READY))
+        self.assertEqual(1, driver.count_streams(state=stream.COLLECTING))
+        ready = next(driver.find_streams(state=stream.READY, details=True))
+        self.assertEqual(3, len(ready['events']))
+        self.assertEqual({'max_events': 2},
+                         driver._get_debugger("capped")._cap_hits)